@@ -0,0 +1,76 @@
+"""Проверка калькулятора на неудобных выражениях: каждое должно быстро завершаться ошибкой или числом.
+
+Запуск: python bench_calculator.py [число случайных выражений]
+"""
+import random
+import sys
+import time
+
+from calculator import MAX_SECONDS, evaluate
+
+# Запас сверх внутреннего лимита Evaluator на разбор выражения и шум планировщика
+TIME_LIMIT = MAX_SECONDS + 0.2
+
+NASTY = [
+    '9**9**9',
+    '9**9**9**9',
+    '(10**100)**(10**100)',
+    '2**4097',
+    '-(2**10000)',
+    'factorial(10**6)',
+    'factorial(factorial(20))',
+    'factorial(100000)',
+    '(10**1000)*(10**1000)*(10**1000)*(10**1000)',
+    '*'.join(['(2**4000)'] * 20),
+    '*'.join(['99999999999999999999'] * 100),
+    '(' * 100 + '1' + ')' * 100,
+    '(' * 1000 + '1' + ')' * 1000,
+    '-' * 400 + '1',
+    '+'.join(['1'] * 1000),
+    'round(1.5, 10**9)',
+    'exp(10**6)',
+    'sqrt(-1)',
+    '1/0',
+    '10**-10**9',
+    '1e308*10',
+    '__import__("os")',
+    '().__class__',
+    'max(*[1]*10)',
+    'lambda: 1',
+    '[1]*10**9',
+]
+
+def check(expression: str) -> float:
+    started = time.monotonic()
+    result = evaluate(expression)
+    elapsed = time.monotonic() - started
+    assert isinstance(result, str), (expression, result)
+    # Целые ограничены MAX_INT_BITS (4096 бит ~ 1234 цифры), так что длинный ответ - признак обхода лимитов
+    assert len(result) <= 1300, f"{expression[:60]!r}: ответ из {len(result)} символов"
+    assert elapsed < TIME_LIMIT, f"{expression[:60]!r}: {elapsed:.3f} с"
+    return elapsed
+
+def random_expression(rng: random.Random, depth: int) -> str:
+    if depth <= 0 or rng.random() < 0.2:
+        return str(rng.choice([rng.randint(0, 10 ** rng.randint(1, 30)), rng.random() * 1000, 9, 2]))
+    kind = rng.random()
+    if kind < 0.6:
+        op = rng.choice(['+', '-', '*', '/', '//', '%', '**'])
+        return f"({random_expression(rng, depth - 1)}{op}{random_expression(rng, depth - 1)})"
+    if kind < 0.8:
+        return f"-{random_expression(rng, depth - 1)}"
+    func = rng.choice(['factorial', 'sqrt', 'exp', 'log', 'abs', 'floor', 'round'])
+    return f"{func}({random_expression(rng, depth - 1)})"
+
+def main(iterations: int = 2000):
+    worst = max(check(expression) for expression in NASTY)
+    print(f"Неудобные выражения: {len(NASTY)}, худшее время {worst * 1000:.1f} мс")
+
+    rng = random.Random(0)
+    worst = 0.0
+    for _ in range(iterations):
+        worst = max(worst, check(random_expression(rng, rng.randint(1, 8))))
+    print(f"Случайные выражения: {iterations}, худшее время {worst * 1000:.1f} мс")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
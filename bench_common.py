@@ -0,0 +1,19 @@
+"""Общая подготовка для bench_*.py: main.py импортируется во временном каталоге с тестовым токеном.
+
+База userdata.db создаётся во временном каталоге, так что рабочие данные бота не затрагиваются;
+Telegram и Ollama бенчмарки не вызывают.
+"""
+import os
+import sys
+import tempfile
+
+def load_main():
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix='ollama-bot-bench-'))
+    os.environ.setdefault('BOT_TOKEN', '123456:bench')
+    import main
+    return main
+
+def percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
@@ -0,0 +1,83 @@
+"""Нагрузочный тест: задержка лёгких обработчиков, пока диск занят медленными записями.
+
+Несколько пользователей параллельно открывают меню (профиль, список чатов, хосты), а один чат
+непрерывно пишет сообщения в базу, каждая запись которой искусственно тормозит на DISK_DELAY.
+Сравниваются AsyncDatabase (пул потоков + отложенная запись) и прямые вызовы Database из цикла
+событий, как было раньше. С AsyncDatabase p99 почти не растёт, при прямых вызовах - растёт на порядки.
+
+Запуск: python bench_db_latency.py [секунд на замер]
+"""
+import asyncio
+import sys
+import time
+from functools import wraps
+
+from bench_common import load_main, percentile
+
+USERS = 50
+DISK_DELAY = 0.1
+
+def throttled(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        # Медленный fsync: поток, выполняющий запись, стоит DISK_DELAY секунд
+        time.sleep(DISK_DELAY)
+        return func(*args, **kwargs)
+    return wrapper
+
+async def measure(bot, duration: float, busy: bool, direct: bool) -> list:
+    db, adb = bot.db, bot.adb
+    stop = time.monotonic() + duration
+    latencies = []
+
+    async def menu(user_id: int):
+        while time.monotonic() < stop:
+            # Задержка считается от момента, когда обработчик должен был начаться: так в неё входит
+            # и время, пока цикл событий был занят чужой синхронной записью
+            due = time.perf_counter() + 0.01
+            await asyncio.sleep(0.01)
+            db.user_cache.invalidate(user_id)
+            if direct:
+                db.get_user(user_id)
+                db.get_user_chats(user_id, bot.CHATS_PAGE_SIZE)
+                db.get_user_hosts(user_id)
+            else:
+                await adb.get_user(user_id)
+                await adb.get_user_chats(user_id, bot.CHATS_PAGE_SIZE)
+                await adb.get_user_hosts(user_id)
+            latencies.append(time.perf_counter() - due)
+
+    async def writer(chat_id: int):
+        while time.monotonic() < stop:
+            if direct:
+                db.add_message(chat_id, 'user', 'x' * 1000)
+            else:
+                await adb.add_message(chat_id, 'user', 'x' * 1000)
+            await asyncio.sleep(0.005)
+
+    tasks = [menu(user_id) for user_id in range(1, USERS + 1)]
+    if busy:
+        tasks.append(writer(bot.db.create_chat(0, 'hog', 'llama3')))
+    await asyncio.gather(*tasks)
+    await adb.flush()
+    return latencies
+
+async def run(bot, duration: float):
+    for user_id in range(0, USERS + 1):
+        bot.db.create_user(user_id, 'http://localhost:11434')
+        bot.db.create_chat(user_id, 'chat', 'llama3')
+
+    slow_batch, slow_add = throttled(bot.db.write_batch), throttled(bot.db.add_message)
+    fast_batch, fast_add = bot.db.write_batch, bot.db.add_message
+    for direct in (False, True):
+        for busy in (False, True):
+            bot.db.write_batch, bot.db.add_message = (slow_batch, slow_add) if busy else (fast_batch, fast_add)
+            latencies = await measure(bot, duration, busy, direct)
+            print(f"{'Database из цикла' if direct else 'AsyncDatabase':17} | {'диск занят' if busy else 'диск свободен':13} | "
+                  f"обработчиков {len(latencies):5} | p50 {percentile(latencies, 0.5) * 1000:7.2f} мс | "
+                  f"p99 {percentile(latencies, 0.99) * 1000:7.2f} мс")
+    await bot.close_resources()
+
+if __name__ == '__main__':
+    bot = load_main()
+    asyncio.run(run(bot, float(sys.argv[1]) if len(sys.argv) > 1 else 3))
@@ -0,0 +1,59 @@
+"""Сколько соединений SQLite открывает один ход чата: с пулом Database и при соединении на каждый вызов.
+
+Ход повторяет запросы text_message_handler к базе (профиль, хосты, чат, история, два сообщения,
+статистика промпта). Пул открывает соединения только на первом ходу, дальше - ноль.
+
+Запуск: python bench_db_pool.py [число ходов]
+"""
+import sys
+import time
+
+from bench_common import load_main
+
+def turn(db, user_id: int, chat_id: int, close_after_call: bool):
+    calls = [
+        lambda: db.get_user(user_id),
+        lambda: db.get_user_hosts(user_id),
+        lambda: db.get_chat(chat_id),
+        lambda: db.add_message(chat_id, 'user', 'Привет! Как дела?'),
+        lambda: db.get_chat_summary(chat_id),
+        lambda: db.get_chat_messages_after(chat_id, 0),
+        lambda: db.add_message(chat_id, 'assistant', 'Хорошо, спасибо!'),
+        lambda: db.record_prompt_eval(chat_id, 100, 20, 1000000),
+    ]
+    for call in calls:
+        db.user_cache.clear()
+        call()
+        if close_after_call:
+            # Так вёл себя Database до пула: новое соединение на каждый запрос
+            db.close()
+
+def run(db, user_id: int, chat_id: int, turns: int, close_after_call: bool):
+    connects = []
+    started = time.perf_counter()
+    for _ in range(turns):
+        before = db.stats['connects']
+        turn(db, user_id, chat_id, close_after_call)
+        connects.append(db.stats['connects'] - before)
+    elapsed = time.perf_counter() - started
+    return connects, elapsed / turns
+
+def main(turns: int = 200):
+    bot = load_main()
+    db = bot.Database('bench.db')
+    db.create_user(1, 'http://localhost:11434')
+    chat_id = db.create_chat(1, 'bench', 'llama3')
+
+    db.close()
+    connects, per_turn = run(db, 1, chat_id, turns, close_after_call=False)
+    print(f"Пул: первый ход - {connects[0]} соединений, следующие {turns - 1} ходов - {sum(connects[1:])} "
+          f"соединений; {per_turn * 1000:.2f} мс на ход")
+    print(f"db.stats: {db.stats}")
+    assert sum(connects[1:]) == 0, connects
+
+    connects, per_turn = run(db, 1, chat_id, turns, close_after_call=True)
+    print(f"Соединение на вызов: {sum(connects) / turns:.0f} соединений на ход; {per_turn * 1000:.2f} мс на ход")
+    db.close()
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,102 @@
+"""Бенчмарк индексов: засевает базу миллионами сообщений и проверяет планы запросов Database.
+
+Запросы не дублируются здесь вручную: методы Database вызываются как есть, их SQL перехватывается
+через trace callback и прогоняется через EXPLAIN QUERY PLAN. Каждая таблица chats/messages/hosts
+должна читаться поиском по индексу (SEARCH), а не полным просмотром (SCAN).
+
+Запуск: python bench_migrations.py [число сообщений]
+"""
+import random
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bench_common import load_main
+
+USERS = 2000
+CHATS_PER_USER = 5
+HOSTS_PER_USER = 2
+INDEXED_TABLES = ('messages', 'chats', 'hosts')
+
+def seed(db, messages: int):
+    started = time.perf_counter()
+    base = datetime(2024, 1, 1)
+    chats = USERS * CHATS_PER_USER
+    with db.connection() as conn:
+        conn.executemany('INSERT INTO users (user_id, host) VALUES (?, ?)',
+                         ((u, 'http://localhost:11434') for u in range(1, USERS + 1)))
+        conn.executemany('INSERT INTO hosts (user_id, host_url, host_name, is_active, created_at) VALUES (?, ?, ?, 0, ?)',
+                         ((u, f'http://host{h}:11434', f'host{h}', base + timedelta(minutes=h))
+                          for u in range(1, USERS + 1) for h in range(HOSTS_PER_USER)))
+        conn.executemany('INSERT INTO chats (id, user_id, chat_name, model, created_at) VALUES (?, ?, ?, ?, ?)',
+                         ((c, (c - 1) // CHATS_PER_USER + 1, f'chat {c}', 'llama3', base + timedelta(seconds=c))
+                          for c in range(1, chats + 1)))
+        rng = random.Random(0)
+        conn.executemany('INSERT INTO messages (chat_id, role, content, timestamp) VALUES (?, ?, ?, ?)',
+                         ((rng.randint(1, chats), 'user' if i % 2 else 'assistant', 'x' * 40, base)
+                          for i in range(messages)))
+    print(f"Засеяно {messages} сообщений в {chats} чатах за {time.perf_counter() - started:.1f} с")
+
+def traced(db, call) -> list:
+    statements = []
+    with db.connection() as conn:
+        conn.set_trace_callback(statements.append)
+    try:
+        call()
+    finally:
+        with db.connection() as conn:
+            conn.set_trace_callback(None)
+    return [s for s in statements if re.match(r'\s*(SELECT|UPDATE|DELETE)', s, re.IGNORECASE)]
+
+def check_plan(db, statement: str) -> list:
+    with db.connection() as conn:
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + statement)]
+    for line in plan:
+        # SQLite < 3.36 пишет 'SCAN TABLE messages', новее - 'SCAN messages'
+        match = re.match(r'(SCAN|SEARCH) (?:TABLE )?(\w+)', line)
+        if match and match.group(2) in INDEXED_TABLES:
+            assert match.group(1) == 'SEARCH', f"полный просмотр {match.group(2)}:\n  {statement}\n  {plan}"
+    return plan
+
+def main(messages: int = 2_000_000):
+    bot = load_main()
+    # Один поток соединений: trace callback ставится на то же соединение, что выполняет запросы
+    db = bot.Database('bench.db', pool_size=1)
+    seed(db, messages)
+    db.user_cache.clear()
+
+    chat_id, user_id = USERS * CHATS_PER_USER // 2, USERS // 2
+    page = db.get_user_chats(user_id, 2)
+    cursor = (page[-1]['created_at'], page[-1]['id'])
+    last = db.get_last_message(chat_id)
+    calls = {
+        'get_chat_messages': lambda: db.get_chat_messages(chat_id),
+        'get_chat_messages_after': lambda: db.get_chat_messages_after(chat_id, last['id'] - 1000),
+        'get_last_message': lambda: db.get_last_message(chat_id),
+        'update_last_message': lambda: db.update_last_message(chat_id, 'edited'),
+        'update_message': lambda: db.update_message(chat_id, last['id'], 'edited'),
+        'get_user_chats': lambda: db.get_user_chats(user_id, bot.CHATS_PAGE_SIZE),
+        'get_user_chats (cursor)': lambda: db.get_user_chats(user_id, bot.CHATS_PAGE_SIZE, cursor),
+        'get_user_hosts': lambda: db.get_user_hosts(user_id),
+        'get_chat': lambda: db.get_chat(chat_id),
+    }
+    for name, call in calls.items():
+        statements = traced(db, call)
+        started = time.perf_counter()
+        call()
+        elapsed = time.perf_counter() - started
+        plans = [check_plan(db, statement) for statement in statements]
+        print(f"{name:24} {elapsed * 1000:8.2f} мс  {' | '.join('; '.join(p) for p in plans)}")
+
+    # Каскадное удаление находит сообщения чата по idx_messages_chat_id, а не просмотром всей таблицы
+    started = time.perf_counter()
+    db.delete_chat(chat_id)
+    print(f"{'delete_chat (cascade)':24} {(time.perf_counter() - started) * 1000:8.2f} мс")
+    with db.connection() as conn:
+        assert not conn.execute('SELECT 1 FROM messages WHERE chat_id = ? LIMIT 1', (chat_id,)).fetchone()
+    print("Все запросы используют индексы")
+    db.close()
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000)
@@ -0,0 +1,81 @@
+"""Пропускная способность шардирования: сколько обновлений в секунду проходят через 1, 2, 4 процесса.
+
+Процессы-обработчики запускаются настоящим run_shard, обновления раздаются настоящим route_update;
+подменяется только dp.feed_update - вместо обработчиков бота он CPU_MS миллисекунд считает
+(разбор, форматирование, работа с базой) и IO_MS миллисекунд ждёт (Telegram, Ollama).
+Время запуска процессов в замер не входит. Рост возможен только до числа ядер: на одном ядре
+процессы делят его между собой, и пропускная способность не меняется.
+
+Запуск: python bench_shards.py [число обновлений] [CPU_MS] [IO_MS]
+"""
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+
+from bench_common import load_main
+
+USERS = 1000
+WORKERS = (1, 2, 4)
+
+def busy(seconds: float):
+    stop = time.perf_counter() + seconds
+    while time.perf_counter() < stop:
+        pass
+
+def worker(updates, shard: int, ready, finished, cpu: float, io: float):
+    bot = load_main()
+
+    async def feed_update(_bot, update):
+        busy(cpu)
+        await asyncio.sleep(io)
+        finished[shard] = time.time()
+
+    bot.dp.feed_update = feed_update
+    ready.release()
+    bot.run_shard_worker(updates, shard)
+
+def message(update_id: int) -> dict:
+    user = {'id': update_id % USERS + 1, 'is_bot': False, 'first_name': 'bench'}
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'date': 0, 'chat': dict(user, type='private'),
+                                                 'from': user, 'text': 'Привет'}}
+
+def measure(bot, workers: int, total: int, cpu: float, io: float) -> float:
+    context = multiprocessing.get_context('spawn')
+    bot.SHARD_PROCESSES = workers
+    bot.shard_stats['routed'] = [0] * workers
+    queues = [context.Queue(bot.SHARD_QUEUE_SIZE) for _ in range(workers)]
+    ready = context.Semaphore(0)
+    finished = context.Array('d', workers)
+    processes = [context.Process(target=worker, args=(q, i, ready, finished, cpu, io)) for i, q in enumerate(queues)]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        ready.acquire()
+
+    async def ingress():
+        for update_id in range(total):
+            await bot.route_update(queues, message(update_id))
+
+    started = time.time()
+    asyncio.run(ingress())
+    for q in queues:
+        q.put(None)
+    for process in processes:
+        process.join()
+    return total / (max(finished) - started)
+
+def main(total: int = 2000, cpu_ms: float = 2, io_ms: float = 20):
+    bot = load_main()
+    print(f"Ядер: {os.cpu_count()}; обновление - {cpu_ms} мс CPU и {io_ms} мс ожидания")
+    baseline = None
+    for workers in WORKERS:
+        rate = measure(bot, workers, total, cpu_ms / 1000, io_ms / 1000)
+        baseline = baseline or rate
+        print(f"Процессов {workers}: {rate:8.0f} обновлений/с  (x{rate / baseline:.2f}), "
+              f"распределение {bot.shard_stats['routed']}")
+
+if __name__ == '__main__':
+    args = [float(a) for a in sys.argv[1:]]
+    main(int(args[0]) if args else 2000, *args[1:])
@@ -0,0 +1,155 @@
+import ast
+import asyncio
+import math
+import multiprocessing
+import multiprocessing.pool
+import operator
+import time
+from typing import Optional, Union
+
+# Ограничения вычисления: любое выражение укладывается в них за миллисекунды
+MAX_EXPRESSION_LENGTH = 500
+MAX_NODES = 200
+MAX_OPERATIONS = 1000
+MAX_INT_BITS = 4096
+MAX_SECONDS = 0.5
+
+Number = Union[int, float]
+
+# Результат, зависящий от загрузки машины, а не от выражения: его нельзя запоминать
+TIMEOUT_RESULT = "Ошибка вычисления: превышено время вычисления"
+
+class CalculatorError(Exception):
+    """Выражение недопустимо или превышает ограничения"""
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+
+UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+FUNCTIONS = {
+    'abs': abs, 'round': round, 'min': min, 'max': max,
+    'sqrt': math.sqrt, 'exp': math.exp, 'log': math.log, 'log10': math.log10, 'log2': math.log2,
+    'sin': math.sin, 'cos': math.cos, 'tan': math.tan, 'asin': math.asin, 'acos': math.acos, 'atan': math.atan,
+    'floor': math.floor, 'ceil': math.ceil, 'factorial': math.factorial,
+}
+
+CONSTANTS = {'pi': math.pi, 'e': math.e, 'tau': math.tau}
+
+def _bits(value: Number) -> int:
+    return abs(value).bit_length() if isinstance(value, int) else 0
+
+class Evaluator:
+    """Обход AST с подсчётом операций, проверкой размера целых и времени"""
+    def __init__(self, max_operations: int = MAX_OPERATIONS, max_int_bits: int = MAX_INT_BITS,
+                 max_seconds: float = MAX_SECONDS):
+        self.max_operations = max_operations
+        self.max_int_bits = max_int_bits
+        self.deadline = time.monotonic() + max_seconds
+        self.operations = 0
+
+    def _tick(self):
+        self.operations += 1
+        if self.operations > self.max_operations:
+            raise CalculatorError('слишком много операций')
+        if time.monotonic() > self.deadline:
+            raise CalculatorError('превышено время вычисления')
+
+    def _check_size(self, value: Number) -> Number:
+        if _bits(value) > self.max_int_bits:
+            raise CalculatorError('слишком большое число')
+        return value
+
+    def _estimate(self, op: type, left: Number, right: Number):
+        # Размер результата оценивается до вычисления, чтобы 9**9**9 не успел занять процессор
+        if not (isinstance(left, int) and isinstance(right, int)):
+            return
+        if op is ast.Pow and right > 0 and _bits(left) > 1 and (_bits(left) - 1) * right > self.max_int_bits:
+            raise CalculatorError('слишком большое число')
+        if op is ast.Mult and _bits(left) + _bits(right) > self.max_int_bits + 1:
+            raise CalculatorError('слишком большое число')
+
+    def visit(self, node: ast.AST) -> Number:
+        self._tick()
+        if isinstance(node, ast.Expression):
+            return self.visit(node.body)
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return self._check_size(node.value)
+        if isinstance(node, ast.Name) and node.id in CONSTANTS:
+            return CONSTANTS[node.id]
+        if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            return UNARY_OPERATORS[type(node.op)](self.visit(node.operand))
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+            left, right = self.visit(node.left), self.visit(node.right)
+            self._estimate(type(node.op), left, right)
+            return self._check_size(BINARY_OPERATORS[type(node.op)](left, right))
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS
+                and not node.keywords):
+            args = [self.visit(arg) for arg in node.args]
+            if node.func.id == 'factorial' and args and isinstance(args[0], int):
+                # log2(n!) < n * log2(n): заведомо огромный факториал не вычисляем
+                if args[0] * args[0].bit_length() > self.max_int_bits * 2:
+                    raise CalculatorError('слишком большое число')
+            if node.func.id == 'round' and len(args) > 1 and isinstance(args[1], int) and abs(args[1]) > 100:
+                raise CalculatorError('слишком большая точность округления')
+            return self._check_size(FUNCTIONS[node.func.id](*args))
+        raise CalculatorError(f'недопустимое выражение: {type(node).__name__}')
+
+def evaluate(expression: str) -> str:
+    """Безопасно вычисляет арифметическое выражение; при ошибке возвращает её текст"""
+    try:
+        if len(expression) > MAX_EXPRESSION_LENGTH:
+            raise CalculatorError('слишком длинное выражение')
+        tree = ast.parse(expression.strip(), mode='eval')
+        if sum(1 for _ in ast.walk(tree)) > MAX_NODES:
+            raise CalculatorError('слишком длинное выражение')
+        result = Evaluator().visit(tree)
+        if isinstance(result, float) and result.is_integer() and abs(result) < 2 ** 53:
+            result = int(result)
+        return str(result)
+    except (CalculatorError, SyntaxError, ValueError, TypeError, ArithmeticError) as e:
+        return f"Ошибка вычисления: {e}"
+
+class CalculatorPool:
+    """Вычисление в отдельных процессах с жёстким таймаутом: зависший процесс убивается вместе с пулом"""
+    def __init__(self, processes: int, timeout: float):
+        self.processes = processes
+        self.timeout = timeout
+        self._pool: Optional[multiprocessing.pool.Pool] = None
+
+    def _get_pool(self) -> 'multiprocessing.pool.Pool':
+        if self._pool is None:
+            self._pool = multiprocessing.get_context('spawn').Pool(self.processes)
+        return self._pool
+
+    async def evaluate(self, expression: str) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(result):
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(result))
+
+        def reject(error):
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_exception(error))
+
+        self._get_pool().apply_async(evaluate, (expression,), callback=resolve, error_callback=reject)
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.close()
+            return TIMEOUT_RESULT
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
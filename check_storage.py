@@ -0,0 +1,42 @@
+"""Проверка хранилищ состояний: круговой путь get_user_state/set_user_state/update_user_state и TTL.
+
+Проверяются SQLiteStorage и RedisStorage; Redis подменяется локальным fakeredis, так что сервер
+не нужен. Без пакетов redis и fakeredis проверка Redis пропускается.
+
+Запуск: python check_storage.py
+"""
+import asyncio
+
+from bench_common import load_main
+
+TTL = 1
+
+async def check(bot, name: str, storage):
+    bot.storage = storage
+    user_id = 42
+    assert await bot.get_user_state(user_id) == {}, name
+    await bot.set_user_state(user_id, {'current_chat': 7})
+    await bot.update_user_state(user_id, page=2)
+    assert await bot.get_user_state(user_id) == {'current_chat': 7, 'page': 2}, name
+    # Состояние одного пользователя не видно другому и не смешивается с FSM того же пользователя
+    assert await bot.get_user_state(user_id + 1) == {}, name
+    assert await storage.get_data(bot.StorageKey(bot_id=bot.bot.id, chat_id=user_id, user_id=user_id)) == {}, name
+    await asyncio.sleep(TTL + 0.5)
+    assert await bot.get_user_state(user_id) == {}, f"{name}: состояние пережило TTL"
+    await storage.close()
+    print(f"{name}: круговой путь и TTL в порядке")
+
+async def run(bot):
+    await check(bot, 'SQLiteStorage', bot.SQLiteStorage(bot.adb, ttl=TTL))
+    try:
+        from fakeredis import FakeServer
+        from fakeredis.aioredis import FakeRedis
+    except ImportError:
+        print("RedisStorage: пропущено, нужны пакеты redis и fakeredis")
+    else:
+        await check(bot, 'RedisStorage (fakeredis)', bot.redis_storage(FakeRedis(server=FakeServer()), ttl=TTL))
+    await bot.close_resources()
+
+if __name__ == '__main__':
+    bot = load_main()
+    asyncio.run(run(bot))
@@ -57,6 +57,7 @@ LOCALES = {
         'model_not_found': '❌ Model not found. Please check the name and try again.',
         'loading_model': '⏳ Loading model...',
         'model_loaded': '✅ Model loaded!',
+        'model_selected': '✅ Model selected, it is loading in the background',
         'model_load_error': '❌ Error loading model',
         'unloading_model': '⏳ Unloading model...',
         'model_unloaded': '✅ Model unloaded',
@@ -82,7 +83,7 @@ LOCALES = {
         'none': 'None',
         'select_translator_model': '🌐 Select translator model',
         'translator_set': '✅ Translator model set',
-        'manage_models_text': '📦 Model Management\n\n📥 - Load model\n📤 - Unload model',
+        'manage_models_text': '📦 Model Management\n\nModels are loaded and unloaded automatically based on demand.\n🟢 - in memory · number of requests',
         'select_language': '🌍 Select Language',
         'language_changed': '✅ Language changed',
         
@@ -101,6 +102,8 @@ LOCALES = {
         'inline_translate': '🌐 Translate',
         'inline_translate_desc': 'Translate your text',
         'no_translator': '⚠️ Translator model not configured',
+        'queue_position': '⏳ Server is busy. Your place in queue: {position}',
+        'generation_superseded': '⏹ Generation stopped: a newer message arrived.',
     },
     
     'ru': {
@@ -148,6 +151,7 @@ LOCALES = {
         'model_not_found': '❌ Модель не найдена. Проверьте название и попробуйте снова.',
         'loading_model': '⏳ Загрузка модели...',
         'model_loaded': '✅ Модель загружена!',
+        'model_selected': '✅ Модель выбрана, она загружается в фоне',
         'model_load_error': '❌ Ошибка загрузки модели',
         'unloading_model': '⏳ Выгрузка модели...',
         'model_unloaded': '✅ Модель выгружена',
@@ -173,7 +177,7 @@ LOCALES = {
         'none': 'Нет',
         'select_translator_model': '🌐 Выберите модель-переводчик',
         'translator_set': '✅ Модель-переводчик установлена',
-        'manage_models_text': '📦 Управление моделями\n\n📥 - Загрузить модель\n📤 - Выгрузить модель',
+        'manage_models_text': '📦 Управление моделями\n\nМодели загружаются и выгружаются автоматически по спросу.\n🟢 - в памяти · число запросов',
         'select_language': '🌍 Выберите язык',
         'language_changed': '✅ Язык изменен',
         
@@ -192,6 +196,8 @@ LOCALES = {
         'inline_translate': '🌐 Перевести',
         'inline_translate_desc': 'Перевести ваш текст',
         'no_translator': '⚠️ Модель-переводчик не настроена',
+        'queue_position': '⏳ Сервер занят. Ваше место в очереди: {position}',
+        'generation_superseded': '⏹ Генерация остановлена: пришло более новое сообщение.',
     },
     
     'es': {
@@ -230,6 +236,7 @@ LOCALES = {
         'model_not_found': '❌ Modelo no encontrado. Verifique el nombre e intente nuevamente.',
         'loading_model': '⏳ Cargando modelo...',
         'model_loaded': '✅ ¡Modelo cargado!',
+        'model_selected': '✅ Modelo seleccionado, se está cargando en segundo plano',
         'model_load_error': '❌ Error al cargar el modelo',
         'unloading_model': '⏳ Descargando modelo...',
         'model_unloaded': '✅ Modelo descargado',
@@ -251,7 +258,7 @@ LOCALES = {
         'none': 'Ninguno',
         'select_translator_model': '🌐 Seleccione modelo traductor',
         'translator_set': '✅ Modelo traductor configurado',
-        'manage_models_text': '📦 Gestión de Modelos\n\n📥 - Cargar modelo\n📤 - Descargar modelo',
+        'manage_models_text': '📦 Gestión de Modelos\n\nLos modelos se cargan y descargan automáticamente según la demanda.\n🟢 - en memoria · número de solicitudes',
         'select_language': '🌍 Seleccionar Idioma',
         'language_changed': '✅ Idioma cambiado',
         'please_select_model': '⚠️ Seleccione primero un modelo',
@@ -266,6 +273,8 @@ LOCALES = {
         'inline_translate': '🌐 Traducir',
         'inline_translate_desc': 'Traducir su texto',
         'no_translator': '⚠️ Modelo traductor no configurado',
+        'queue_position': '⏳ El servidor está ocupado. Su lugar en la cola: {position}',
+        'generation_superseded': '⏹ Generación detenida: llegó un mensaje más reciente.',
     },
     
     'fr': {
@@ -304,6 +313,7 @@ LOCALES = {
         'model_not_found': '❌ Modèle non trouvé. Vérifiez le nom et réessayez.',
         'loading_model': '⏳ Chargement du modèle...',
         'model_loaded': '✅ Modèle chargé!',
+        'model_selected': '✅ Modèle sélectionné, il se charge en arrière-plan',
         'model_load_error': '❌ Erreur de chargement du modèle',
         'unloading_model': '⏳ Déchargement du modèle...',
         'model_unloaded': '✅ Modèle déchargé',
@@ -325,7 +335,7 @@ LOCALES = {
         'none': 'Aucun',
         'select_translator_model': '🌐 Sélectionner modèle traducteur',
         'translator_set': '✅ Modèle traducteur configuré',
-        'manage_models_text': '📦 Gestion des Modèles\n\n📥 - Charger modèle\n📤 - Décharger modèle',
+        'manage_models_text': '📦 Gestion des Modèles\n\nLes modèles sont chargés et déchargés automatiquement selon la demande.\n🟢 - en mémoire · nombre de requêtes',
         'select_language': '🌍 Sélectionner Langue',
         'language_changed': '✅ Langue changée',
         'please_select_model': '⚠️ Veuillez d\'abord sélectionner un modèle',
@@ -340,6 +350,8 @@ LOCALES = {
         'inline_translate': '🌐 Traduire',
         'inline_translate_desc': 'Traduire votre texte',
         'no_translator': '⚠️ Modèle traducteur non configuré',
+        'queue_position': '⏳ Le serveur est occupé. Votre place dans la file : {position}',
+        'generation_superseded': '⏹ Génération interrompue : un message plus récent est arrivé.',
     },
     
     'de': {
@@ -378,6 +390,7 @@ LOCALES = {
         'model_not_found': '❌ Modell nicht gefunden. Überprüfen Sie den Namen und versuchen Sie es erneut.',
         'loading_model': '⏳ Modell wird geladen...',
         'model_loaded': '✅ Modell geladen!',
+        'model_selected': '✅ Modell ausgewählt, es wird im Hintergrund geladen',
         'model_load_error': '❌ Fehler beim Laden des Modells',
         'unloading_model': '⏳ Modell wird entladen...',
         'model_unloaded': '✅ Modell entladen',
@@ -399,7 +412,7 @@ LOCALES = {
         'none': 'Keine',
         'select_translator_model': '🌐 Übersetzer-Modell wählen',
         'translator_set': '✅ Übersetzer-Modell festgelegt',
-        'manage_models_text': '📦 Modellverwaltung\n\n📥 - Modell laden\n📤 - Modell entladen',
+        'manage_models_text': '📦 Modellverwaltung\n\nModelle werden je nach Bedarf automatisch geladen und entladen.\n🟢 - im Speicher · Anzahl der Anfragen',
         'select_language': '🌍 Sprache Wählen',
         'language_changed': '✅ Sprache geändert',
         'please_select_model': '⚠️ Bitte wählen Sie zuerst ein Modell',
@@ -414,6 +427,8 @@ LOCALES = {
         'inline_translate': '🌐 Übersetzen',
         'inline_translate_desc': 'Ihren Text übersetzen',
         'no_translator': '⚠️ Übersetzer-Modell nicht konfiguriert',
+        'queue_position': '⏳ Server ausgelastet. Ihr Platz in der Warteschlange: {position}',
+        'generation_superseded': '⏹ Generierung abgebrochen: eine neuere Nachricht ist eingetroffen.',
     },
 }
 
@@ -425,3 +440,13 @@ for lang_code in LANGUAGES.keys():
         for key in LOCALES['en'].keys():
             if key not in LOCALES[lang_code]:
                 LOCALES[lang_code][key] = LOCALES['en'][key]
+
+DEFAULT_LOCALE = 'ru'
+
+def compile_locales() -> dict:
+    """Build flat per-locale string tables with the default locale already merged in."""
+    default = LOCALES[DEFAULT_LOCALE]
+    return {code: {**default, **strings} for code, strings in LOCALES.items()}
+
+# Precompiled tables: STRINGS[locale][key] never needs a fallback lookup
+STRINGS = compile_locales()
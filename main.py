@@ -1,19 +1,179 @@
 import asyncio
+import hashlib
+import inspect
 import json
+import multiprocessing
+import os
+import queue
 import sqlite3
 import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
+from functools import partial
 from datetime import datetime
-from typing import Optional, Dict, List
+from typing import Any, Optional, Dict, List, Tuple, Callable, Awaitable
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, InlineQueryResultArticle, InputTextMessageContent
 import aiohttp
-from localization import LOCALES, LANGUAGES
-
-API_TOKEN = 'YOUR_BOT_TOKEN_HERE'
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from localization import LANGUAGES, STRINGS, DEFAULT_LOCALE
+from calculator import TIMEOUT_RESULT, CalculatorPool, evaluate
+
+# Токен можно передать и через переменную окружения BOT_TOKEN
+API_TOKEN = os.environ.get('BOT_TOKEN', 'YOUR_BOT_TOKEN_HERE')
+
+# Webhook: если задан публичный адрес, бот принимает обновления через aiohttp вместо long polling
+WEBHOOK_URL = None  # например 'https://bot.example.com'
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_SECRET = None  # X-Telegram-Bot-Api-Secret-Token: 1-256 символов A-Z, a-z, 0-9, _ и -
+# Число процессов-обработчиков webhook; при WEBHOOK_WORKERS > 1 обновления принимает один процесс
+# и раздаёт их по user_id (как SHARD_WORKERS), поэтому кэши и отложенные записи остаются согласованными
+WEBHOOK_WORKERS = 1
+# Шардирование: один процесс принимает обновления и раздаёт их SHARD_WORKERS процессам по user_id,
+# так что обновления одного пользователя всегда обрабатываются одним процессом и по порядку
+SHARD_WORKERS = 1
+SHARD_QUEUE_SIZE = 1000
+
+# Хранилище состояний FSM и текущих чатов: 'sqlite', 'redis' или 'memory'
+STORAGE_BACKEND = 'sqlite'
+REDIS_URL = 'redis://localhost:6379/0'
+# Состояние пользователя забывается после STATE_TTL секунд бездействия
+STATE_TTL = 7 * 24 * 3600
+STATE_PURGE_EVERY = 500
+
+# Пул соединений SQLite
+DB_POOL_SIZE = 4
+DB_STATEMENT_CACHE = 256
+DB_CACHE_SIZE_KB = 16384
+
+# Кэш профилей пользователей (get_user / get_locale / t)
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300
+
+# HTTP-соединения с Ollama
+OLLAMA_CONN_LIMIT = 8
+OLLAMA_KEEPALIVE = 60
+
+# Кэш списков моделей хостов: до MODEL_CACHE_TTL секунд список свежий, до MODEL_CACHE_MAX_STALE
+# отдаётся сразу и обновляется в фоне, старше - запрос ждёт ответа хоста
+MODEL_CACHE_TTL = 60
+MODEL_CACHE_MAX_STALE = 3600
+
+# Пул Ollama-хостов: период фоновой проверки доступности, сек
+HOST_HEALTH_INTERVAL = 30
+
+# Не больше HOST_CONCURRENCY одновременных /api/chat на один хост, остальные ждут в очереди
+HOST_CONCURRENCY = 2
+# Сообщение о месте в очереди правится не чаще раза в QUEUE_NOTICE_INTERVAL секунд: промежуточные места пропускаются
+QUEUE_NOTICE_INTERVAL = 3.0
+# Новое сообщение или «Перегенерировать» в том же чате прерывает ещё идущую генерацию
+SUPERSEDE_GENERATIONS = False
+
+# Потоковая выдача ответов: правки сообщения не чаще раза в STREAM_EDIT_INTERVAL секунд
+STREAM_RESPONSES = True
+STREAM_EDIT_INTERVAL = 1.0
+STREAM_PREVIEW_LIMIT = 4000
+# Предел длины сообщения Telegram: более длинный ответ отправляется несколькими сообщениями
+MESSAGE_LIMIT = 4096
+
+# Конвейерный перевод потокового ответа: минимальный размер куска, отправляемого переводчику
+PIPELINED_TRANSLATION = True
+PIPELINE_MIN_CHARS = 120
+LANG_DETECT_MIN_LETTERS = 12
+SENTENCE_END = re.compile(r'[.!?…。！？]+["»)\]]*\s+|\n+')
+
+# Кэш переводов: записей в памяти, строк в SQLite и частота проверки лимита
+TRANSLATION_CACHE_SIZE = 2048
+TRANSLATION_DB_MAX_ROWS = 100000
+TRANSLATION_EVICT_EVERY = 100
+# Калькулятор: ограничения вычисления - в calculator.py; при CALCULATOR_PROCESSES > 0
+# выражения считаются в отдельных процессах и обрываются через CALCULATOR_TIMEOUT секунд
+CALCULATOR_PROCESSES = 0
+CALCULATOR_TIMEOUT = 2.0
+# Таймаут инструмента по умолчанию, сек
+TOOL_TIMEOUT = 10
+# Цикл агента: не больше AGENT_MAX_STEPS раундов вызова инструментов и AGENT_TIME_BUDGET секунд на весь ход
+AGENT_MAX_STEPS = 4
+AGENT_TIME_BUDGET = 120
+# Результаты детерминированных инструментов запоминаются в пределах чата
+TOOL_MEMO_SIZE = 1024
+
+# Сводка статистики печатается в лог раз в STATS_LOG_INTERVAL секунд (0 - выключено);
+# пользователям из ADMIN_IDS она доступна командой /stats вместе со статистикой текущего чата
+STATS_LOG_INTERVAL = 3600
+ADMIN_IDS = ()  # например (123456789,)
+
+# Кнопок на одной странице списков чатов и моделей
+CHATS_PAGE_SIZE = 8
+MODELS_PAGE_SIZE = 8
+
+# Отложенная (write-behind) запись сообщений
+WRITE_BEHIND_INTERVAL_MS = 50
+WRITE_BEHIND_MAX_OPS = 64
+BUFFERED_WRITES = ('add_message', 'update_chat_name', 'update_last_message', 'update_message')
+# Списки чатов зависят только от отложенных переименований, а не от сообщений
+CHAT_LIST_READS = ('get_user_chats',)
+CHAT_DEPENDENT_READS = ('get_chat', 'get_chat_messages', 'get_chat_messages_after', 'get_last_message', 'delete_chat')
+# Вызовы, которые не зависят от отложенных записей и никогда не ждут сброса
+INDEPENDENT_CALLS = ('get_user', 'create_user', 'update_user', 'add_host', 'get_user_hosts',
+                     'set_active_host', 'delete_host', 'create_chat', 'get_chat_summary', 'set_chat_summary',
+                     'get_translation', 'put_translation',
+                     'get_fsm', 'set_fsm_state', 'set_fsm_data', 'record_prompt_eval', 'get_prompt_stats',
+                     'record_model_demand', 'get_model_demand', 'delete_model_demand')
+
+# Контекст чата: последние CONTEXT_KEEP_MESSAGES сообщений дословно, более старые - в сводке
+CONTEXT_KEEP_MESSAGES = 8
+CONTEXT_DEFAULT_TOKENS = 4096
+# Размер контекста по префиксу имени модели
+MODEL_CONTEXT_TOKENS = {
+    'llama3': 8192,
+    'qwen2.5': 32768,
+    'mistral': 32768,
+}
+# Доля контекста, оставляемая под ответ модели
+CONTEXT_REPLY_RESERVE = 0.25
+# Сводка обновляется, когда вне окна накопилось столько несведённых сообщений
+SUMMARY_MIN_MESSAGES = 6
+# Модель для сводок (None - модель самого чата)
+SUMMARY_MODEL = None
+# Постоянный системный промпт чатов (None - без него); он всегда первый, чтобы начало запроса не менялось
+CHAT_SYSTEM_PROMPT = None
+# Окно истории сдвигается ступенями по столько сообщений: между сдвигами префикс запроса
+# побайтно совпадает с прошлым ходом, и Ollama переиспользует его KV-кэш
+CONTEXT_TRIM_STEP = 8
+
+# Автоматическая загрузка моделей: на хосте держится не больше RESIDENCY_MAX_MODELS моделей
+# (и не больше RESIDENCY_VRAM_BUDGET байт видеопамяти, если задано); порядок вытеснения - 'lfu' или 'lru'
+RESIDENCY_MAX_MODELS = 2
+RESIDENCY_VRAM_BUDGET = None
+RESIDENCY_POLICY = 'lfu'
+RESIDENCY_INTERVAL = 30
+# Модель, не использовавшаяся столько секунд, может быть выгружена ради более востребованной
+RESIDENCY_IDLE = 300
+# Период полураспада счётчика спроса (LFU), сек
+RESIDENCY_HALF_LIFE = 3600
+# Заранее подгружаются только модели, запрошенные за последние RESIDENCY_DEMAND_WINDOW секунд или
+# со счётчиком спроса не ниже RESIDENCY_MIN_SCORE; спрос, не проходящий ни по одному условию, забывается
+RESIDENCY_DEMAND_WINDOW = 1800
+RESIDENCY_MIN_SCORE = 2.0
+
+# keep_alive модели: KEEP_ALIVE_BASE секунд на каждый активный чат (не больше KEEP_ALIVE_MAX);
+# чат активен, если писал в последние ACTIVE_CHAT_WINDOW секунд
+KEEP_ALIVE_BASE = 300
+KEEP_ALIVE_MAX = 3600
+ACTIVE_CHAT_WINDOW = 900
 
 class States(StatesGroup):
     waiting_host = State()
@@ -23,1112 +183,2259 @@ class States(StatesGroup):
     waiting_message = State()
     waiting_response_edit = State()
 
+# Миграции схемы: (версия, список SQL). Применяются по порядку при старте
+MIGRATIONS = [
+    (1, [
+        # messages: внешний ключ на chats с каскадным удалением
+        '''CREATE TABLE messages_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+            role TEXT,
+            content TEXT,
+            timestamp TIMESTAMP
+        )''',
+        '''INSERT INTO messages_new (id, chat_id, role, content, timestamp)
+           SELECT id, chat_id, role, content, timestamp FROM messages
+           WHERE chat_id IN (SELECT id FROM chats)''',
+        'DROP TABLE messages',
+        'ALTER TABLE messages_new RENAME TO messages',
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages (chat_id, id)',
+        'CREATE INDEX IF NOT EXISTS idx_chats_user_created ON chats (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_hosts_user_created ON hosts (user_id, created_at)',
+    ]),
+    (2, [
+        # Сводка старой части переписки; covered_id - последнее сообщение, вошедшее в сводку
+        '''CREATE TABLE IF NOT EXISTS chat_summaries (
+            chat_id INTEGER PRIMARY KEY REFERENCES chats(id) ON DELETE CASCADE,
+            summary TEXT,
+            covered_id INTEGER,
+            updated_at TIMESTAMP
+        )''',
+    ]),
+    (3, [
+        # Кэш переводов: ключ - sha256(модель, язык, нормализованный текст)
+        '''CREATE TABLE IF NOT EXISTS translations (
+            key TEXT PRIMARY KEY,
+            translation TEXT,
+            last_used TIMESTAMP
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_translations_last_used ON translations (last_used)',
+    ]),
+    (4, [
+        # Состояния FSM aiogram и состояния пользователей (SQLiteStorage)
+        '''CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            expires_at REAL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_fsm_storage_expires ON fsm_storage (expires_at)',
+    ]),
+    (5, [
+        # Эффективность кэша префикса: сколько токенов промпта Ollama реально вычисляла
+        '''CREATE TABLE IF NOT EXISTS chat_prompt_stats (
+            chat_id INTEGER PRIMARY KEY REFERENCES chats (id) ON DELETE CASCADE,
+            requests INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            prompt_eval_count INTEGER NOT NULL DEFAULT 0,
+            prompt_eval_duration INTEGER NOT NULL DEFAULT 0
+        )''',
+    ]),
+    (6, [
+        # Спрос на модели, общий для всех процессов: по нему ResidencyManager решает, что держать в памяти
+        '''CREATE TABLE IF NOT EXISTS model_demand (
+            host TEXT NOT NULL,
+            model TEXT NOT NULL,
+            score REAL NOT NULL DEFAULT 0,
+            updated REAL NOT NULL,
+            last_used REAL NOT NULL,
+            uses INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (host, model)
+        )''',
+    ]),
+]
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш с TTL и счётчиками попаданий"""
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+    
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+def decay_score(score: float, elapsed: float) -> float:
+    """Затухание счётчика спроса (LFU) за elapsed секунд"""
+    return score * 0.5 ** (max(elapsed, 0) / RESIDENCY_HALF_LIFE)
+
 class Database:
-    def __init__(self, db_path='userdata.db'):
+    def __init__(self, db_path='userdata.db', pool_size: int = DB_POOL_SIZE):
         self.db_path = db_path
+        self.pool_size = pool_size
+        self._pool: queue.LifoQueue = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self.stats = {'connects': 0, 'checkouts': 0}
+        self.user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        # Локали без TTL: get_locale / t читают только отсюда и никогда не ходят в БД из цикла событий
+        self.locale_cache = LRUCache(USER_CACHE_SIZE)
+        self._translation_puts = 0
+        self._fsm_writes = 0
         self.init_db()
     
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                               cached_statements=DB_STATEMENT_CACHE)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA cache_size = {DB_CACHE_SIZE_KB * -1}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute('PRAGMA foreign_keys = ON')
+        conn.create_function('decay_score', 2, decay_score, deterministic=True)
+        self.stats['connects'] += 1
+        return conn
+    
+    @contextmanager
+    def connection(self):
+        """Взять соединение из пула, закоммитить и вернуть его обратно"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self._opened < self.pool_size
+                if can_open:
+                    self._opened += 1
+            conn = self._connect() if can_open else self._pool.get()
+        self.stats['checkouts'] += 1
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._pool.put(conn)
+    
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._opened = 0
+    
     def init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            host TEXT,
-            selected_model TEXT,
-            translator_model TEXT,
-            locale TEXT DEFAULT 'ru'
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS hosts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            host_url TEXT,
-            host_name TEXT,
-            is_active INTEGER DEFAULT 0,
-            created_at TIMESTAMP
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS chats (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            chat_name TEXT,
-            model TEXT,
-            created_at TIMESTAMP
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER,
-            role TEXT,
-            content TEXT,
-            timestamp TIMESTAMP
-        )''')
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            c = conn.cursor()
+            c.execute('''CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                host TEXT,
+                selected_model TEXT,
+                translator_model TEXT,
+                locale TEXT DEFAULT 'ru'
+            )''')
+            c.execute('''CREATE TABLE IF NOT EXISTS hosts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                host_url TEXT,
+                host_name TEXT,
+                is_active INTEGER DEFAULT 0,
+                created_at TIMESTAMP
+            )''')
+            c.execute('''CREATE TABLE IF NOT EXISTS chats (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                chat_name TEXT,
+                model TEXT,
+                created_at TIMESTAMP
+            )''')
+            c.execute('''CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER,
+                role TEXT,
+                content TEXT,
+                timestamp TIMESTAMP
+            )''')
+        self.migrate()
+    
+    def migrate(self):
+        """Применить недостающие миграции схемы по PRAGMA user_version"""
+        with self.connection() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for target, statements in MIGRATIONS:
+                if target <= version:
+                    continue
+                conn.execute('BEGIN')
+                try:
+                    for sql in statements:
+                        conn.execute(sql)
+                    conn.execute(f'PRAGMA user_version = {target}')
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                print(f"🗄 Миграция БД до версии {target} применена")
     
     def get_user(self, user_id: int) -> Optional[Dict]:
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        row = c.fetchone()
-        conn.close()
+        user = self.user_cache.get(user_id)
+        if user is not None:
+            return dict(user)
+        with self.connection() as conn:
+            row = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
         if row:
-            return {'user_id': row[0], 'host': row[1], 'selected_model': row[2], 
+            user = {'user_id': row[0], 'host': row[1], 'selected_model': row[2], 
                     'translator_model': row[3], 'locale': row[4]}
+            self.user_cache.set(user_id, user)
+            self.locale_cache.set(user_id, user['locale'])
+            return dict(user)
         return None
     
+    def _reload_user(self, user_id: int):
+        # После записи профиль сразу перечитывается, чтобы кэши не остались пустыми
+        self.user_cache.invalidate(user_id)
+        self.get_user(user_id)
+    
     def create_user(self, user_id: int, host: str):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('INSERT OR REPLACE INTO users (user_id, host, locale) VALUES (?, ?, ?)', 
-                  (user_id, host, 'ru'))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO users (user_id, host, locale) VALUES (?, ?, ?)', 
+                         (user_id, host, 'ru'))
+        self._reload_user(user_id)
     
     def add_host(self, user_id: int, host_url: str, host_name: str) -> int:
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        # Деактивировать все хосты пользователя
-        c.execute('UPDATE hosts SET is_active = 0 WHERE user_id = ?', (user_id,))
-        # Добавить новый активный хост
-        c.execute('INSERT INTO hosts (user_id, host_url, host_name, is_active, created_at) VALUES (?, ?, ?, 1, ?)',
-                  (user_id, host_url, host_name, datetime.now()))
-        host_id = c.lastrowid
-        # Обновить текущий хост у пользователя
-        c.execute('UPDATE users SET host = ? WHERE user_id = ?', (host_url, user_id))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            c = conn.cursor()
+            # Деактивировать все хосты пользователя
+            c.execute('UPDATE hosts SET is_active = 0 WHERE user_id = ?', (user_id,))
+            # Добавить новый активный хост
+            c.execute('INSERT INTO hosts (user_id, host_url, host_name, is_active, created_at) VALUES (?, ?, ?, 1, ?)',
+                      (user_id, host_url, host_name, datetime.now()))
+            host_id = c.lastrowid
+            # Обновить текущий хост у пользователя
+            c.execute('UPDATE users SET host = ? WHERE user_id = ?', (host_url, user_id))
+        self._reload_user(user_id)
         return host_id
     
     def get_user_hosts(self, user_id: int) -> List[Dict]:
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('SELECT * FROM hosts WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
-        rows = c.fetchall()
-        conn.close()
+        with self.connection() as conn:
+            rows = conn.execute('SELECT * FROM hosts WHERE user_id = ? ORDER BY created_at DESC', (user_id,)).fetchall()
         return [{'id': r[0], 'user_id': r[1], 'host_url': r[2], 'host_name': r[3], 'is_active': r[4], 'created_at': r[5]} for r in rows]
     
     def set_active_host(self, user_id: int, host_id: int):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        # Деактивировать все хосты
-        c.execute('UPDATE hosts SET is_active = 0 WHERE user_id = ?', (user_id,))
-        # Активировать выбранный
-        c.execute('UPDATE hosts SET is_active = 1 WHERE id = ?', (host_id,))
-        # Получить URL хоста
-        c.execute('SELECT host_url FROM hosts WHERE id = ?', (host_id,))
-        row = c.fetchone()
-        if row:
-            c.execute('UPDATE users SET host = ? WHERE user_id = ?', (row[0], user_id))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            c = conn.cursor()
+            # Деактивировать все хосты
+            c.execute('UPDATE hosts SET is_active = 0 WHERE user_id = ?', (user_id,))
+            # Активировать выбранный
+            c.execute('UPDATE hosts SET is_active = 1 WHERE id = ?', (host_id,))
+            # Получить URL хоста
+            c.execute('SELECT host_url FROM hosts WHERE id = ?', (host_id,))
+            row = c.fetchone()
+            if row:
+                c.execute('UPDATE users SET host = ? WHERE user_id = ?', (row[0], user_id))
+        self._reload_user(user_id)
     
     def delete_host(self, host_id: int):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('DELETE FROM hosts WHERE id = ?', (host_id,))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            conn.execute('DELETE FROM hosts WHERE id = ?', (host_id,))
     
     def update_user(self, user_id: int, **kwargs):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        for key, value in kwargs.items():
-            c.execute(f'UPDATE users SET {key} = ? WHERE user_id = ?', (value, user_id))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            for key, value in kwargs.items():
+                conn.execute(f'UPDATE users SET {key} = ? WHERE user_id = ?', (value, user_id))
+        self._reload_user(user_id)
     
     def create_chat(self, user_id: int, chat_name: str, model: str) -> int:
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('INSERT INTO chats (user_id, chat_name, model, created_at) VALUES (?, ?, ?, ?)',
-                  (user_id, chat_name, model, datetime.now()))
-        chat_id = c.lastrowid
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            c = conn.execute('INSERT INTO chats (user_id, chat_name, model, created_at) VALUES (?, ?, ?, ?)',
+                             (user_id, chat_name, model, datetime.now()))
+            chat_id = c.lastrowid
         return chat_id
     
-    def get_user_chats(self, user_id: int) -> List[Dict]:
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('SELECT * FROM chats WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
-        rows = c.fetchall()
-        conn.close()
+    def get_user_chats(self, user_id: int, limit: Optional[int] = None, cursor: Optional[Tuple[str, int]] = None,
+                       backward: bool = False) -> List[Dict]:
+        """Чаты от новых к старым; cursor = (created_at, id) - страница после этого чата (backward - перед ним)"""
+        query = 'SELECT * FROM chats WHERE user_id = ?'
+        params: list = [user_id]
+        if cursor:
+            query += ' AND (created_at, id) > (?, ?)' if backward else ' AND (created_at, id) < (?, ?)'
+            params += cursor
+        query += ' ORDER BY created_at, id' if backward else ' ORDER BY created_at DESC, id DESC'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+        with self.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+        if backward:
+            rows.reverse()
         return [{'id': r[0], 'user_id': r[1], 'chat_name': r[2], 'model': r[3], 'created_at': r[4]} for r in rows]
     
     def get_chat(self, chat_id: int) -> Optional[Dict]:
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('SELECT * FROM chats WHERE id = ?', (chat_id,))
-        row = c.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            row = conn.execute('SELECT * FROM chats WHERE id = ?', (chat_id,)).fetchone()
         if row:
             return {'id': row[0], 'user_id': row[1], 'chat_name': row[2], 'model': row[3], 'created_at': row[4]}
         return None
     
     def update_chat_name(self, chat_id: int, new_name: str):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('UPDATE chats SET chat_name = ? WHERE id = ?', (new_name, chat_id))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            self._update_chat_name(conn, chat_id, new_name)
+    
+    def _update_chat_name(self, conn: sqlite3.Connection, chat_id: int, new_name: str):
+        conn.execute('UPDATE chats SET chat_name = ? WHERE id = ?', (new_name, chat_id))
     
     def delete_chat(self, chat_id: int):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
-        c.execute('DELETE FROM chats WHERE id = ?', (chat_id,))
-        conn.commit()
-        conn.close()
-    
-    def add_message(self, chat_id: int, role: str, content: str):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('INSERT INTO messages (chat_id, role, content, timestamp) VALUES (?, ?, ?, ?)',
-                  (chat_id, role, content, datetime.now()))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            # Сообщения удаляются каскадно (ON DELETE CASCADE)
+            conn.execute('DELETE FROM chats WHERE id = ?', (chat_id,))
+    
+    def add_message(self, chat_id: int, role: str, content: str, timestamp: Optional[datetime] = None):
+        with self.connection() as conn:
+            self._add_message(conn, chat_id, role, content, timestamp)
+    
+    def _add_message(self, conn: sqlite3.Connection, chat_id: int, role: str, content: str,
+                     timestamp: Optional[datetime] = None):
+        conn.execute('INSERT INTO messages (chat_id, role, content, timestamp) VALUES (?, ?, ?, ?)',
+                     (chat_id, role, content, timestamp or datetime.now()))
     
     def get_chat_messages(self, chat_id: int) -> List[Dict]:
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('SELECT role, content FROM messages WHERE chat_id = ? ORDER BY timestamp', (chat_id,))
-        rows = c.fetchall()
-        conn.close()
+        with self.connection() as conn:
+            rows = conn.execute('SELECT role, content FROM messages WHERE chat_id = ? ORDER BY id', (chat_id,)).fetchall()
         return [{'role': r[0], 'content': r[1]} for r in rows]
     
+    def get_chat_messages_after(self, chat_id: int, after_id: int = 0) -> List[Dict]:
+        with self.connection() as conn:
+            rows = conn.execute('SELECT id, role, content FROM messages WHERE chat_id = ? AND id > ? ORDER BY id',
+                                (chat_id, after_id)).fetchall()
+        return [{'id': r[0], 'role': r[1], 'content': r[2]} for r in rows]
+    
+    def get_last_message(self, chat_id: int) -> Optional[Dict]:
+        with self.connection() as conn:
+            row = conn.execute('SELECT id, role, content FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT 1',
+                               (chat_id,)).fetchone()
+        if row:
+            return {'id': row[0], 'role': row[1], 'content': row[2]}
+        return None
+    
+    def get_chat_summary(self, chat_id: int) -> Optional[Dict]:
+        with self.connection() as conn:
+            row = conn.execute('SELECT summary, covered_id FROM chat_summaries WHERE chat_id = ?', (chat_id,)).fetchone()
+        if row:
+            return {'summary': row[0], 'covered_id': row[1]}
+        return None
+    
+    def set_chat_summary(self, chat_id: int, summary: str, covered_id: int):
+        with self.connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO chat_summaries (chat_id, summary, covered_id, updated_at) VALUES (?, ?, ?, ?)',
+                         (chat_id, summary, covered_id, datetime.now()))
+    
+    def record_prompt_eval(self, chat_id: int, prompt_tokens: int, eval_count: int, eval_duration: int):
+        with self.connection() as conn:
+            conn.execute('''INSERT INTO chat_prompt_stats (chat_id, requests, prompt_tokens, prompt_eval_count, prompt_eval_duration)
+                            VALUES (?, 1, ?, ?, ?)
+                            ON CONFLICT(chat_id) DO UPDATE SET
+                                requests = requests + 1,
+                                prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                                prompt_eval_count = prompt_eval_count + excluded.prompt_eval_count,
+                                prompt_eval_duration = prompt_eval_duration + excluded.prompt_eval_duration''',
+                         (chat_id, prompt_tokens, eval_count, eval_duration))
+    
+    def get_prompt_stats(self, chat_id: int) -> Optional[Dict]:
+        with self.connection() as conn:
+            row = conn.execute('''SELECT requests, prompt_tokens, prompt_eval_count, prompt_eval_duration
+                                  FROM chat_prompt_stats WHERE chat_id = ?''', (chat_id,)).fetchone()
+        if not row:
+            return None
+        # prompt_tokens - оценка (~4 символа на токен), prompt_eval_count - сколько токенов Ollama реально
+        # вычислила; их отношение - лишь оценка доли промпта, взятой из кэша префикса
+        return {'requests': row[0], 'estimated_prompt_tokens': row[1], 'prompt_eval_count': row[2],
+                'prompt_eval_duration': row[3],
+                'estimated_reuse_ratio': max(0.0, 1 - row[2] / row[1]) if row[1] else 0.0}
+    
+    def record_model_demand(self, host: str, model: str, now: float):
+        with self.connection() as conn:
+            # Затухание и приращение одним оператором: процессы пишут спрос одновременно
+            conn.execute('''INSERT INTO model_demand (host, model, score, updated, last_used, uses)
+                            VALUES (?, ?, 1, ?, ?, 1)
+                            ON CONFLICT(host, model) DO UPDATE SET
+                                score = decay_score(score, excluded.updated - updated) + 1,
+                                updated = excluded.updated,
+                                last_used = excluded.last_used,
+                                uses = uses + 1''',
+                         (host, model, now, now))
+    
+    def get_model_demand(self) -> Dict[str, Dict[str, Dict]]:
+        with self.connection() as conn:
+            rows = conn.execute('SELECT host, model, score, updated, last_used, uses FROM model_demand').fetchall()
+        demand: Dict[str, Dict[str, Dict]] = {}
+        for host, model, score, updated, last_used, uses in rows:
+            demand.setdefault(host, {})[model] = {'score': score, 'updated': updated, 'last_used': last_used, 'uses': uses}
+        return demand
+    
+    def delete_model_demand(self, entries: List[Tuple[str, str, float]]):
+        """Удалить спрос (host, model), если с момента чтения (last_used) модель никто не запрашивал"""
+        with self.connection() as conn:
+            conn.executemany('DELETE FROM model_demand WHERE host = ? AND model = ? AND last_used = ?', entries)
+    
     def update_last_message(self, chat_id: int, new_content: str):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('''UPDATE messages SET content = ? 
-                     WHERE chat_id = ? AND id = (
-                         SELECT id FROM messages WHERE chat_id = ? ORDER BY timestamp DESC LIMIT 1
-                     )''', (new_content, chat_id, chat_id))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            self._update_last_message(conn, chat_id, new_content)
+    
+    def _update_last_message(self, conn: sqlite3.Connection, chat_id: int, new_content: str):
+        conn.execute('''UPDATE messages SET content = ? 
+                        WHERE chat_id = ? AND id = (
+                            SELECT id FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT 1
+                        )''', (new_content, chat_id, chat_id))
+    
+    def update_message(self, chat_id: int, message_id: int, new_content: str):
+        with self.connection() as conn:
+            self._update_message(conn, chat_id, message_id, new_content)
+    
+    def _update_message(self, conn: sqlite3.Connection, chat_id: int, message_id: int, new_content: str):
+        conn.execute('UPDATE messages SET content = ? WHERE chat_id = ? AND id = ?', (new_content, chat_id, message_id))
+    
+    def get_translation(self, key: str) -> Optional[str]:
+        with self.connection() as conn:
+            row = conn.execute('SELECT translation FROM translations WHERE key = ?', (key,)).fetchone()
+            if row:
+                conn.execute('UPDATE translations SET last_used = ? WHERE key = ?', (datetime.now(), key))
+        return row[0] if row else None
+    
+    def put_translation(self, key: str, translation: str):
+        with self.connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO translations (key, translation, last_used) VALUES (?, ?, ?)',
+                         (key, translation, datetime.now()))
+            self._translation_puts += 1
+            if self._translation_puts % TRANSLATION_EVICT_EVERY == 0:
+                # Вытеснение давно не использованных переводов сверх TRANSLATION_DB_MAX_ROWS
+                conn.execute('''DELETE FROM translations WHERE key IN (
+                                    SELECT key FROM translations ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                                )''', (TRANSLATION_DB_MAX_ROWS,))
+    
+    def get_fsm(self, key: str, now: float) -> Optional[Dict]:
+        with self.connection() as conn:
+            row = conn.execute('SELECT state, data FROM fsm_storage WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+                               (key, now)).fetchone()
+        return {'state': row[0], 'data': row[1]} if row else None
+    
+    def set_fsm_state(self, key: str, state: Optional[str], expires_at: Optional[float]):
+        with self.connection() as conn:
+            # Истёкшая запись не должна воскресать: её data сбрасывается вместе с обновлением
+            conn.execute('''INSERT INTO fsm_storage (key, state, expires_at) VALUES (?, ?, ?)
+                            ON CONFLICT(key) DO UPDATE SET
+                                state = excluded.state,
+                                data = CASE WHEN fsm_storage.expires_at <= ? THEN NULL ELSE fsm_storage.data END,
+                                expires_at = excluded.expires_at''',
+                         (key, state, expires_at, time.time()))
+            self._purge_fsm(conn)
+    
+    def set_fsm_data(self, key: str, data: str, expires_at: Optional[float]):
+        with self.connection() as conn:
+            conn.execute('''INSERT INTO fsm_storage (key, data, expires_at) VALUES (?, ?, ?)
+                            ON CONFLICT(key) DO UPDATE SET
+                                state = CASE WHEN fsm_storage.expires_at <= ? THEN NULL ELSE fsm_storage.state END,
+                                data = excluded.data,
+                                expires_at = excluded.expires_at''',
+                         (key, data, expires_at, time.time()))
+            self._purge_fsm(conn)
+    
+    def _purge_fsm(self, conn: sqlite3.Connection):
+        self._fsm_writes += 1
+        if self._fsm_writes % STATE_PURGE_EVERY == 0:
+            conn.execute('DELETE FROM fsm_storage WHERE expires_at <= ?', (time.time(),))
+    
+    def write_batch(self, ops: List[Tuple[str, tuple]]):
+        """Записать пачку отложенных операций одной транзакцией (group commit)"""
+        try:
+            with self.connection() as conn:
+                for name, args in ops:
+                    getattr(self, f'_{name}')(conn, *args)
+        except sqlite3.Error as e:
+            # Пачка откатилась целиком - применяем операции по одной, чтобы не потерять остальные
+            print(f"Ошибка пакетной записи: {e}")
+            for name, args in ops:
+                try:
+                    with self.connection() as conn:
+                        getattr(self, f'_{name}')(conn, *args)
+                except sqlite3.Error as e:
+                    print(f"Ошибка записи {name}{args[:1]}: {e}")
+
+class AsyncDatabase:
+    """Асинхронная обёртка над Database: запросы выполняются в пуле потоков, а не в event loop.
+    
+    add_message, update_chat_name, update_last_message и update_message не ждут записи: они копятся в буфере
+    и сбрасываются одной транзакцией раз в WRITE_BEHIND_INTERVAL_MS или по WRITE_BEHIND_MAX_OPS
+    операций. Чтения чата, у которого есть несброшенные записи, сначала дожидаются сброса.
+    """
+    def __init__(self, database: Database, max_workers: int = DB_POOL_SIZE):
+        self.db = database
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+        self._pending: List[Tuple[str, tuple]] = []
+        # chat_id -> число записей в буфере или в текущей транзакции
+        self._dirty_chats: Dict[int, int] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_timer: Optional[asyncio.Task] = None
+        self._flush_tasks: set = set()
+        self._pending_renames = 0
+        self.stats = {'buffered': 0, 'flushes': 0}
+    
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+    
+    async def get_user(self, user_id: int) -> Optional[Dict]:
+        # Попадание в кэш профилей отдаём без перехода в пул потоков
+        user = self.db.user_cache.get(user_id)
+        if user is not None:
+            return dict(user)
+        return await self.run(self.db.get_user, user_id)
+    
+    def __getattr__(self, name: str):
+        method = getattr(self.db, name)
+        if name.startswith('_') or not callable(method):
+            return method
+        
+        if name in BUFFERED_WRITES:
+            async def wrapper(*args):
+                self._enqueue(name, args)
+        else:
+            async def wrapper(*args, **kwargs):
+                if self._needs_flush(name, args):
+                    await self.flush()
+                return await self.run(method, *args, **kwargs)
+        wrapper.__name__ = name
+        return wrapper
+    
+    def _enqueue(self, name: str, args: tuple):
+        if name == 'add_message' and len(args) < 4:
+            # Время сообщения фиксируется в момент вызова, а не при сбросе
+            args = args + (datetime.now(),)
+        chat_id = args[0]
+        self._pending.append((name, args))
+        if name == 'update_chat_name':
+            self._pending_renames += 1
+        self._dirty_chats[chat_id] = self._dirty_chats.get(chat_id, 0) + 1
+        self.stats['buffered'] += 1
+        
+        if len(self._pending) >= WRITE_BEHIND_MAX_OPS:
+            task = asyncio.create_task(self.flush())
+            self._flush_tasks.add(task)
+            task.add_done_callback(self._flush_tasks.discard)
+        elif self._flush_timer is None or self._flush_timer.done():
+            self._flush_timer = asyncio.create_task(self._flush_later())
+    
+    def _needs_flush(self, name: str, args: tuple) -> bool:
+        if not self._dirty_chats:
+            return False
+        if name in CHAT_DEPENDENT_READS:
+            return bool(args) and args[0] in self._dirty_chats
+        if name in CHAT_LIST_READS:
+            return self._pending_renames > 0
+        # Остальные запросы к chats/messages (списки чатов, миграции и т.п.) видят всё
+        return name not in INDEPENDENT_CALLS
+    
+    async def _flush_later(self):
+        await asyncio.sleep(WRITE_BEHIND_INTERVAL_MS / 1000)
+        await self.flush()
+    
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, []
+            try:
+                await self.run(self.db.write_batch, batch)
+                self.stats['flushes'] += 1
+            finally:
+                self._pending_renames -= sum(1 for name, _ in batch if name == 'update_chat_name')
+                for _, args in batch:
+                    left = self._dirty_chats.get(args[0], 0) - 1
+                    if left > 0:
+                        self._dirty_chats[args[0]] = left
+                    else:
+                        self._dirty_chats.pop(args[0], None)
+    
+    async def close(self):
+        if self._flush_timer and not self._flush_timer.done():
+            self._flush_timer.cancel()
+        await self.flush()
+        self._executor.shutdown(wait=True)
+        self.db.close()
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище aiogram в SQLite: переживает перезапуск и общее для всех процессов бота.
+    
+    Записи, не обновлявшиеся дольше ttl секунд, считаются пустыми и периодически удаляются.
+    """
+    def __init__(self, database: AsyncDatabase, ttl: Optional[int] = STATE_TTL):
+        self.adb = database
+        self.ttl = ttl
+    
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ':'.join(str(part) for part in (key.bot_id, key.chat_id, key.user_id, key.thread_id,
+                                               key.business_connection_id, key.destiny))
+    
+    def _expires_at(self) -> Optional[float]:
+        return time.time() + self.ttl if self.ttl else None
+    
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        await self.adb.set_fsm_state(self._key(key), state, self._expires_at())
+    
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self.adb.get_fsm(self._key(key), time.time())
+        return row['state'] if row else None
+    
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self.adb.set_fsm_data(self._key(key), json.dumps(data), self._expires_at())
+    
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self.adb.get_fsm(self._key(key), time.time())
+        return json.loads(row['data']) if row and row['data'] else {}
+    
+    async def close(self) -> None:
+        pass
+
+def redis_storage(client, ttl: int = STATE_TTL) -> BaseStorage:
+    """RedisStorage поверх готового клиента redis.asyncio (или fakeredis.aioredis в check_storage.py)"""
+    from aiogram.fsm.storage.redis import RedisStorage, DefaultKeyBuilder
+    return RedisStorage(client, key_builder=DefaultKeyBuilder(with_destiny=True), state_ttl=ttl, data_ttl=ttl)
+
+def create_storage() -> BaseStorage:
+    if STORAGE_BACKEND == 'redis':
+        # Требует необязательный пакет redis (pip install redis)
+        from redis.asyncio import Redis
+        return redis_storage(Redis.from_url(REDIS_URL))
+    if STORAGE_BACKEND == 'memory':
+        return MemoryStorage()
+    return SQLiteStorage(adb)
 
 db = Database()
+adb = AsyncDatabase(db)
 bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+storage = create_storage()
+class OrderedDispatcher(Dispatcher):
+    """Dispatcher, который отмечает текстовые сообщения в ChatLanes в порядке поступления.
+    
+    Отметка ставится до первого await (middleware FSM, прогрев кэша), пока задачи обновлений
+    ещё идут в порядке создания; по ней text_message_handler занимает очередь чата по порядку.
+    """
+    async def feed_update(self, bot: Bot, update: types.Update, **kwargs: Any) -> Any:
+        message = update.message
+        arrival = (message.from_user.id, message.message_id) if message and message.text and message.from_user else None
+        if arrival:
+            chat_lanes.arrive(*arrival)
+        try:
+            return await super().feed_update(bot, update, **kwargs)
+        finally:
+            if arrival:
+                chat_lanes.depart(*arrival)
+
+dp = OrderedDispatcher(storage=storage)
 
-user_states: Dict[int, Dict] = {}
+def user_state_key(user_id: int) -> StorageKey:
+    # Состояние пользователя (текущий чат и т.п.) хранится рядом с FSM, но под отдельным destiny
+    return StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id, destiny='user_state')
+
+async def get_user_state(user_id: int) -> Dict:
+    return await storage.get_data(user_state_key(user_id))
+
+async def set_user_state(user_id: int, state: Dict):
+    await storage.set_data(user_state_key(user_id), state)
+
+async def update_user_state(user_id: int, **values):
+    await storage.update_data(user_state_key(user_id), values)
 
 def get_locale(user_id: int) -> str:
-    user = db.get_user(user_id)
-    if user and user['locale']:
-        return user['locale']
-    return 'ru'  # По умолчанию русский
+    # Кэш локалей заполняют warm_user_cache до обработчика и перечитывание профиля после записи
+    locale = db.locale_cache.get(user_id)
+    if locale in STRINGS:
+        return locale
+    return DEFAULT_LOCALE  # По умолчанию русский
+
+@dp.update.outer_middleware()
+async def warm_user_cache(handler, event: types.Update, data: Dict):
+    """Загружает профиль пользователя через пул потоков до обработчика, чтобы t() не блокировал цикл событий"""
+    user = data.get('event_from_user')
+    if user is not None and db.locale_cache.get(user.id) is None:
+        await adb.get_user(user.id)
+    return await handler(event, data)
 
 def t(user_id: int, key: str) -> str:
-    locale = get_locale(user_id)
-    result = LOCALES.get(locale, LOCALES['ru']).get(key, LOCALES['ru'].get(key, key))
-    return result
+    return STRINGS[get_locale(user_id)].get(key, key)
+
+# Кнопки reply-клавиатуры -> действие, для каждой локали
+MENU_BUTTONS = {
+    locale: {strings['btn_model_select']: 'select_model',
+             strings['btn_chats']: 'chat_list',
+             strings['btn_settings']: 'settings'}
+    for locale, strings in STRINGS.items()
+}
+
+# Шаблоны клавиатур: (локаль, вид) -> markup. Клавиатуры чатов собираются один раз с CHAT_ID_PLACEHOLDER
+# в callback_data и при выдаче заполняются номером чата. Объекты aiogram изменяемы (frozen=False):
+# общие клавиатуры без chat_id отдаются как есть и не должны меняться, клавиатуры чатов - всегда новые
+CHAT_ID_PLACEHOLDER = '{chat_id}'
+keyboard_templates: Dict[Tuple[str, str], Any] = {}
+
+def cached_keyboard(locale: str, kind: str, builder, chat_id: Optional[int] = None):
+    keyboard = keyboard_templates.get((locale, kind))
+    if keyboard is None:
+        keyboard = builder(STRINGS[locale]) if chat_id is None else builder(STRINGS[locale], CHAT_ID_PLACEHOLDER)
+        keyboard_templates[(locale, kind)] = keyboard
+    if chat_id is None:
+        return keyboard
+    # Поля шаблона уже проверены при сборке, поэтому копии создаются без повторной валидации
+    return InlineKeyboardMarkup.model_construct(inline_keyboard=[
+        [button.model_copy(update={'callback_data': button.callback_data.format(chat_id=chat_id)}) for button in row]
+        for row in keyboard.inline_keyboard
+    ])
 
-def get_main_keyboard(user_id: int) -> ReplyKeyboardMarkup:
-    keyboard = ReplyKeyboardMarkup(
+def build_main_keyboard(s: Dict[str, str]) -> ReplyKeyboardMarkup:
+    return ReplyKeyboardMarkup(
         keyboard=[
-            [KeyboardButton(text=t(user_id, 'btn_model_select'))],
-            [KeyboardButton(text=t(user_id, 'btn_chats'))],
-            [KeyboardButton(text=t(user_id, 'btn_settings'))]
+            [KeyboardButton(text=s['btn_model_select'])],
+            [KeyboardButton(text=s['btn_chats'])],
+            [KeyboardButton(text=s['btn_settings'])]
         ],
         resize_keyboard=True
     )
-    return keyboard
 
-async def get_ollama_models(host: str) -> List[str]:
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{host}/api/tags", timeout=aiohttp.ClientTimeout(total=10)) as resp:
+def build_main_menu_keyboard(s: Dict[str, str]) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=s['btn_model_select'], callback_data='select_model')],
+        [InlineKeyboardButton(text=s['btn_new_chat'], callback_data='new_chat')],
+        [InlineKeyboardButton(text=s['btn_chats'], callback_data='chat_list')],
+        [InlineKeyboardButton(text=s['btn_settings'], callback_data='settings')]
+    ])
+
+def build_response_keyboard(s: Dict[str, str], chat_id: Any) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text=s['btn_regenerate'], callback_data=f'regen_{chat_id}'),
+            InlineKeyboardButton(text=s['btn_modify'], callback_data=f'modify_{chat_id}')
+        ]
+    ])
+
+def build_modify_keyboard(s: Dict[str, str], chat_id: Any) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text=s['btn_shorter'], callback_data=f'mod_shorter_{chat_id}'),
+            InlineKeyboardButton(text=s['btn_longer'], callback_data=f'mod_longer_{chat_id}')
+        ],
+        [
+            InlineKeyboardButton(text=s['btn_simpler'], callback_data=f'mod_simpler_{chat_id}'),
+            InlineKeyboardButton(text=s['btn_complex'], callback_data=f'mod_complex_{chat_id}')
+        ],
+        [InlineKeyboardButton(text=s['btn_edit_response'], callback_data=f'edit_resp_{chat_id}')],
+        [InlineKeyboardButton(text=s['btn_back'], callback_data=f'cancel_modify_{chat_id}')]
+    ])
+
+def get_main_keyboard(user_id: int) -> ReplyKeyboardMarkup:
+    return cached_keyboard(get_locale(user_id), 'main', build_main_keyboard)
+
+def get_main_menu_keyboard(user_id: int) -> InlineKeyboardMarkup:
+    return cached_keyboard(get_locale(user_id), 'main_menu', build_main_menu_keyboard)
+
+def get_response_keyboard(user_id: int, chat_id: int) -> InlineKeyboardMarkup:
+    return cached_keyboard(get_locale(user_id), 'response', build_response_keyboard, chat_id)
+
+def get_modify_keyboard(user_id: int, chat_id: int) -> InlineKeyboardMarkup:
+    return cached_keyboard(get_locale(user_id), 'modify', build_modify_keyboard, chat_id)
+
+class OllamaClient:
+    """Общие aiohttp-сессии к Ollama: одна сессия с keep-alive пулом соединений на каждый хост"""
+    def __init__(self, limit_per_host: int = OLLAMA_CONN_LIMIT, keepalive_timeout: float = OLLAMA_KEEPALIVE):
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        # host -> {'requests', 'new_connections', 'reused_connections'}
+        self.stats: Dict[str, Dict[str, int]] = {}
+    
+    def _trace_config(self, host: str) -> aiohttp.TraceConfig:
+        stats = self.stats.setdefault(host, {'requests': 0, 'new_connections': 0, 'reused_connections': 0})
+        
+        async def on_request_start(session, ctx, params):
+            stats['requests'] += 1
+        
+        async def on_connection_create_end(session, ctx, params):
+            stats['new_connections'] += 1
+        
+        async def on_connection_reuseconn(session, ctx, params):
+            stats['reused_connections'] += 1
+        
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(on_request_start)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace
+    
+    def session(self, host: str) -> aiohttp.ClientSession:
+        host = host.rstrip('/')
+        session = self._sessions.get(host)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout,
+                                             ttl_dns_cache=300)
+            session = aiohttp.ClientSession(connector=connector, trace_configs=[self._trace_config(host)])
+            self._sessions[host] = session
+        return session
+    
+    def reuse_rate(self, host: Optional[str] = None) -> float:
+        """Доля запросов, обслуженных уже открытым соединением"""
+        stats = [self.stats.get(host.rstrip('/'), {})] if host else list(self.stats.values())
+        reused = sum(s.get('reused_connections', 0) for s in stats)
+        created = sum(s.get('new_connections', 0) for s in stats)
+        return reused / (reused + created) if reused + created else 0.0
+    
+    async def close(self):
+        sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            await session.close()
+
+ollama = OllamaClient()
+
+# Время до первого видимого фрагмента ответа (сумма по всем потоковым ответам)
+stream_stats = {'replies': 0, 'ttft_total': 0.0}
+
+class ModelCatalog:
+    """Кэш моделей хостов: установленные (/api/tags) и загруженные в память (/api/ps).
+    
+    Меню открываются сразу: устаревший список отдаётся немедленно, а обновляется в фоне.
+    Одновременные обновления одного хоста объединяются в один запрос.
+    """
+    def __init__(self, ttl: float = MODEL_CACHE_TTL, max_stale: float = MODEL_CACHE_MAX_STALE):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        # host -> {'models': [...], 'running': [...], 'sizes': {...}, 'vram': {...}, 'fetched_at': monotonic}
+        self._entries: Dict[str, Dict] = {}
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        self._versions: Dict[str, int] = {}
+        self.stats = {'fresh': 0, 'stale': 0, 'misses': 0, 'refreshes': 0}
+    
+    async def _fetch(self, host: str, path: str) -> Optional[List[Dict]]:
+        try:
+            session = ollama.session(host)
+            async with session.get(f"{host}{path}", timeout=aiohttp.ClientTimeout(total=10)) as resp:
                 if resp.status == 200:
                     data = await resp.json()
-                    return [model['name'] for model in data.get('models', [])]
-    except Exception as e:
-        print(f"Ошибка получения моделей: {e}")
-    return []
+                    return data.get('models', [])
+        except Exception as e:
+            print(f"Ошибка получения моделей: {e}")
+        return None
+    
+    async def _load(self, host: str) -> Optional[Dict]:
+        version = self._versions.get(host, 0)
+        models, running = await asyncio.gather(self._fetch(host, '/api/tags'), self._fetch(host, '/api/ps'))
+        self.stats['refreshes'] += 1
+        if version != self._versions.get(host, 0):
+            # Пока шёл запрос, кэш сбросили - ответ мог устареть
+            return await self.refresh(host)
+        if models is None:
+            # Хост не ответил - остаёмся на прежнем списке
+            return self._entries.get(host)
+        running = running or []
+        entry = {'models': [model['name'] for model in models],
+                 'running': [model['name'] for model in running],
+                 # Размер модели: на диске (/api/tags) и в видеопамяти для загруженных (/api/ps)
+                 'sizes': {model['name']: model.get('size', 0) for model in models},
+                 'vram': {model['name']: model.get('size_vram') or model.get('size', 0) for model in running},
+                 'fetched_at': time.monotonic()}
+        self._entries[host] = entry
+        return entry
+    
+    def refresh(self, host: str) -> asyncio.Task:
+        host = host.rstrip('/')
+        task = self._refreshing.get(host)
+        if task is None or task.done():
+            task = asyncio.create_task(self._load(host))
+            self._refreshing[host] = task
+        return task
+    
+    def invalidate(self, host: str):
+        """После pull/load/unload: следующий запрос дождётся свежего списка"""
+        host = host.rstrip('/')
+        self._versions[host] = self._versions.get(host, 0) + 1
+        self._entries.pop(host, None)
+        self._refreshing.pop(host, None)
+        self.refresh(host)
+    
+    async def _entry(self, host: str) -> Optional[Dict]:
+        host = host.rstrip('/')
+        entry = self._entries.get(host)
+        age = time.monotonic() - entry['fetched_at'] if entry else None
+        if entry and age < self.ttl:
+            self.stats['fresh'] += 1
+            return entry
+        if entry and age < self.max_stale:
+            self.stats['stale'] += 1
+            self.refresh(host)
+            return entry
+        self.stats['misses'] += 1
+        return await asyncio.shield(self.refresh(host))
+    
+    async def models(self, host: str) -> List[str]:
+        entry = await self._entry(host)
+        return entry['models'] if entry else []
+    
+    async def running(self, host: str) -> List[str]:
+        entry = await self._entry(host)
+        return entry['running'] if entry else []
+    
+    async def snapshot(self, host: str) -> Optional[Dict]:
+        return await self._entry(host)
+    
+    def peek(self, host: str) -> Optional[Dict]:
+        """Последний известный снимок хоста без обновления (для синхронного выбора хоста)"""
+        return self._entries.get(host.rstrip('/'))
+
+model_catalog = ModelCatalog()
+
+async def get_ollama_models(host: str) -> List[str]:
+    return await model_catalog.models(host)
+
+async def get_running_models(host: str) -> List[str]:
+    """Модели, загруженные сейчас в память хоста"""
+    return await model_catalog.running(host)
+
+class KeepAlivePolicy:
+    """keep_alive для запросов к модели по числу её активных чатов.
+    
+    Пока моделью пользуются несколько чатов, Ollama держит её (и KV-кэш префиксов) в памяти дольше;
+    модель без активных чатов выгружается через обычные KEEP_ALIVE_BASE секунд.
+    """
+    def __init__(self):
+        # model -> {chat_id: время последнего хода}
+        self._activity: Dict[str, Dict[int, float]] = {}
+    
+    def touch(self, model: str, chat_id: int):
+        self._activity.setdefault(model, {})[chat_id] = time.monotonic()
+    
+    def active_chats(self, model: str) -> int:
+        chats = self._activity.get(model)
+        if not chats:
+            return 0
+        horizon = time.monotonic() - ACTIVE_CHAT_WINDOW
+        for chat_id in [c for c, last in chats.items() if last < horizon]:
+            del chats[chat_id]
+        return len(chats)
+    
+    def seconds(self, model: str) -> int:
+        return min(KEEP_ALIVE_MAX, KEEP_ALIVE_BASE * max(1, self.active_chats(model)))
+
+keep_alive_policy = KeepAlivePolicy()
 
 async def check_ollama_connection(host: str) -> bool:
     """Проверка доступности Ollama сервера"""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{host}/api/tags", timeout=aiohttp.ClientTimeout(total=5)) as resp:
-                return resp.status == 200
+        session = ollama.session(host)
+        async with session.get(f"{host}/api/tags", timeout=aiohttp.ClientTimeout(total=5)) as resp:
+            return resp.status == 200
     except Exception as e:
         print(f"Ошибка подключения к {host}: {e}")
         return False
 
 async def pull_model(host: str, model_name: str, progress_callback):
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{host}/api/pull", 
-                                   json={'name': model_name}, 
-                                   timeout=aiohttp.ClientTimeout(total=None)) as resp:
-                if resp.status == 200:
-                    async for line in resp.content:
-                        if line:
-                            try:
-                                data = json.loads(line.decode('utf-8'))
-                                if 'status' in data:
-                                    completed = data.get('completed', 0)
-                    total = data.get('total', 1)
-                                    if total > 0:
-                                        progress = int((completed / total) * 100)
-                                        await progress_callback(progress, data['status'])
-                                    if data.get('status') == 'success':
-                                        return True
-                            except Exception as e:
-                                print(f"Ошибка парсинга: {e}")
-                    return True
-                else:
-                    print(f"Ошибка pull: status {resp.status}")
-                    return False
+        session = ollama.session(host)
+        async with session.post(f"{host}/api/pull", 
+                               json={'name': model_name}, 
+                               timeout=aiohttp.ClientTimeout(total=None)) as resp:
+            if resp.status == 200:
+                async for line in resp.content:
+                    if line:
+                        try:
+                            data = json.loads(line.decode('utf-8'))
+                            if 'status' in data:
+                                completed = data.get('completed', 0)
+                                total = data.get('total', 1)
+                                if total > 0:
+                                    progress = int((completed / total) * 100)
+                                    await progress_callback(progress, data['status'])
+                                if data.get('status') == 'success':
+                                    return True
+                        except Exception as e:
+                            print(f"Ошибка парсинга: {e}")
+                return True
+            else:
+                print(f"Ошибка pull: status {resp.status}")
+                return False
     except Exception as e:
         print(f"Ошибка pull_model: {e}")
         return False
 
-async def load_model(host: str, model_name: str) -> bool:
+async def load_model(host: str, model_name: str, keep_alive: Optional[int] = None) -> bool:
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{host}/api/generate", 
-                                   json={'model': model_name, 'prompt': '', 'stream': False},
-                                   timeout=aiohttp.ClientTimeout(total=60)) as resp:
-                return resp.status == 200
+        payload = {'model': model_name, 'prompt': '', 'stream': False}
+        if keep_alive is not None:
+            payload['keep_alive'] = keep_alive
+        session = ollama.session(host)
+        async with session.post(f"{host}/api/generate", 
+                               json=payload,
+                               timeout=aiohttp.ClientTimeout(total=60)) as resp:
+            return resp.status == 200
     except Exception as e:
         print(f"Ошибка load_model: {e}")
         return False
 
 async def unload_model(host: str, model_name: str) -> bool:
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{host}/api/generate",
-                                   json={'model': model_name, 'keep_alive': 0},
-                                   timeout=10) as resp:
-                return resp.status == 200
-    except:
+        session = ollama.session(host)
+        async with session.post(f"{host}/api/generate",
+                               json={'model': model_name, 'keep_alive': 0},
+                               timeout=10) as resp:
+            return resp.status == 200
+    except Exception as e:
+        print(f"Ошибка unload_model: {e}")
         return False
 
-async def chat_with_ollama(host: str, model: str, messages: List[Dict], tools: Optional[List[Dict]] = None) -> Optional[Dict]:
+async def chat_with_ollama(host: str, model: str, messages: List[Dict], tools: Optional[List[Dict]] = None,
+                           on_delta: Optional[Callable[[str], None]] = None) -> Optional[Dict]:
+    if on_delta is not None:
+        return await stream_chat_with_ollama(host, model, messages, tools, on_delta)
     try:
-        payload = {'model': model, 'messages': messages, 'stream': False}
+        payload = {'model': model, 'messages': messages, 'stream': False,
+                   'keep_alive': keep_alive_policy.seconds(model)}
         if tools:
             payload['tools'] = tools
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{host}/api/chat", 
-                                   json=payload, 
-                                   timeout=aiohttp.ClientTimeout(total=180)) as resp:
-                if resp.status == 200:
-                    return await resp.json()
-                else:
-                    print(f"Ошибка chat: status {resp.status}")
+        session = ollama.session(host)
+        async with session.post(f"{host}/api/chat", 
+                               json=payload, 
+                               timeout=aiohttp.ClientTimeout(total=180)) as resp:
+            if resp.status == 200:
+                return await resp.json()
+            else:
+                print(f"Ошибка chat: status {resp.status}")
     except Exception as e:
         print(f"Ошибка chat_with_ollama: {e}")
     return None
 
-async def translate_text(host: str, translator_model: str, text: str, target_lang: str) -> str:
-    if not translator_model:
-        return text
-    
-    system_prompt = '''You are a professional translator. Input is a JSON object where the key is the target language code and the value is the source text. Translate the text accurately, preserving meaning and nuances, following the target language's grammar and cultural norms. Output ONLY the translated text, with no explanations, comments, or formatting.'''
-    
-    json_input = json.dumps({target_lang: text})
-    messages = [
-        {'role': 'system', 'content': system_prompt},
-        {'role': 'user', 'content': json_input}
-    ]
-    
-    response = await chat_with_ollama(host, translator_model, messages)
-    if response and 'message' in response:
-        return response['message']['content'].strip()
-    return text
-
-TOOLS = [
-    {
-        'type': 'function',
-        'function': {
-            'name': 'rename_chat',
-            'description': 'Rename the current chat to better reflect its content',
-            'parameters': {
-                'type': 'object',
-                'properties': {
-                    'new_name': {
-                        'type': 'string',
-                        'description': 'The new name for the chat'
-                    }
-                },
-                'required': ['new_name']
-            }
-        }
-    },
-    {
-        'type': 'function',
-        'function': {
-            'name': 'calculator',
-            'description': 'Perform mathematical calculations',
-            'parameters': {
-                'type': 'object',
-                'properties': {
-                    'expression': {
-                        'type': 'string',
-                        'description': 'Mathematical expression to evaluate'
-                    }
-                },
-                'required': ['expression']
-            }
-        }
-    }
-]
+async def stream_chat_with_ollama(host: str, model: str, messages: List[Dict], tools: Optional[List[Dict]],
+                                  on_delta: Callable[[str], None]) -> Optional[Dict]:
+    """Потоковый /api/chat: каждый фрагмент текста сразу отдаётся в on_delta, результат - как у chat_with_ollama"""
+    try:
+        payload = {'model': model, 'messages': messages, 'stream': True,
+                   'keep_alive': keep_alive_policy.seconds(model)}
+        if tools:
+            payload['tools'] = tools
+        
+        session = ollama.session(host)
+        async with session.post(f"{host}/api/chat",
+                               json=payload,
+                               timeout=aiohttp.ClientTimeout(total=None, sock_read=180)) as resp:
+            if resp.status != 200:
+                print(f"Ошибка chat: status {resp.status}")
+                return None
+            
+            parts = []
+            tool_calls = []
+            result = {}
+            try:
+                async for line in resp.content:
+                    if not line.strip():
+                        continue
+                    chunk = json.loads(line.decode('utf-8'))
+                    if 'error' in chunk:
+                        print(f"Ошибка chat: {chunk['error']}")
+                        return None
+                    delta = chunk.get('message', {})
+                    if delta.get('content'):
+                        parts.append(delta['content'])
+                        on_delta(delta['content'])
+                    if delta.get('tool_calls'):
+                        tool_calls.extend(delta['tool_calls'])
+                    if chunk.get('done'):
+                        result = chunk
+                        break
+            except asyncio.CancelledError:
+                # Разрываем соединение, чтобы Ollama перестала генерировать отменённый ответ
+                resp.close()
+                raise
+            
+            result['message'] = {'role': 'assistant', 'content': ''.join(parts)}
+            if tool_calls:
+                result['message']['tool_calls'] = tool_calls
+            return result
+    except Exception as e:
+        print(f"Ошибка stream_chat_with_ollama: {e}")
+    return None
 
-def execute_tool(tool_name: str, arguments: Dict) -> str:
-    if tool_name == 'calculator':
+class StreamingMessage:
+    """Показывает ответ по мере генерации, редактируя одно сообщение не чаще раза в STREAM_EDIT_INTERVAL секунд"""
+    def __init__(self, target: types.Message, sent: Optional[types.Message] = None,
+                 interval: float = STREAM_EDIT_INTERVAL):
+        self.target = target
+        self.sent = sent
+        self.interval = interval
+        self.text = ''
+        self._shown = ''
+        self._next_edit = 0.0
+        self._task: Optional[asyncio.Task] = None
+        # Отправка/редактирование, уже ушедшее в Telegram: его нельзя отменять, только дождаться
+        self._inflight: Optional[asyncio.Task] = None
+        self._started = time.monotonic()
+        self.ttft: Optional[float] = None
+    
+    def feed(self, delta: str):
+        self.text += delta
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+    
+    async def _flush(self):
+        delay = self._next_edit - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        text = self.text[:STREAM_PREVIEW_LIMIT]
+        if not text.strip() or text == self._shown:
+            return
+        self._inflight = asyncio.create_task(self._show(text.rstrip() + ' ▌'))
+        await asyncio.shield(self._inflight)
+        self._shown = text
+    
+    async def _show(self, text: str, reply_markup=None) -> bool:
+        """False - Telegram попросил подождать, текст не показан"""
         try:
-            result = eval(arguments['expression'], {"__builtins__": {}}, {})
-            return str(result)
-        except:
-            return "Ошибка вычисления"
-    return ""
-
-@dp.message(CommandStart())
-async def start_handler(message: types.Message, state: FSMContext):
-    user = db.get_user(message.from_user.id)
-    
-    if not user or not user['host']:
-        await message.answer(t(message.from_user.id, 'welcome'))
-        await state.set_state(States.waiting_host)
-    else:
-        await show_main_menu(message)
-
-@dp.message(States.waiting_host)
-async def host_input_handler(message: types.Message, state: FSMContext):
-    host = message.text.strip()
-    
-    if not re.match(r'^https?://[\w\.\-]+:\d+
-
-async def show_main_menu(message: types.Message):
-    user = db.get_user(message.from_user.id)
-    selected_model = user['selected_model'] if user and user['selected_model'] else t(message.from_user.id, 'no_model')
-    
-    text = f"{t(message.from_user.id, 'main_menu')}\n{t(message.from_user.id, 'selected_model')}: {selected_model}"
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=t(message.from_user.id, 'btn_model_select'), callback_data='select_model')],
-        [InlineKeyboardButton(text=t(message.from_user.id, 'btn_new_chat'), callback_data='new_chat')],
-        [InlineKeyboardButton(text=t(message.from_user.id, 'btn_chats'), callback_data='chat_list')],
-        [InlineKeyboardButton(text=t(message.from_user.id, 'btn_settings'), callback_data='settings')]
-    ])
-    
-    await message.answer(text, reply_markup=keyboard)
-
-@dp.callback_query(F.data == 'select_model')
-async def select_model_handler(callback: types.CallbackQuery):
-    user = db.get_user(callback.from_user.id)
-    models = await get_ollama_models(user['host'])
-    
-    keyboard = []
-    for model in models:
-        check = '✓ ' if model == user['selected_model'] else ''
-        keyboard.append([InlineKeyboardButton(text=f"{check}{model}", callback_data=f"model_{model}")])
-    
-    keyboard.append([InlineKeyboardButton(text=t(callback.from_user.id, 'btn_add_model'), callback_data='add_model')])
-    keyboard.append([InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data='back_main')])
-    
-    await callback.message.edit_text(
-        t(callback.from_user.id, 'model_selection'),
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
-    )
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith('model_'))
-async def model_select_handler(callback: types.CallbackQuery):
-    model_name = callback.data.replace('model_', '')
-    user = db.get_user(callback.from_user.id)
-    
-    loading_msg = await callback.message.answer(t(callback.from_user.id, 'loading_model'))
-    
-    success = await load_model(user['host'], model_name)
-    await loading_msg.delete()
-    
-    if success:
-        db.update_user(callback.from_user.id, selected_model=model_name)
-        await callback.answer(t(callback.from_user.id, 'model_loaded'))
-        
-        if callback.from_user.id in user_states and user_states[callback.from_user.id].get('return_to_new_chat'):
-            user_states[callback.from_user.id]['return_to_new_chat'] = False
-            await create_new_chat(callback.message, callback.from_user.id)
+            if self.sent is None:
+                self.sent = await self.target.answer(text, reply_markup=reply_markup)
+            else:
+                await self.sent.edit_text(text, reply_markup=reply_markup)
+            if self.ttft is None:
+                self.ttft = time.monotonic() - self._started
+                stream_stats['replies'] += 1
+                stream_stats['ttft_total'] += self.ttft
+            self._next_edit = time.monotonic() + self.interval
+        except TelegramRetryAfter as e:
+            self._next_edit = time.monotonic() + e.retry_after
+            return False
+        except TelegramBadRequest as e:
+            print(f"Ошибка обновления сообщения: {e}")
+        return True
+    
+    async def finish(self, text: str, reply_markup=None):
+        """Показать окончательный ответ; не влезающее в одно сообщение уходит следующими сообщениями"""
+        if self._task and not self._task.done():
+            self._task.cancel()
+        if self._inflight is not None and not self._inflight.done():
+            # Иначе первое сообщение ещё не создано, и ответ ушёл бы вторым сообщением
+            await asyncio.wait([self._inflight])
+        parts = split_message(text)
+        for attempt in range(3):
+            delay = self._next_edit - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # Окончательный текст нельзя потерять из-за ограничения частоты: повторяем после паузы
+            if await self._show(parts[0], reply_markup if len(parts) == 1 else None):
+                break
+        for index, part in enumerate(parts[1:], 2):
+            try:
+                await self.target.answer(part, reply_markup=reply_markup if index == len(parts) else None)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                await self.target.answer(part, reply_markup=reply_markup if index == len(parts) else None)
+            except TelegramBadRequest as e:
+                print(f"Ошибка отправки продолжения ответа: {e}")
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Делит текст на части не длиннее limit, по возможности по строкам, иначе по пробелам"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(' ', 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    parts.append(text)
+    return parts
+
+class HostScheduler:
+    """Ограничение числа одновременных запросов к хосту с честной очередью по пользователям.
+    
+    Свободный слот отдаётся пользователям по кругу: один активный пользователь с десятком сообщений
+    не задерживает остальных больше чем на один запрос. Ожидающим сообщается их место в очереди.
+    """
+    def __init__(self, limit: int = HOST_CONCURRENCY):
+        self.limit = limit
+        # host -> {'active': int, 'queues': OrderedDict[user_id, deque[waiter]]}
+        self._hosts: Dict[str, Dict] = {}
+        self._notify_tasks: set = set()
+    
+    def _state(self, host: str) -> Dict:
+        return self._hosts.setdefault(host.rstrip('/'), {'active': 0, 'queues': OrderedDict()})
+    
+    def queued(self, host: str) -> int:
+        return sum(len(waiters) for waiters in self._state(host)['queues'].values())
+    
+    @asynccontextmanager
+    async def slot(self, host: str, user_id: int = 0,
+                   on_queue: Optional[Callable[[int], Awaitable[None]]] = None):
+        state = self._state(host)
+        if state['active'] < self.limit and not state['queues']:
+            state['active'] += 1
         else:
-            await select_model_handler(callback)
-    else:
-        await callback.answer(t(callback.from_user.id, 'model_load_error'), show_alert=True)
-
-@dp.callback_query(F.data == 'add_model')
-async def add_model_handler(callback: types.CallbackQuery, state: FSMContext):
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data='select_model')]
-    ])
-    await callback.message.edit_text(t(callback.from_user.id, 'enter_model_name'), reply_markup=keyboard)
-    await state.set_state(States.waiting_model_name)
-    await callback.answer()
+            waiter = {'future': asyncio.get_running_loop().create_future(), 'on_queue': on_queue, 'position': None}
+            state['queues'].setdefault(user_id, deque()).append(waiter)
+            self._notify(state)
+            try:
+                # Слот передаётся при освобождении: active уже увеличен за нас
+                await waiter['future']
+            except asyncio.CancelledError:
+                if waiter['future'].done() and not waiter['future'].cancelled():
+                    self._release(state)
+                else:
+                    self._discard(state, user_id, waiter)
+                raise
+            finally:
+                self._report(waiter, 0)
+        try:
+            yield
+        finally:
+            self._release(state)
+    
+    def _discard(self, state: Dict, user_id: int, waiter: Dict):
+        waiters = state['queues'].get(user_id)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del state['queues'][user_id]
+        self._notify(state)
+    
+    def _release(self, state: Dict):
+        state['active'] -= 1
+        while state['queues'] and state['active'] < self.limit:
+            user_id, waiters = next(iter(state['queues'].items()))
+            waiter = waiters.popleft()
+            if waiters:
+                state['queues'].move_to_end(user_id)
+            else:
+                del state['queues'][user_id]
+            if waiter['future'].done():
+                continue
+            state['active'] += 1
+            waiter['future'].set_result(None)
+        self._notify(state)
+    
+    def _notify(self, state: Dict):
+        # Порядок обслуживания: по одному запросу от каждого пользователя по кругу
+        queues = [list(waiters) for waiters in state['queues'].values()]
+        position = 0
+        for depth in range(max((len(q) for q in queues), default=0)):
+            for waiters in queues:
+                if depth < len(waiters):
+                    position += 1
+                    self._report(waiters[depth], position)
+    
+    def _report(self, waiter: Dict, position: int):
+        if waiter['position'] == position:
+            return
+        waiter['position'] = position
+        if waiter['on_queue'] is not None:
+            task = asyncio.create_task(waiter['on_queue'](position))
+            self._notify_tasks.add(task)
+            task.add_done_callback(self._notify_tasks.discard)
+
+class QueueNotice:
+    """Сообщение о месте в очереди: создаётся при ожидании, обновляется и удаляется при получении слота.
+    
+    Как и StreamingMessage, правится не чаще раза в QUEUE_NOTICE_INTERVAL секунд и показывает последнее
+    место: при N ожидающих освобождение слота не превращается в N правок подряд.
+    """
+    def __init__(self, target: types.Message, user_id: int, interval: float = QUEUE_NOTICE_INTERVAL):
+        self.target = target
+        self.user_id = user_id
+        self.interval = interval
+        self.sent: Optional[types.Message] = None
+        self.position = 0
+        self._shown = 0
+        self._next_edit = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+    
+    async def update(self, position: int):
+        self.position = position
+        if position:
+            if self._task is None or self._task.done():
+                self._task = asyncio.create_task(self._flush())
+            return
+        # Слот получен: отложенная правка сама увидит position == 0, ждём только уже идущую отправку
+        async with self._lock:
+            if self.sent is not None:
+                try:
+                    await self.sent.delete()
+                except (TelegramBadRequest, TelegramRetryAfter) as e:
+                    print(f"Ошибка сообщения об очереди: {e}")
+                self.sent = None
+    
+    async def _flush(self):
+        while True:
+            delay = self._next_edit - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with self._lock:
+                position = self.position
+                if not position or (self.sent is not None and position == self._shown):
+                    return
+                text = t(self.user_id, 'queue_position').format(position=position)
+                try:
+                    if self.sent is None:
+                        self.sent = await self.target.answer(text)
+                    else:
+                        await self.sent.edit_text(text)
+                    self._shown = position
+                    self._next_edit = time.monotonic() + self.interval
+                except TelegramRetryAfter as e:
+                    self._next_edit = time.monotonic() + e.retry_after
+                except TelegramBadRequest as e:
+                    print(f"Ошибка сообщения об очереди: {e}")
+                    return
+
+scheduler = HostScheduler()
+
+class GenerationSuperseded(Exception):
+    """Генерация прервана более новым сообщением в том же чате"""
+
+class ChatLanes:
+    """Очередь ходов по чату: сообщения одного чата обрабатываются строго по одному и по порядку.
+    
+    При supersede новый ход отменяет идущую генерацию предыдущего (вместе с HTTP-потоком к Ollama),
+    а ход, за которым уже ждёт более новый, не начинает генерацию вовсе.
+    
+    Чат сообщения известен только после чтения состояния пользователя, поэтому порядок до очереди
+    держат отметки поступления: сообщение пользователя ждёт, пока его более ранние сообщения займут
+    свой ход (или завершатся), и только потом читает текущий чат.
+    """
+    def __init__(self, supersede: bool = SUPERSEDE_GENERATIONS):
+        self.supersede = supersede
+        # chat_id -> {'lock', 'ticket': номер последнего хода, 'users', 'generation': Task,
+        #             'superseded': генерация, отменённая более новым ходом}
+        self._lanes: Dict[int, Dict] = {}
+        # user_id -> {message_id: Event, выставляется, когда сообщение заняло ход или завершилось}
+        self._arrivals: Dict[int, Dict[int, asyncio.Event]] = {}
+        self.stats = {'turns': 0, 'superseded': 0}
+    
+    def arrive(self, user_id: int, message_id: int):
+        self._arrivals.setdefault(user_id, {})[message_id] = asyncio.Event()
+    
+    def depart(self, user_id: int, message_id: int):
+        arrivals = self._arrivals.get(user_id)
+        if arrivals is None or message_id not in arrivals:
+            return
+        arrivals.pop(message_id).set()
+        if not arrivals:
+            del self._arrivals[user_id]
+    
+    async def wait_arrival(self, user_id: int, message_id: int):
+        """Ждёт, пока более ранние сообщения пользователя займут ход или завершатся"""
+        for earlier, arrived in list(self._arrivals.get(user_id, {}).items()):
+            if earlier < message_id:
+                await arrived.wait()
+    
+    @asynccontextmanager
+    async def turn(self, chat_id: int, arrival: Optional[Tuple[int, int]] = None):
+        lane = self._lanes.setdefault(chat_id, {'lock': asyncio.Lock(), 'ticket': 0, 'users': 0,
+                                                'generation': None, 'superseded': None})
+        lane['ticket'] += 1
+        lane['users'] += 1
+        ticket = lane['ticket']
+        self.stats['turns'] += 1
+        if self.supersede and lane['generation'] is not None:
+            lane['superseded'] = lane['generation']
+            lane['generation'].cancel()
+        if arrival:
+            # Номер хода получен: следующее сообщение пользователя может занимать свой
+            self.depart(*arrival)
+        try:
+            async with lane['lock']:
+                yield ticket
+        finally:
+            lane['users'] -= 1
+            if not lane['users']:
+                del self._lanes[chat_id]
+    
+    async def run(self, chat_id: int, ticket: int, coro: Awaitable):
+        """Выполняет генерацию хода; GenerationSuperseded, если её вытеснил более новый ход"""
+        lane = self._lanes[chat_id]
+        if self.supersede and ticket != lane['ticket']:
+            coro.close()
+            self.stats['superseded'] += 1
+            raise GenerationSuperseded()
+        task = asyncio.ensure_future(coro)
+        lane['generation'] = task
+        try:
+            return await task
+        except asyncio.CancelledError:
+            # Генерацию отменил более новый ход, а не отмена самого обработчика
+            if lane['superseded'] is task:
+                self.stats['superseded'] += 1
+                raise GenerationSuperseded() from None
+            raise
+        finally:
+            lane['generation'] = None
+            lane['superseded'] = None
+
+chat_lanes = ChatLanes()
+
+class HostPool:
+    """Балансировка запросов к нескольким Ollama-хостам пользователя.
+    
+    Выбирается здоровый хост с нужной моделью: сначала те, где она уже загружена в память (/api/ps)
+    и есть свободный слот, затем остальные - с наименьшим числом запросов в работе, при равенстве -
+    с меньшей задержкой health check. Фоновая проверка раз в HOST_HEALTH_INTERVAL секунд обновляет
+    доступность и список моделей; упавший хост исключается до следующей успешной проверки.
+    """
+    def __init__(self, interval: float = HOST_HEALTH_INTERVAL):
+        self.interval = interval
+        # host -> {'healthy', 'outstanding', 'latency', 'models'}
+        self.hosts: Dict[str, Dict] = {}
+        self._task: Optional[asyncio.Task] = None
+    
+    def state(self, host: str) -> Dict:
+        host = host.rstrip('/')
+        if host not in self.hosts:
+            self.hosts[host] = {'healthy': True, 'outstanding': 0, 'latency': None, 'models': None}
+        return self.hosts[host]
+    
+    def candidates(self, hosts: List[str], model: str) -> List[str]:
+        ranked = []
+        for index, host in enumerate(dict.fromkeys(h.rstrip('/') for h in hosts if h)):
+            state = self.state(host)
+            if not state['healthy']:
+                continue
+            if state['models'] is not None and model not in state['models']:
+                continue
+            # Холодный хост сначала загружает модель - это секунды; загруженный, но занятый хост
+            # конкурирует с холодными на общих основаниях
+            entry = model_catalog.peek(host)
+            warm = entry is not None and model in entry['running'] and state['outstanding'] < HOST_CONCURRENCY
+            ranked.append((not warm, state['outstanding'], state['latency'] or 0.0, index, host))
+        return [host for *_, host in sorted(ranked)]
+    
+    async def check(self, host: str):
+        state = self.state(host)
+        started = time.monotonic()
+        healthy = await check_ollama_connection(host)
+        if healthy:
+            latency = time.monotonic() - started
+            state['latency'] = latency if state['latency'] is None else 0.7 * state['latency'] + 0.3 * latency
+            # Заодно держим кэш моделей хоста тёплым
+            entry = await model_catalog.refresh(host)
+            if entry:
+                state['models'] = set(entry['models'])
+        if healthy != state['healthy']:
+            print(f"{'✅' if healthy else '❌'} Хост {host} {'снова доступен' if healthy else 'недоступен'}")
+        state['healthy'] = healthy
+    
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*(self.check(host) for host in list(self.hosts)), return_exceptions=True)
+            await asyncio.sleep(self.interval)
+    
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._health_loop())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+    
+    async def chat(self, hosts: List[str], model: str, messages: List[Dict], tools: Optional[List[Dict]] = None,
+                   on_delta: Optional[Callable[[str], None]] = None, user_id: int = 0,
+                   on_queue: Optional[Callable[[int], Awaitable[None]]] = None) -> Optional[Dict]:
+        """chat_with_ollama с выбором хоста, очередью HostScheduler и переключением на следующий хост при отказе"""
+        candidates = self.candidates(hosts, model) or [hosts[0]]
+        streamed = False
+        
+        def track_delta(delta: str):
+            nonlocal streamed
+            streamed = True
+            on_delta(delta)
+        
+        for host in candidates:
+            state = self.state(host)
+            state['outstanding'] += 1
+            residency.record(host, model)
+            try:
+                async with scheduler.slot(host, user_id, on_queue):
+                    response = await chat_with_ollama(host, model, messages, tools,
+                                                      on_delta=track_delta if on_delta else None)
+            finally:
+                state['outstanding'] -= 1
+            if response is not None:
+                return response
+            # Часть ответа уже показана пользователю - повтор на другом хосте её бы продублировал
+            if streamed:
+                return None
+            if not await check_ollama_connection(host):
+                state['healthy'] = False
+                print(f"❌ Хост {host} недоступен, переключаемся на следующий")
+        return None
 
-@dp.message(States.waiting_model_name)
-async def model_name_input_handler(message: types.Message, state: FSMContext):
-    model_name = message.text.strip()
-    user = db.get_user(message.from_user.id)
-    
-    progress_msg = await message.answer(t(message.from_user.id, 'downloading_model') + "\n▱▱▱▱▱▱▱▱▱▱ 0%")
-    
-    async def update_progress(percent: int, status: str):
-        filled = int(percent / 10)
-        bar = '▰' * filled + '▱' * (10 - filled)
-        await progress_msg.edit_text(f"{status}\n{bar} {percent}%")
-    
-    success = await pull_model(user['host'], model_name, update_progress)
-    
-    if success:
-        await progress_msg.delete()
-        await message.answer(t(message.from_user.id, 'model_downloaded'))
-        await state.clear()
-        fake_callback = types.CallbackQuery(
-            id='fake', from_user=message.from_user, message=message,
-            chat_instance='', data='select_model'
-        )
-        await select_model_handler(fake_callback)
-    else:
-        await progress_msg.edit_text(t(message.from_user.id, 'model_not_found'))
-        await state.clear()
+class ResidencyManager:
+    """Решает, какие модели держать загруженными на каждом хосте.
+    
+    Спрос на модели копится по всем пользователям и всем процессам в таблице model_demand (затухающий
+    счётчик для LFU, время последнего запроса для LRU). Планирует только один процесс - тот, что вызвал
+    start(): раз в RESIDENCY_INTERVAL, а также при выборе модели, самые востребованные модели,
+    влезающие в бюджет хоста, подгружаются заранее, а ради них выгружаются простаивающие.
+    Что загружено сейчас - берётся из /api/ps.
+    """
+    def __init__(self, interval: float = RESIDENCY_INTERVAL):
+        self.interval = interval
+        # Снимок model_demand: host -> model -> {'score': float, 'updated': time, 'last_used': time, 'uses': int}
+        self.demand: Dict[str, Dict[str, Dict]] = {}
+        self.planner = False
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._tasks: set = set()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {'preloads': 0, 'evictions': 0, 'failed': 0}
+    
+    def _decayed(self, item: Dict, now: float) -> float:
+        return decay_score(item['score'], now - item['updated'])
+    
+    def _remember(self, host: str, model: str) -> float:
+        """Учесть запрос в локальном снимке; возвращает его время для записи в общую таблицу"""
+        now = time.time()
+        item = self.demand.setdefault(host, {}).setdefault(
+            model, {'score': 0.0, 'updated': now, 'last_used': now, 'uses': 0})
+        item['score'] = self._decayed(item, now) + 1
+        item['updated'] = item['last_used'] = now
+        item['uses'] += 1
+        return now
+    
+    def record(self, host: str, model: str):
+        host = host.rstrip('/')
+        self._spawn(self._store(host, model, self._remember(host, model)))
+    
+    async def _store(self, host: str, model: str, now: float):
+        try:
+            await adb.record_model_demand(host, model, now)
+        except sqlite3.Error as e:
+            print(f"Ошибка записи спроса на модель {model}: {e}")
+    
+    def _spawn(self, coro: Awaitable):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def load(self):
+        """Обновить снимок спроса из общей таблицы"""
+        self.demand = await adb.get_model_demand()
+    
+    def _current(self, item: Dict, now: float) -> bool:
+        return (now - item['last_used'] <= RESIDENCY_DEMAND_WINDOW
+                or self._decayed(item, now) >= RESIDENCY_MIN_SCORE)
+    
+    async def prune(self, host: str):
+        """Забыть устаревший спрос, чтобы давно не нужные модели не подгружались снова и снова"""
+        now = time.time()
+        demand = self.demand.get(host, {})
+        stale = [(host, m, item['last_used']) for m, item in demand.items() if not self._current(item, now)]
+        for _, model, _ in stale:
+            del demand[model]
+        if not demand:
+            self.demand.pop(host, None)
+        if stale:
+            await adb.delete_model_demand(stale)
+    
+    def rank(self, host: str, model: str) -> float:
+        item = self.demand.get(host.rstrip('/'), {}).get(model)
+        if item is None:
+            return float('-inf')
+        if RESIDENCY_POLICY == 'lru':
+            return item['last_used']
+        return self._decayed(item, time.time())
+    
+    def _idle(self, host: str, model: str) -> bool:
+        # Общий спрос видит запросы всех процессов; активные чаты - лишь дополнительная защита этого процесса
+        item = self.demand.get(host, {}).get(model)
+        idle = item is None or time.time() - item['last_used'] > RESIDENCY_IDLE
+        return idle and keep_alive_policy.active_chats(model) == 0
+    
+    def request(self, host: str, model: str):
+        """Пользователь выбрал модель: учесть спрос и, в планирующем процессе, подгрузить её в фоне.
+        
+        В остальных процессах модель подгрузит планировщик на следующем проходе.
+        """
+        if not self.planner:
+            self.record(host, model)
+            return
+        host = host.rstrip('/')
+        self._spawn(self._record_and_plan(host, model, self._remember(host, model)))
+    
+    async def _record_and_plan(self, host: str, model: str, now: float):
+        # plan() перечитывает снимок из model_demand: без записи этого запроса модель в нём не найдётся
+        await self._store(host, model, now)
+        await self.plan(host)
+    
+    async def plan(self, host: str):
+        async with self._locks.setdefault(host, asyncio.Lock()):
+            await self.load()
+            await self.prune(host)
+            if host not in self.demand:
+                return
+            entry = await model_catalog.refresh(host)
+            if not entry:
+                return
+            installed = set(entry['models'])
+            resident = list(entry['running'])
+            vram = dict(entry['vram'])
+            
+            def size(model: str) -> int:
+                return vram.get(model) or entry['sizes'].get(model, 0)
+            
+            def fits(extra: Optional[str] = None) -> bool:
+                models = resident + ([extra] if extra else [])
+                if len(models) > RESIDENCY_MAX_MODELS:
+                    return False
+                return RESIDENCY_VRAM_BUDGET is None or sum(size(m) for m in models) <= RESIDENCY_VRAM_BUDGET
+            
+            # Желаемый набор: самые востребованные из недавно запрошенных установленных моделей в пределах бюджета
+            wanted = []
+            for model in sorted((m for m in self.demand.get(host, {}) if m in installed),
+                                key=lambda m: self.rank(host, m), reverse=True):
+                if len(wanted) >= RESIDENCY_MAX_MODELS:
+                    break
+                if RESIDENCY_VRAM_BUDGET is None or sum(size(m) for m in wanted + [model]) <= RESIDENCY_VRAM_BUDGET:
+                    wanted.append(model)
+            
+            changed = False
+            for model in wanted:
+                if model in resident:
+                    continue
+                # Освобождаем место, вытесняя наименее востребованные простаивающие модели
+                while not fits(model):
+                    victims = [m for m in resident if m not in wanted and self._idle(host, m)]
+                    if not victims:
+                        break
+                    victim = min(victims, key=lambda m: self.rank(host, m))
+                    if not await unload_model(host, victim):
+                        self.stats['failed'] += 1
+                        break
+                    resident.remove(victim)
+                    self.stats['evictions'] += 1
+                    changed = True
+                if not fits(model):
+                    continue
+                if await load_model(host, model, keep_alive=keep_alive_policy.seconds(model)):
+                    resident.append(model)
+                    self.stats['preloads'] += 1
+                    changed = True
+                else:
+                    self.stats['failed'] += 1
+            if changed:
+                model_catalog.invalidate(host)
+    
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.load()
+            except sqlite3.Error as e:
+                print(f"Ошибка чтения спроса на модели: {e}")
+                continue
+            for host in list(self.demand):
+                try:
+                    await self.plan(host)
+                except Exception as e:
+                    print(f"Ошибка управления моделями на {host}: {e}")
+    
+    def start(self):
+        """Сделать этот процесс планировщиком; вызывается ровно в одном процессе"""
+        self.planner = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        for task in list(self._tasks):
+            task.cancel()
+
+residency = ResidencyManager()
+
+host_pool = HostPool()
+
+async def generate_reply(chat: Dict, hosts: List[str], messages: List[Dict], tools: Optional[List[Dict]] = None,
+                         **kwargs) -> Optional[Dict]:
+    """host_pool.chat для хода чата: отмечает активность модели и копит статистику prompt eval"""
+    keep_alive_policy.touch(chat['model'], chat['id'])
+    response = await host_pool.chat(hosts, chat['model'], messages, tools, **kwargs)
+    if response and 'prompt_eval_count' in response:
+        try:
+            await adb.record_prompt_eval(chat['id'], sum(estimate_tokens(m.get('content')) for m in messages),
+                                         response['prompt_eval_count'], response.get('prompt_eval_duration', 0))
+        except sqlite3.Error as e:
+            # Чат могли удалить, пока шла генерация
+            print(f"Ошибка записи статистики промпта: {e}")
+    return response
+
+async def get_user_host_urls(user: Dict) -> List[str]:
+    """Активный хост пользователя и остальные его сохранённые хосты"""
+    hosts = await adb.get_user_hosts(user['user_id'])
+    return [user['host']] + [h['host_url'] for h in hosts if h['host_url'] != user['host']]
+
+# Частые служебные слова латинских языков для detect_language
+# Служебные слова латинских языков. Однобуквенных слов и слов, общих с английским (a, o, e, as, do, was...),
+# здесь нет: английский текст иначе легко набирает очки другого языка
+LATIN_STOPWORDS = {
+    'en': {'the', 'and', 'is', 'are', 'was', 'were', 'of', 'to', 'in', 'it', 'you', 'that', 'this', 'for',
+           'with', 'what', 'how', 'have', 'has', 'not', 'be', 'can', 'do', 'my', 'on', 'which', 'from', 'an',
+           'by', 'at', 'as'},
+    'es': {'el', 'la', 'los', 'las', 'de', 'que', 'es', 'en', 'un', 'una', 'por', 'para', 'con', 'no',
+           'como', 'qué', 'está', 'pero', 'del', 'se', 'lo', 'mi', 'yo', 'muy', 'también', 'esto'},
+    'fr': {'le', 'la', 'les', 'de', 'des', 'et', 'est', 'un', 'une', 'que', 'qui', 'pour', 'dans', 'pas',
+           'je', 'vous', 'il', 'ce', 'du', 'au', 'avec', 'sur', 'mais', 'comment'},
+    'de': {'der', 'die', 'das', 'und', 'ist', 'nicht', 'ich', 'sie', 'es', 'ein', 'eine', 'zu', 'den', 'mit',
+           'von', 'auf', 'für', 'wie', 'auch', 'sich', 'dem', 'du', 'bitte', 'aber', 'oder'},
+    'it': {'il', 'lo', 'la', 'gli', 'le', 'di', 'che', 'è', 'un', 'una', 'per', 'non', 'con', 'sono',
+           'del', 'della', 'mi', 'io', 'ma', 'questo', 'cosa', 'anche', 'perché', 'molto', 'sei'},
+    'pt': {'os', 'de', 'que', 'é', 'um', 'uma', 'para', 'com', 'não', 'da', 'dos', 'das', 'em',
+           'no', 'na', 'eu', 'você', 'como', 'mas', 'isso', 'está', 'são', 'também', 'muito', 'ele', 'ela'},
+}
+# Язык признаётся, только если набрал не меньше LANG_DETECT_MIN_SCORE и опережает каждый другой
+# латинский язык и на LANG_DETECT_MARGIN очков, и вдвое: ошибка здесь пропускает нужный перевод
+LANG_DETECT_MIN_SCORE = 3
+LANG_DETECT_MARGIN = 2
+# Буквы, характерные только для одного языка
+LATIN_MARKERS = {'es': 'ñ¿¡', 'fr': 'çœêèëîû', 'de': 'ßäöü', 'pt': 'ãõ', 'it': 'ìò'}
+WORD_RE = re.compile(r"[^\W\d_]+", re.UNICODE)
+
+def detect_language(text: str) -> Optional[str]:
+    """Определение языка по письменности и служебным словам, без сети. None - если не уверены"""
+    counts = {'latin': 0, 'cyrillic': 0, 'kana': 0, 'hangul': 0, 'han': 0}
+    for ch in text:
+        code = ord(ch)
+        if code < 0x250:
+            if ch.isalpha():
+                counts['latin'] += 1
+        elif 0x400 <= code < 0x530:
+            counts['cyrillic'] += 1
+        elif 0x3040 <= code < 0x3100:
+            counts['kana'] += 1
+        elif 0xAC00 <= code < 0xD7B0 or 0x1100 <= code < 0x1200:
+            counts['hangul'] += 1
+        elif 0x4E00 <= code < 0xA000:
+            counts['han'] += 1
+    total = sum(counts.values())
+    if total < LANG_DETECT_MIN_LETTERS:
+        return None
+    script = max(counts, key=counts.get)
+    if counts[script] < total * 0.8:
+        # Японский пишется смесью иероглифов и каны
+        if counts['kana'] and counts['kana'] + counts['han'] >= total * 0.8:
+            return 'ja'
+        return None
+    if script == 'kana' or (script == 'han' and counts['kana']):
+        return 'ja'
+    if script != 'latin':
+        return {'cyrillic': 'ru', 'hangul': 'ko', 'han': 'zh'}[script]
+    
+    lowered = text.lower()
+    words = WORD_RE.findall(lowered)
+    scores = {lang: sum(1 for w in words if w in stopwords) for lang, stopwords in LATIN_STOPWORDS.items()}
+    for lang, markers in LATIN_MARKERS.items():
+        if any(m in lowered for m in markers):
+            scores[lang] += 2
+    best = max(scores, key=scores.get)
+    best_score = scores[best]
+    if best_score < LANG_DETECT_MIN_SCORE:
+        return None
+    if all(best_score >= score + LANG_DETECT_MARGIN and best_score >= score * 2
+           for lang, score in scores.items() if lang != best):
+        return best
+    return None
 
-@dp.callback_query(F.data == 'new_chat')
-async def new_chat_handler(callback: types.CallbackQuery):
-    user = db.get_user(callback.from_user.id)
+class TranslationCache:
+    """Кэш переводов: LRU в памяти поверх таблицы translations.
+    
+    Ключ - sha256 от модели-переводчика, целевого языка и нормализованного текста.
+    """
+    def __init__(self, maxsize: int = TRANSLATION_CACHE_SIZE):
+        self.memory = LRUCache(maxsize)
+        # same_language - сэкономленные вызовы переводчика благодаря detect_language
+        self.stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'same_language': 0}
+    
+    @staticmethod
+    def key(text: str, target_lang: str, translator_model: str) -> str:
+        normalized = ' '.join(text.split())
+        return hashlib.sha256(f"{translator_model}\0{target_lang}\0{normalized}".encode('utf-8')).hexdigest()
+    
+    async def get(self, key: str) -> Optional[str]:
+        translation = self.memory.get(key)
+        if translation is not None:
+            self.stats['memory_hits'] += 1
+            return translation
+        translation = await adb.get_translation(key)
+        if translation is not None:
+            self.stats['db_hits'] += 1
+            self.memory.set(key, translation)
+            return translation
+        self.stats['misses'] += 1
+        return None
     
-    if not user['selected_model']:
-        user_states[callback.from_user.id] = {'return_to_new_chat': True}
-        await select_model_handler(callback)
-        return
+    async def put(self, key: str, translation: str):
+        self.memory.set(key, translation)
+        await adb.put_translation(key, translation)
     
-    await create_new_chat(callback.message, callback.from_user.id)
-    await callback.answer()
+    @property
+    def hit_ratio(self) -> float:
+        hits = self.stats['memory_hits'] + self.stats['db_hits']
+        total = hits + self.stats['misses']
+        return hits / total if total else 0.0
 
-async def create_new_chat(message: types.Message, user_id: int):
-    user = db.get_user(user_id)
-    chat_id = db.create_chat(user_id, t(user_id, 'new_chat_name'), user['selected_model'])
-    
-    user_states[user_id] = {'current_chat': chat_id}
-    
-    await message.answer(
-        f"{t(user_id, 'chat_with_model')} {user['selected_model']}",
-        reply_markup=get_main_keyboard(user_id)
-    )
+translation_cache = TranslationCache()
 
-@dp.callback_query(F.data == 'chat_list')
-async def chat_list_handler(callback: types.CallbackQuery):
-    chats = db.get_user_chats(callback.from_user.id)
+async def request_translation(hosts: List[str], translator_model: str, text: str, target_lang: str,
+                              user_id: int = 0) -> Optional[str]:
+    """Перевод через модель-переводчик с кэшем; None, если перевести не удалось"""
+    # Текст уже на нужном языке - переводчик не нужен
+    if detect_language(text) == target_lang:
+        translation_cache.stats['same_language'] += 1
+        return text
     
-    if not chats:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_create_chat'), callback_data='new_chat')],
-            [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data='back_main')]
-        ])
-        await callback.message.edit_text(t(callback.from_user.id, 'no_chats'), reply_markup=keyboard)
-    else:
-        keyboard = []
-        for chat in chats:
-            keyboard.append([InlineKeyboardButton(text=chat['chat_name'], callback_data=f"open_chat_{chat['id']}")])
-        keyboard.append([InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data='back_main')])
-        
-        await callback.message.edit_text(t(callback.from_user.id, 'your_chats'), 
-                                        reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith('open_chat_'))
-async def open_chat_handler(callback: types.CallbackQuery):
-    chat_id = int(callback.data.replace('open_chat_', ''))
-    chat = db.get_chat(chat_id)
+    key = translation_cache.key(text, target_lang, translator_model)
+    cached = await translation_cache.get(key)
+    if cached is not None:
+        return cached
     
-    text = f"{t(callback.from_user.id, 'chat')}: {chat['chat_name']}\n{t(callback.from_user.id, 'model_in_chat')}: {chat['model']}"
+    system_prompt = '''You are a professional translator. Input is a JSON object where the key is the target language code and the value is the source text. Translate the text accurately, preserving meaning and nuances, following the target language's grammar and cultural norms. Output ONLY the translated text, with no explanations, comments, or formatting.'''
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_delete_chat'), callback_data=f"delete_chat_{chat_id}")],
-        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_rename_chat'), callback_data=f"rename_chat_{chat_id}")],
-        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_continue_chat'), callback_data=f"continue_chat_{chat_id}")],
-        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data='chat_list')]
-    ])
-    
-    await callback.message.edit_text(text, reply_markup=keyboard)
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith('delete_chat_'))
-async def delete_chat_handler(callback: types.CallbackQuery):
-    chat_id = int(callback.data.replace('delete_chat_', ''))
-    db.delete_chat(chat_id)
-    
-    if callback.from_user.id in user_states and user_states[callback.from_user.id].get('current_chat') == chat_id:
-        user_states[callback.from_user.id]['current_chat'] = None
-    
-    await callback.answer(t(callback.from_user.id, 'chat_deleted'))
-    await chat_list_handler(callback)
-
-@dp.callback_query(F.data.startswith('rename_chat_'))
-async def rename_chat_handler(callback: types.CallbackQuery, state: FSMContext):
-    chat_id = int(callback.data.replace('rename_chat_', ''))
-    await state.update_data(rename_chat_id=chat_id)
-    await state.set_state(States.waiting_chat_rename)
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data=f'open_chat_{chat_id}')]
-    ])
-    await callback.message.edit_text(t(callback.from_user.id, 'enter_new_name'), reply_markup=keyboard)
-    await callback.answer()
-
-@dp.message(States.waiting_chat_rename)
-async def chat_rename_input_handler(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    chat_id = data.get('rename_chat_id')
-    new_name = message.text.strip()
-    
-    db.update_chat_name(chat_id, new_name)
-    await state.clear()
-    await message.answer(t(message.from_user.id, 'chat_renamed'))
-
-@dp.callback_query(F.data.startswith('continue_chat_'))
-async def continue_chat_handler(callback: types.CallbackQuery):
-    chat_id = int(callback.data.replace('continue_chat_', ''))
-    user_states[callback.from_user.id] = {'current_chat': chat_id}
-    
-    chat = db.get_chat(chat_id)
-    await callback.message.answer(
-        f"{t(callback.from_user.id, 'continuing_chat')} {chat['chat_name']}",
-        reply_markup=get_main_keyboard(callback.from_user.id)
-    )
-    await callback.answer()
-
-@dp.callback_query(F.data == 'settings')
-async def settings_handler(callback: types.CallbackQuery):
-    user = db.get_user(callback.from_user.id)
-    models = await get_ollama_models(user['host'])
-    hosts = db.get_user_hosts(callback.from_user.id)
-    
-    active_host = next((h for h in hosts if h['is_active']), None)
-    host_name = active_host['host_name'] if active_host else user['host']
-    
-    text = f"""{t(callback.from_user.id, 'settings')}
-{t(callback.from_user.id, 'selected_host')}: {host_name}
-{t(callback.from_user.id, 'translator_model')}: {user['translator_model'] or t(callback.from_user.id, 'none')}
-{t(callback.from_user.id, 'loaded_models')}: {', '.join(models) if models else t(callback.from_user.id, 'none')}
-{t(callback.from_user.id, 'selected_model')}: {user['selected_model'] or t(callback.from_user.id, 'none')}"""
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_manage_hosts'), callback_data='manage_hosts')],
-        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_select_translator'), callback_data='select_translator')],
-        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_manage_models'), callback_data='manage_models')],
-        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_localization'), callback_data='localization')],
-        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data='back_main')]
-    ])
-    
-    await callback.message.edit_text(text, reply_markup=keyboard)
-    await callback.answer()
-
-@dp.callback_query(F.data == 'manage_hosts')
-async def manage_hosts_handler(callback: types.CallbackQuery):
-    hosts = db.get_user_hosts(callback.from_user.id)
-    
-    if not hosts:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_add_host'), callback_data='add_host')],
-            [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data='settings')]
-        ])
-        await callback.message.edit_text("У вас нет сохраненных хостов", reply_markup=keyboard)
-    else:
-        text = "📡 Ваши хосты:\n\n"
-        keyboard = []
-        for host in hosts:
-            status = "✓ " if host['is_active'] else ""
-            text += f"{status}{host['host_name']}: {host['host_url']}\n"
-            keyboard.append([
-                InlineKeyboardButton(text=f"{status}{host['host_name']}", callback_data=f"selhost_{host['id']}"),
-                InlineKeyboardButton(text="🗑", callback_data=f"delhost_{host['id']}")
-            ])
-        
-        keyboard.append([InlineKeyboardButton(text=t(callback.from_user.id, 'btn_add_host'), callback_data='add_host')])
-        keyboard.append([InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data='settings')])
-        
-        await callback.message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
-    await callback.answer()
-
-@dp.callback_query(F.data == 'add_host')
-async def add_host_handler(callback: types.CallbackQuery, state: FSMContext):
-    await callback.message.answer(t(callback.from_user.id, 'enter_new_host'))
-    await state.set_state(States.waiting_host)
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith('selhost_'))
-async def select_host_handler(callback: types.CallbackQuery):
-    host_id = int(callback.data.replace('selhost_', ''))
-    db.set_active_host(callback.from_user.id, host_id)
-    await callback.answer("✅ Хост активирован!")
-    await manage_hosts_handler(callback)
-
-@dp.callback_query(F.data.startswith('delhost_'))
-async def delete_host_handler(callback: types.CallbackQuery):
-    host_id = int(callback.data.replace('delhost_', ''))
-    db.delete_host(host_id)
-    await callback.answer("🗑 Хост удален")
-    await manage_hosts_handler(callback)
-
-@dp.callback_query(F.data == 'change_host')
-async def change_host_handler(callback: types.CallbackQuery, state: FSMContext):
-    await callback.message.answer(t(callback.from_user.id, 'enter_new_host'))
-    await state.set_state(States.waiting_host)
-    await callback.answer()
-
-@dp.callback_query(F.data == 'select_translator')
-async def select_translator_handler(callback: types.CallbackQuery):
-    user = db.get_user(callback.from_user.id)
-    models = await get_ollama_models(user['host'])
-    
-    keyboard = []
-    for model in models:
-        check = '✓ ' if model == user['translator_model'] else ''
-        keyboard.append([InlineKeyboardButton(text=f"{check}{model}", callback_data=f"trans_{model}")])
-    
-    keyboard.append([InlineKeyboardButton(text=t(callback.from_user.id, 'btn_none'), callback_data='trans_none')])
-    keyboard.append([InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data='settings')])
-    
-    await callback.message.edit_text(
-        t(callback.from_user.id, 'select_translator_model'),
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
-    )
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith('trans_'))
-async def translator_select_handler(callback: types.CallbackQuery):
-    model = callback.data.replace('trans_', '')
-    if model == 'none':
-        model = None
-    
-    db.update_user(callback.from_user.id, translator_model=model)
-    await callback.answer(t(callback.from_user.id, 'translator_set'))
-    await settings_handler(callback)
-
-@dp.callback_query(F.data == 'manage_models')
-async def manage_models_handler(callback: types.CallbackQuery):
-    user = db.get_user(callback.from_user.id)
-    models = await get_ollama_models(user['host'])
-    
-    keyboard = []
-    for model in models:
-        keyboard.append([
-            InlineKeyboardButton(text=f"📥 {model}", callback_data=f"load_{model}"),
-            InlineKeyboardButton(text="📤", callback_data=f"unload_{model}")
-        ])
-    
-    keyboard.append([InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data='settings')])
-    
-    await callback.message.edit_text(
-        t(callback.from_user.id, 'manage_models_text'),
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
-    )
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith('load_'))
-async def load_model_handler(callback: types.CallbackQuery):
-    model = callback.data.replace('load_', '')
-    user = db.get_user(callback.from_user.id)
-    
-    await callback.answer(t(callback.from_user.id, 'loading_model'))
-    success = await load_model(user['host'], model)
-    
-    if success:
-        await callback.message.answer(t(callback.from_user.id, 'model_loaded'))
-    else:
-        await callback.message.answer(t(callback.from_user.id, 'model_load_error'))
-
-@dp.callback_query(F.data.startswith('unload_'))
-async def unload_model_handler(callback: types.CallbackQuery):
-    model = callback.data.replace('unload_', '')
-    user = db.get_user(callback.from_user.id)
-    
-    await callback.answer(t(callback.from_user.id, 'unloading_model'))
-    success = await unload_model(user['host'], model)
-    
-    if success:
-        await callback.message.answer(t(callback.from_user.id, 'model_unloaded'))
-    else:
-        await callback.message.answer(t(callback.from_user.id, 'model_unload_error'))
-
-@dp.callback_query(F.data == 'localization')
-async def localization_handler(callback: types.CallbackQuery):
-    keyboard = []
-    for code, lang_info in LANGUAGES.items():
-        keyboard.append([InlineKeyboardButton(
-            text=f"{lang_info['flag']} {lang_info['name']}", 
-            callback_data=f"lang_{code}"
-        )])
-    
-    keyboard.append([InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data='settings')])
-    
-    await callback.message.edit_text(
-        t(callback.from_user.id, 'select_language'),
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
-    )
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith('lang_'))
-async def language_select_handler(callback: types.CallbackQuery):
-    lang_code = callback.data.replace('lang_', '')
-    db.update_user(callback.from_user.id, locale=lang_code)
-    await callback.answer(t(callback.from_user.id, 'language_changed'))
-    await settings_handler(callback)
-
-@dp.callback_query(F.data == 'back_main')
-async def back_main_handler(callback: types.CallbackQuery):
-    await callback.message.delete()
-    await show_main_menu(callback.message)
-    await callback.answer()
-
-async def send_typing_action(chat_id: int):
-    while True:
-        try:
-            await bot.send_chat_action(chat_id, 'typing')
-            await asyncio.sleep(5)
-        except asyncio.CancelledError:
-            break
-
-@dp.callback_query(F.data.startswith('regen_'))
-async def regenerate_handler(callback: types.CallbackQuery):
-    chat_id = int(callback.data.replace('regen_', ''))
-    user = db.get_user(callback.from_user.id)
-    chat = db.get_chat(chat_id)
-    
-    messages = db.get_chat_messages(chat_id)[:-1]
-    
-    typing_task = asyncio.create_task(send_typing_action(callback.message.chat.id))
-    response = await chat_with_ollama(user['host'], chat['model'], messages, TOOLS)
-    typing_task.cancel()
-    
-    if response:
-        content = response['message']['content']
-        if user['translator_model']:
-            content = await translate_text(user['host'], user['translator_model'], content, user['locale'])
-        
-        db.update_last_message(chat_id, response['message']['content'])
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text=t(callback.from_user.id, 'btn_regenerate'), callback_data=f'regen_{chat_id}'),
-                InlineKeyboardButton(text=t(callback.from_user.id, 'btn_modify'), callback_data=f'modify_{chat_id}')
-            ]
-        ])
-        
-        await callback.message.edit_text(content, reply_markup=keyboard)
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith('modify_'))
-async def modify_handler(callback: types.CallbackQuery):
-    chat_id = int(callback.data.replace('modify_', ''))
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text=t(callback.from_user.id, 'btn_shorter'), callback_data=f'mod_shorter_{chat_id}'),
-            InlineKeyboardButton(text=t(callback.from_user.id, 'btn_longer'), callback_data=f'mod_longer_{chat_id}')
-        ],
-        [
-            InlineKeyboardButton(text=t(callback.from_user.id, 'btn_simpler'), callback_data=f'mod_simpler_{chat_id}'),
-            InlineKeyboardButton(text=t(callback.from_user.id, 'btn_complex'), callback_data=f'mod_complex_{chat_id}')
-        ],
-        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_edit_response'), callback_data=f'edit_resp_{chat_id}')],
-        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data=f'cancel_modify_{chat_id}')]
-    ])
-    
-    await callback.message.edit_reply_markup(reply_markup=keyboard)
-    await callback.answer()
-
-async def modify_response(callback: types.CallbackQuery, chat_id: int, modification: str):
-    user = db.get_user(callback.from_user.id)
-    chat = db.get_chat(chat_id)
-    messages = db.get_chat_messages(chat_id)
-    
-    mod_prompt = {
-        'shorter': 'Make your previous response shorter and more concise.',
-        'longer': 'Expand your previous response with more details.',
-        'simpler': 'Simplify your previous response for easier understanding.',
-        'complex': 'Make your previous response more detailed and sophisticated.'
-    }
-    
-    messages.append({'role': 'user', 'content': mod_prompt[modification]})
-    
-    typing_task = asyncio.create_task(send_typing_action(callback.message.chat.id))
-    response = await chat_with_ollama(user['host'], chat['model'], messages, TOOLS)
-    typing_task.cancel()
-    
-    if response:
-        content = response['message']['content']
-        if user['translator_model']:
-            content = await translate_text(user['host'], user['translator_model'], content, user['locale'])
-        
-        db.update_last_message(chat_id, response['message']['content'])
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text=t(callback.from_user.id, 'btn_regenerate'), callback_data=f'regen_{chat_id}'),
-                InlineKeyboardButton(text=t(callback.from_user.id, 'btn_modify'), callback_data=f'modify_{chat_id}')
-            ]
-        ])
-        
-        await callback.message.edit_text(content, reply_markup=keyboard)
-
-@dp.callback_query(F.data.startswith('mod_shorter_'))
-async def mod_shorter_handler(callback: types.CallbackQuery):
-    chat_id = int(callback.data.replace('mod_shorter_', ''))
-    await modify_response(callback, chat_id, 'shorter')
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith('mod_longer_'))
-async def mod_longer_handler(callback: types.CallbackQuery):
-    chat_id = int(callback.data.replace('mod_longer_', ''))
-    await modify_response(callback, chat_id, 'longer')
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith('mod_simpler_'))
-async def mod_simpler_handler(callback: types.CallbackQuery):
-    chat_id = int(callback.data.replace('mod_simpler_', ''))
-    await modify_response(callback, chat_id, 'simpler')
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith('mod_complex_'))
-async def mod_complex_handler(callback: types.CallbackQuery):
-    chat_id = int(callback.data.replace('mod_complex_', ''))
-    await modify_response(callback, chat_id, 'complex')
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith('edit_resp_'))
-async def edit_response_handler(callback: types.CallbackQuery, state: FSMContext):
-    chat_id = int(callback.data.replace('edit_resp_', ''))
-    await state.update_data(edit_chat_id=chat_id)
-    await state.set_state(States.waiting_response_edit)
-    
-    await callback.message.answer(t(callback.from_user.id, 'enter_new_response'))
-    await callback.answer()
-
-@dp.message(States.waiting_response_edit)
-async def response_edit_input_handler(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    chat_id = data.get('edit_chat_id')
-    
-    db.update_last_message(chat_id, message.text)
-    await state.clear()
-    await message.answer(t(message.from_user.id, 'response_updated'))
-
-@dp.callback_query(F.data.startswith('cancel_modify_'))
-async def cancel_modify_handler(callback: types.CallbackQuery):
-    chat_id = int(callback.data.replace('cancel_modify_', ''))
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text=t(callback.from_user.id, 'btn_regenerate'), callback_data=f'regen_{chat_id}'),
-            InlineKeyboardButton(text=t(callback.from_user.id, 'btn_modify'), callback_data=f'modify_{chat_id}')
-        ]
-    ])
-    
-    await callback.message.edit_reply_markup(reply_markup=keyboard)
-    await callback.answer()
-
-@dp.inline_query()
-async def inline_query_handler(inline_query: types.InlineQuery):
-    user = db.get_user(inline_query.from_user.id)
-    
-    if not user or not user['selected_model']:
-        results = [
-            InlineQueryResultArticle(
-                id='no_model',
-                title=t(inline_query.from_user.id, 'no_model_selected'),
-                input_message_content=InputTextMessageContent(
-                    message_text=t(inline_query.from_user.id, 'please_select_model_inline')
-                )
-            )
-        ]
-        await inline_query.answer(results, cache_time=1)
-        return
-    
-    query = inline_query.query.strip()
-    if not query:
-        await inline_query.answer([], cache_time=1)
-        return
-    
-    results = [
-        InlineQueryResultArticle(
-            id='answer',
-            title=t(inline_query.from_user.id, 'inline_answer'),
-            description=t(inline_query.from_user.id, 'inline_answer_desc'),
-            input_message_content=InputTextMessageContent(message_text='⏳'),
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                InlineKeyboardButton(text='⏳', callback_data=f'inline_answer_{query}')
-            ]])
-        ),
-        InlineQueryResultArticle(
-            id='translate',
-            title=t(inline_query.from_user.id, 'inline_translate'),
-            description=t(inline_query.from_user.id, 'inline_translate_desc'),
-            input_message_content=InputTextMessageContent(message_text='⏳'),
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                InlineKeyboardButton(text='⏳', callback_data=f'inline_translate_{query}')
-            ]])
-        )
-    ]
-    
-    await inline_query.answer(results, cache_time=1)
-
-@dp.callback_query(F.data.startswith('inline_answer_'))
-async def inline_answer_handler(callback: types.CallbackQuery):
-    query = callback.data.replace('inline_answer_', '')
-    user = db.get_user(callback.from_user.id)
-    
-    messages = [{'role': 'user', 'content': query}]
-    response = await chat_with_ollama(user['host'], user['selected_model'], messages)
-    
-    if response:
-        content = response['message']['content']
-        if user['translator_model']:
-            content = await translate_text(user['host'], user['translator_model'], content, user['locale'])
-        await callback.message.edit_text(content)
-    else:
-        await callback.message.edit_text(t(callback.from_user.id, 'error_generating'))
-    
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith('inline_translate_'))
-async def inline_translate_handler(callback: types.CallbackQuery):
-    query = callback.data.replace('inline_translate_', '')
-    user = db.get_user(callback.from_user.id)
-    
-    if not user['translator_model']:
-        await callback.message.edit_text(t(callback.from_user.id, 'no_translator'))
-        await callback.answer()
-        return
-    
-    system_prompt = '''You are a professional translator. Input is a JSON object where the key is the target language code and the value is the source text. Translate the text accurately, preserving meaning and nuances, following the target language's grammar and cultural norms. Output ONLY the translated text, with no explanations, comments, or formatting.'''
-    
-    json_input = json.dumps({user['locale']: query})
-    messages = [
-        {'role': 'system', 'content': system_prompt},
-        {'role': 'user', 'content': json_input}
-    ]
-    
-    response = await chat_with_ollama(user['host'], user['translator_model'], messages)
-    
-    if response:
-        content = response['message']['content'].strip()
-        await callback.message.edit_text(content)
-    else:
-        await callback.message.edit_text(t(callback.from_user.id, 'error_translating'))
-    
-    await callback.answer()
-
-@dp.message(F.text)
-async def text_message_handler(message: types.Message):
-    text = message.text
-    user_id = message.from_user.id
-    
-    # Check if it's a keyboard button
-    if text == t(user_id, 'btn_model_select'):
-        fake_callback = types.CallbackQuery(
-            id='fake', from_user=message.from_user, message=message,
-            chat_instance='', data='select_model'
-        )
-        await select_model_handler(fake_callback)
-        return
-    
-    if text == t(user_id, 'btn_chats'):
-        fake_callback = types.CallbackQuery(
-            id='fake', from_user=message.from_user, message=message,
-            chat_instance='', data='chat_list'
-        )
-        await chat_list_handler(fake_callback)
-        return
-    
-    if text == t(user_id, 'btn_settings'):
-        fake_callback = types.CallbackQuery(
-            id='fake', from_user=message.from_user, message=message,
-            chat_instance='', data='settings'
-        )
-        await settings_handler(fake_callback)
-        return
-    
-    # Process as regular user message
-    user = db.get_user(message.from_user.id)
-    
-    if not user or not user['selected_model']:
-        await message.answer(t(message.from_user.id, 'please_select_model'))
-        return
-    
-    if message.from_user.id not in user_states or not user_states[message.from_user.id].get('current_chat'):
-        chat_id = db.create_chat(message.from_user.id, t(message.from_user.id, 'new_chat_name'), user['selected_model'])
-        user_states[message.from_user.id] = {'current_chat': chat_id}
-    
-    chat_id = user_states[message.from_user.id]['current_chat']
-    chat = db.get_chat(chat_id)
-    
-    user_text = message.text
-    if user['translator_model']:
-        user_text = await translate_text(user['host'], user['translator_model'], message.text, 'en')
-    
-    db.add_message(chat_id, 'user', user_text)
-    
-    typing_task = asyncio.create_task(send_typing_action(message.chat.id))
-    
-    messages = db.get_chat_messages(chat_id)
-    response = await chat_with_ollama(user['host'], chat['model'], messages, TOOLS)
-    
-    typing_task.cancel()
+    json_input = json.dumps({target_lang: text})
+    messages = [
+        {'role': 'system', 'content': system_prompt},
+        {'role': 'user', 'content': json_input}
+    ]
     
-    if not response:
-        await message.answer(t(message.from_user.id, 'error_generating'))
+    response = await host_pool.chat(hosts, translator_model, messages, user_id=user_id)
+    if response and 'message' in response:
+        translation = response['message']['content'].strip()
+        if translation:
+            await translation_cache.put(key, translation)
+            return translation
+    return None
+
+async def translate_text(hosts: List[str], translator_model: str, text: str, target_lang: str,
+                         user_id: int = 0) -> str:
+    if not translator_model:
+        return text
+    translation = await request_translation(hosts, translator_model, text, target_lang, user_id)
+    return translation if translation is not None else text
+
+class PipelinedTranslation:
+    """Перевод ответа по предложениям прямо во время генерации.
+    
+    Законченные предложения собираются в куски от PIPELINE_MIN_CHARS символов и сразу параллельно уходят
+    переводчику; переводы отдаются в on_text строго по порядку, так что перевод заканчивается вскоре
+    после генерации, а не ещё одним полным проходом позже.
+    """
+    def __init__(self, hosts: List[str], translator_model: str, target_lang: str, user_id: int,
+                 on_text: Callable[[str], None]):
+        self.hosts = hosts
+        self.translator_model = translator_model
+        self.target_lang = target_lang
+        self.user_id = user_id
+        self.on_text = on_text
+        self.source = ''
+        self.parts: List[str] = []
+        self._pending = ''
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._deliver_task: Optional[asyncio.Task] = None
+    
+    def feed(self, delta: str):
+        self.source += delta
+        self._pending += delta
+        if len(self._pending) < PIPELINE_MIN_CHARS and '\n\n' not in self._pending:
+            return
+        cut = 0
+        for match in SENTENCE_END.finditer(self._pending):
+            cut = match.end()
+        if cut:
+            chunk, self._pending = self._pending[:cut], self._pending[cut:]
+            self._submit(chunk)
+    
+    def _submit(self, chunk: str):
+        task = None
+        if chunk.strip():
+            task = asyncio.create_task(request_translation(self.hosts, self.translator_model, chunk.strip(),
+                                                           self.target_lang, self.user_id))
+        self._queue.put_nowait((task, chunk))
+        if self._deliver_task is None:
+            self._deliver_task = asyncio.create_task(self._deliver())
+    
+    async def _deliver(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            task, chunk = item
+            translation = await task if task else None
+            if translation is None:
+                text = chunk
+            else:
+                # Переводчик съедает пробелы и переводы строк по краям - возвращаем их
+                text = chunk[:len(chunk) - len(chunk.lstrip())] + translation + chunk[len(chunk.rstrip()):]
+            self.parts.append(text)
+            self.on_text(text)
+    
+    def cancel(self):
+        if self._deliver_task is not None:
+            self._deliver_task.cancel()
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item and item[0]:
+                item[0].cancel()
+    
+    async def finish(self) -> str:
+        if self._pending:
+            self._submit(self._pending)
+            self._pending = ''
+        if self._deliver_task is not None:
+            self._queue.put_nowait(None)
+            await self._deliver_task
+        return ''.join(self.parts).strip()
+
+def open_reply_stream(target: types.Message, user: Dict, hosts: List[str],
+                      sent: Optional[types.Message] = None) -> Tuple[Optional[StreamingMessage], Optional[PipelinedTranslation]]:
+    """Потоковый вывод ответа, а при настроенном переводчике - ещё и конвейерный перевод"""
+    if not STREAM_RESPONSES:
+        return None, None
+    if not user['translator_model']:
+        return StreamingMessage(target, sent=sent), None
+    if not PIPELINED_TRANSLATION:
+        return None, None
+    stream = StreamingMessage(target, sent=sent)
+    return stream, PipelinedTranslation(hosts, user['translator_model'], user['locale'], user['user_id'], stream.feed)
+
+async def translate_reply(pipeline: Optional[PipelinedTranslation], hosts: List[str], user: Dict, content: str) -> str:
+    if pipeline is not None:
+        translated = await pipeline.finish()
+        # В конвейер мог попасть текст промежуточного ответа (до вызова инструмента)
+        if pipeline.source == content:
+            return translated
+    if user['translator_model'] and content:
+        return await translate_text(hosts, user['translator_model'], content, user['locale'], user['user_id'])
+    return content
+
+async def finish_superseded(stream: Optional[StreamingMessage], pipeline: Optional[PipelinedTranslation], user_id: int):
+    if pipeline is not None:
+        pipeline.cancel()
+    if stream and stream.sent:
+        note = t(user_id, 'generation_superseded')
+        partial = stream.text[:STREAM_PREVIEW_LIMIT - len(note) - 2].rstrip()
+        await stream.finish(f"{partial}\n\n{note}" if partial else note)
+
+def estimate_tokens(text: str) -> int:
+    # Грубая оценка без токенизатора: ~4 символа на токен плюс служебные токены сообщения
+    return len(text or '') // 4 + 4
+
+def context_tokens(model: str) -> int:
+    for prefix, tokens in MODEL_CONTEXT_TOKENS.items():
+        if model.startswith(prefix):
+            return tokens
+    return CONTEXT_DEFAULT_TOKENS
+
+summary_tasks: Dict[int, asyncio.Task] = {}
+
+async def build_context(chat: Dict, hosts: List[str], user_id: int, before_id: Optional[int] = None) -> List[Dict]:
+    """История чата для запроса к модели в пределах бюджета токенов.
+    
+    Последние CONTEXT_KEEP_MESSAGES сообщений идут дословно, более ранние - столько, сколько влезает
+    в бюджет; всё, что уже сведено, заменяется сводкой. Сводка обновляется в фоне.
+    """
+    summary = await adb.get_chat_summary(chat['id'])
+    history = await adb.get_chat_messages_after(chat['id'], summary['covered_id'] if summary else 0)
+    if before_id is not None:
+        history = [m for m in history if m['id'] < before_id]
+    
+    prefix = []
+    if CHAT_SYSTEM_PROMPT:
+        prefix.append({'role': 'system', 'content': CHAT_SYSTEM_PROMPT})
+    if summary:
+        prefix.append({'role': 'system', 'content': f"Summary of the earlier conversation:\n{summary['summary']}"})
+    
+    budget = int(context_tokens(chat['model']) * (1 - CONTEXT_REPLY_RESERVE))
+    used = sum(estimate_tokens(m['content']) for m in prefix)
+    first = len(history)
+    while first > 0:
+        cost = estimate_tokens(history[first - 1]['content'])
+        if len(history) - first >= CONTEXT_KEEP_MESSAGES and used + cost > budget:
+            break
+        used += cost
+        first -= 1
+    if first:
+        # Начало окна - только на границах ступеней, чтобы префикс запроса не сдвигался каждый ход
+        first = min(-(-first // CONTEXT_TRIM_STEP) * CONTEXT_TRIM_STEP, max(len(history) - CONTEXT_KEEP_MESSAGES, first))
+    tail = [{'role': m['role'], 'content': m['content']} for m in history[first:]]
+    
+    if len(history) - CONTEXT_KEEP_MESSAGES >= SUMMARY_MIN_MESSAGES:
+        schedule_summary(chat, hosts, user_id)
+    return prefix + tail
+
+def schedule_summary(chat: Dict, hosts: List[str], user_id: int):
+    task = summary_tasks.get(chat['id'])
+    if task and not task.done():
         return
+    task = asyncio.create_task(update_chat_summary(chat, hosts, user_id))
+    summary_tasks[chat['id']] = task
+    task.add_done_callback(lambda _: summary_tasks.pop(chat['id'], None))
+
+async def update_chat_summary(chat: Dict, hosts: List[str], user_id: int):
+    """Досводить сообщения вне дословного окна порциями, каждая - в пределах половины контекста"""
+    model = SUMMARY_MODEL or chat['model']
+    system_prompt = '''You maintain a running summary of a conversation between a user and an assistant. Merge the previous summary with the new messages. Keep facts, names, numbers, decisions, open questions and the user's preferences. Be concise. Output ONLY the updated summary.'''
+    try:
+        while True:
+            summary = await adb.get_chat_summary(chat['id'])
+            history = await adb.get_chat_messages_after(chat['id'], summary['covered_id'] if summary else 0)
+            older = history[:-CONTEXT_KEEP_MESSAGES]
+            if len(older) < SUMMARY_MIN_MESSAGES:
+                return
+            
+            budget = context_tokens(model) // 2
+            used = estimate_tokens(summary['summary'] if summary else '')
+            batch = []
+            for m in older:
+                cost = estimate_tokens(m['content'])
+                if batch and used + cost > budget:
+                    break
+                batch.append(m)
+                used += cost
+            
+            transcript = '\n'.join(f"{m['role']}: {m['content']}" for m in batch)
+            messages = [
+                {'role': 'system', 'content': system_prompt},
+                {'role': 'user', 'content': f"Previous summary:\n{summary['summary'] if summary else '(none)'}\n\nNew messages:\n{transcript}"}
+            ]
+            response = await host_pool.chat(hosts, model, messages, user_id=user_id)
+            if not response:
+                return
+            await adb.set_chat_summary(chat['id'], response['message']['content'].strip(), batch[-1]['id'])
+    except Exception as e:
+        print(f"Ошибка обновления сводки чата {chat['id']}: {e}")
+
+class ToolRegistry:
+    """Инструменты модели: async-функции, регистрируемые декоратором; JSON-схема строится по сигнатуре.
     
-    assistant_message = response['message']
-    tool_notes = []
+    Первый аргумент инструмента - контекст хода (чат, пользователь, заметки для ответа),
+    остальные - параметры, которые заполняет модель.
+    """
+    JSON_TYPES = {str: 'string', int: 'integer', float: 'number', bool: 'boolean'}
     
-    if 'tool_calls' in assistant_message:
-        for tool_call in assistant_message['tool_calls']:
-            func_name = tool_call['function']['name']
-            func_args = tool_call['function']['arguments']
-            
-            if func_name == 'rename_chat':
-                old_name = chat['chat_name']
-                new_name = func_args['new_name']
-                db.update_chat_name(chat_id, new_name)
-                tool_notes.append(f"(ИИ изменил имя чата: \"{old_name}\" → \"{new_name}\")")
-            elif func_name == 'calculator':
-                result = execute_tool(func_name, func_args)
-                messages.append({'role': 'assistant', 'content': '', 'tool_calls': assistant_message['tool_calls']})
-                messages.append({'role': 'tool', 'content': result})
-                response = await chat_with_ollama(user['host'], chat['model'], messages)
-                if response:
-                    assistant_message = response['message']
-    
-    content = assistant_message['content']
+    def __init__(self):
+        self._tools: Dict[str, Dict] = {}
     
-    if user['translator_model'] and content:
-        content = await translate_text(user['host'], user['translator_model'], content, user['locale'])
+    def register(self, description: str, timeout: float = TOOL_TIMEOUT, deterministic: bool = False, **params: str):
+        """deterministic=True - результат зависит только от аргументов и запоминается в пределах чата.
+        
+        Запоминаются только успешные вызовы: таймаут и исключения инструмента повторяются при следующем вызове.
+        """
+        def decorator(func: Callable[..., Awaitable[str]]):
+            properties = {}
+            required = []
+            for name, param in list(inspect.signature(func).parameters.items())[1:]:
+                properties[name] = {'type': self.JSON_TYPES.get(param.annotation, 'string'),
+                                    'description': params.get(name, name)}
+                if param.default is inspect.Parameter.empty:
+                    required.append(name)
+            self._tools[func.__name__] = {
+                'func': func,
+                'timeout': timeout,
+                'deterministic': deterministic,
+                'schema': {
+                    'type': 'function',
+                    'function': {
+                        'name': func.__name__,
+                        'description': description,
+                        'parameters': {'type': 'object', 'properties': properties, 'required': required}
+                    }
+                }
+            }
+            return func
+        return decorator
     
-    db.add_message(chat_id, 'assistant', assistant_message['content'])
+    def schemas(self) -> List[Dict]:
+        return [tool['schema'] for tool in self._tools.values()]
     
-    full_text = content
-    if tool_notes:
-        full_text += '\n\n' + '\n'.join(tool_notes)
+    @staticmethod
+    def name_of(tool_call: Any) -> str:
+        function = tool_call.get('function') if isinstance(tool_call, dict) else None
+        name = function.get('name') if isinstance(function, dict) else None
+        return name if isinstance(name, str) else ''
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text=t(message.from_user.id, 'btn_regenerate'), callback_data=f'regen_{chat_id}'),
-            InlineKeyboardButton(text=t(message.from_user.id, 'btn_modify'), callback_data=f'modify_{chat_id}')
-        ]
-    ])
+    async def call(self, tool_call: Any, context: Dict) -> str:
+        # Вызов приходит от модели как есть: любая ошибка формы - результат для модели, а не исключение хода
+        name = self.name_of(tool_call)
+        try:
+            tool = self._tools.get(name)
+            if tool is None:
+                return f"Неизвестный инструмент: {name}"
+            arguments = tool_call['function'].get('arguments') or {}
+            if isinstance(arguments, str):
+                arguments = json.loads(arguments)
+            if not isinstance(arguments, dict):
+                raise ValueError('аргументы должны быть JSON-объектом')
+            known = tool['schema']['function']['parameters']['properties']
+            arguments = {k: v for k, v in arguments.items() if k in known}
+            memo_key = None
+            if tool['deterministic']:
+                memo_key = (context.get('chat_id'), name, json.dumps(arguments, sort_keys=True, ensure_ascii=False))
+                cached = tool_memo.get(memo_key)
+                if cached is not None:
+                    return cached
+            result = str(await asyncio.wait_for(tool['func'](context, **arguments), tool['timeout']))
+            if memo_key is not None:
+                tool_memo.set(memo_key, result)
+            return result
+        except asyncio.TimeoutError:
+            return f"Ошибка инструмента {name}: превышено время выполнения"
+        except Exception as e:
+            print(f"Ошибка инструмента {name}: {e}")
+            return f"Ошибка инструмента {name}: {e}"
+    
+    async def run_calls(self, tool_calls: List[Dict], context: Dict) -> List[str]:
+        """Все вызовы одного хода выполняются параллельно; результаты - в порядке вызовов"""
+        return list(await asyncio.gather(*(self.call(tool_call, context) for tool_call in tool_calls)))
+
+tools = ToolRegistry()
+tool_memo = LRUCache(TOOL_MEMO_SIZE)
+
+calculator_pool = CalculatorPool(CALCULATOR_PROCESSES, CALCULATOR_TIMEOUT) if CALCULATOR_PROCESSES else None
+
+@tools.register('Rename the current chat to better reflect its content',
+                new_name='The new name for the chat')
+async def rename_chat(context: Dict, new_name: str) -> str:
+    old_name = context['chat']['chat_name']
+    await adb.update_chat_name(context['chat_id'], new_name)
+    context['chat']['chat_name'] = new_name
+    context['notes'].append(f"(ИИ изменил имя чата: \"{old_name}\" → \"{new_name}\")")
+    return f"Chat renamed to \"{new_name}\""
+
+@tools.register('Perform mathematical calculations', timeout=CALCULATOR_TIMEOUT + 1, deterministic=True,
+                expression='Mathematical expression to evaluate')
+async def calculator(context: Dict, expression: str) -> str:
+    if calculator_pool is not None:
+        result = await calculator_pool.evaluate(expression)
+    else:
+        # Вычисление ограничено по числу операций и размеру чисел - занимает миллисекунды
+        result = evaluate(expression)
+    if result == TIMEOUT_RESULT:
+        # Таймаут - ошибка инструмента, а не результат: ToolRegistry его не запоминает
+        raise asyncio.TimeoutError()
+    return result
+
+TOOLS = tools.schemas()
+
+agent_stats = {'turns': 0, 'steps': 0, 'max_steps': 0, 'out_of_budget': 0}
+
+async def run_agent(assistant_message: Dict, messages: List[Dict], tool_context: Dict,
+                    generate: Callable[[Optional[List[Dict]]], Awaitable[Optional[Dict]]]) -> Dict:
+    """Выполняет вызовы инструментов и возвращает их результаты модели, пока она не ответит текстом.
     
-    await message.answer(full_text, reply_markup=keyboard)
+    generate(tools) делает следующий запрос к модели по messages; на последнем шаге инструменты
+    не передаются, чтобы модель ответила. Ход обрывается по AGENT_TIME_BUDGET.
+    """
+    agent_stats['turns'] += 1
+    deadline = time.monotonic() + AGENT_TIME_BUDGET
+    for step in range(1, AGENT_MAX_STEPS + 1):
+        tool_calls = assistant_message.get('tool_calls')
+        if not tool_calls:
+            break
+        agent_stats['steps'] += 1
+        try:
+            results = await asyncio.wait_for(tools.run_calls(tool_calls, tool_context), deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            agent_stats['out_of_budget'] += 1
+            break
+        messages.append({'role': 'assistant', 'content': assistant_message.get('content', ''), 'tool_calls': tool_calls})
+        for tool_call, result in zip(tool_calls, results):
+            tool_message = {'role': 'tool', 'content': result, 'tool_name': tools.name_of(tool_call)}
+            if isinstance(tool_call, dict) and tool_call.get('id'):
+                tool_message['tool_call_id'] = tool_call['id']
+            messages.append(tool_message)
+        
+        last_step = step == AGENT_MAX_STEPS
+        if last_step:
+            agent_stats['max_steps'] += 1
+        try:
+            response = await asyncio.wait_for(generate(None if last_step else TOOLS), deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            agent_stats['out_of_budget'] += 1
+            break
+        if not response:
+            break
+        assistant_message = response['message']
+    return assistant_message
 
-async def main():
-    print("🤖 Ollama Telegram Bot запущен!")
-    print("📊 Ожидание сообщений...")
-    await dp.start_polling(bot)
+@dp.message(CommandStart())
+async def start_handler(message: types.Message, state: FSMContext):
+    user = await adb.get_user(message.from_user.id)
+    
+    if not user or not user['host']:
+        await message.answer(t(message.from_user.id, 'welcome'))
+        await state.set_state(States.waiting_host)
+    else:
+        await show_main_menu(message)
 
-if __name__ == '__main__':
-    asyncio.run(main()), host):
+@dp.message(Command('stats'), F.from_user.id.in_(ADMIN_IDS))
+async def stats_handler(message: types.Message):
+    chat_id = (await get_user_state(message.from_user.id)).get('current_chat')
+    prompt_stats = await adb.get_prompt_stats(chat_id) if chat_id else None
+    await message.answer(stats_report(prompt_stats))
+
+@dp.message(States.waiting_host)
+async def host_input_handler(message: types.Message, state: FSMContext):
+    host = message.text.strip()
+    
+    if not re.match(r'^https?://[\w\.\-]+:\d+$', host):
         await message.answer(t(message.from_user.id, 'invalid_host'))
         return
     
@@ -1152,40 +2459,43 @@ async def host_name_input_handler(message: types.Message, state: FSMContext):
     data = await state.get_data()
     host_url = data.get('host_url')
     
-    user = db.get_user(message.from_user.id)
+    user = await adb.get_user(message.from_user.id)
     if not user:
-        db.create_user(message.from_user.id, host_url)
+        await adb.create_user(message.from_user.id, host_url)
     
-    db.add_host(message.from_user.id, host_url, host_name)
+    await adb.add_host(message.from_user.id, host_url, host_name)
     await state.clear()
     await message.answer(f"✅ Хост '{host_name}' успешно добавлен и активирован!", reply_markup=get_main_keyboard(message.from_user.id))
     await show_main_menu(message)
 
 async def show_main_menu(message: types.Message):
-    user = db.get_user(message.from_user.id)
+    user = await adb.get_user(message.from_user.id)
     selected_model = user['selected_model'] if user and user['selected_model'] else t(message.from_user.id, 'no_model')
     
     text = f"{t(message.from_user.id, 'main_menu')}\n{t(message.from_user.id, 'selected_model')}: {selected_model}"
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=t(message.from_user.id, 'btn_model_select'), callback_data='select_model')],
-        [InlineKeyboardButton(text=t(message.from_user.id, 'btn_new_chat'), callback_data='new_chat')],
-        [InlineKeyboardButton(text=t(message.from_user.id, 'btn_chats'), callback_data='chat_list')],
-        [InlineKeyboardButton(text=t(message.from_user.id, 'btn_settings'), callback_data='settings')]
-    ])
-    
-    await message.answer(text, reply_markup=keyboard)
+    await message.answer(text, reply_markup=get_main_menu_keyboard(message.from_user.id))
+
+@dp.callback_query(F.data.startswith('models_page_'))
+async def model_page_handler(callback: types.CallbackQuery):
+    await select_model_handler(callback, page=int(callback.data.replace('models_page_', '')))
 
 @dp.callback_query(F.data == 'select_model')
-async def select_model_handler(callback: types.CallbackQuery):
-    user = db.get_user(callback.from_user.id)
+async def select_model_handler(callback: types.CallbackQuery, page: int = 0):
+    user = await adb.get_user(callback.from_user.id)
     models = await get_ollama_models(user['host'])
+    pages = max(1, -(-len(models) // MODELS_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
     
     keyboard = []
-    for model in models:
+    for model in models[page * MODELS_PAGE_SIZE:(page + 1) * MODELS_PAGE_SIZE]:
         check = '✓ ' if model == user['selected_model'] else ''
         keyboard.append([InlineKeyboardButton(text=f"{check}{model}", callback_data=f"model_{model}")])
     
+    nav = page_nav_row(f"models_page_{page - 1}" if page > 0 else None,
+                       f"models_page_{page + 1}" if page < pages - 1 else None)
+    if nav:
+        keyboard.append(nav)
     keyboard.append([InlineKeyboardButton(text=t(callback.from_user.id, 'btn_add_model'), callback_data='add_model')])
     keyboard.append([InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data='back_main')])
     
@@ -1198,24 +2508,18 @@ async def select_model_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith('model_'))
 async def model_select_handler(callback: types.CallbackQuery):
     model_name = callback.data.replace('model_', '')
-    user = db.get_user(callback.from_user.id)
+    user = await adb.get_user(callback.from_user.id)
     
-    loading_msg = await callback.message.answer(t(callback.from_user.id, 'loading_model'))
+    # Модель подгружается в фоне менеджером загрузки - выбор применяется сразу
+    residency.request(user['host'], model_name)
+    await adb.update_user(callback.from_user.id, selected_model=model_name)
+    await callback.answer(t(callback.from_user.id, 'model_selected'))
     
-    success = await load_model(user['host'], model_name)
-    await loading_msg.delete()
-    
-    if success:
-        db.update_user(callback.from_user.id, selected_model=model_name)
-        await callback.answer(t(callback.from_user.id, 'model_loaded'))
-        
-        if callback.from_user.id in user_states and user_states[callback.from_user.id].get('return_to_new_chat'):
-            user_states[callback.from_user.id]['return_to_new_chat'] = False
-            await create_new_chat(callback.message, callback.from_user.id)
-        else:
-            await select_model_handler(callback)
+    if (await get_user_state(callback.from_user.id)).get('return_to_new_chat'):
+        await update_user_state(callback.from_user.id, return_to_new_chat=False)
+        await create_new_chat(callback.message, callback.from_user.id)
     else:
-        await callback.answer(t(callback.from_user.id, 'model_load_error'), show_alert=True)
+        await select_model_handler(callback)
 
 @dp.callback_query(F.data == 'add_model')
 async def add_model_handler(callback: types.CallbackQuery, state: FSMContext):
@@ -1229,7 +2533,7 @@ async def add_model_handler(callback: types.CallbackQuery, state: FSMContext):
 @dp.message(States.waiting_model_name)
 async def model_name_input_handler(message: types.Message, state: FSMContext):
     model_name = message.text.strip()
-    user = db.get_user(message.from_user.id)
+    user = await adb.get_user(message.from_user.id)
     
     progress_msg = await message.answer(t(message.from_user.id, 'downloading_model') + "\n▱▱▱▱▱▱▱▱▱▱ 0%")
     
@@ -1239,6 +2543,7 @@ async def model_name_input_handler(message: types.Message, state: FSMContext):
         await progress_msg.edit_text(f"{status}\n{bar} {percent}%")
     
     success = await pull_model(user['host'], model_name, update_progress)
+    model_catalog.invalidate(user['host'])
     
     if success:
         await progress_msg.delete()
@@ -1255,10 +2560,10 @@ async def model_name_input_handler(message: types.Message, state: FSMContext):
 
 @dp.callback_query(F.data == 'new_chat')
 async def new_chat_handler(callback: types.CallbackQuery):
-    user = db.get_user(callback.from_user.id)
+    user = await adb.get_user(callback.from_user.id)
     
     if not user['selected_model']:
-        user_states[callback.from_user.id] = {'return_to_new_chat': True}
+        await set_user_state(callback.from_user.id, {'return_to_new_chat': True})
         await select_model_handler(callback)
         return
     
@@ -1266,19 +2571,47 @@ async def new_chat_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 async def create_new_chat(message: types.Message, user_id: int):
-    user = db.get_user(user_id)
-    chat_id = db.create_chat(user_id, t(user_id, 'new_chat_name'), user['selected_model'])
+    user = await adb.get_user(user_id)
+    chat_id = await adb.create_chat(user_id, t(user_id, 'new_chat_name'), user['selected_model'])
     
-    user_states[user_id] = {'current_chat': chat_id}
+    await set_user_state(user_id, {'current_chat': chat_id})
     
     await message.answer(
         f"{t(user_id, 'chat_with_model')} {user['selected_model']}",
         reply_markup=get_main_keyboard(user_id)
     )
 
+def page_nav_row(prev_data: Optional[str], next_data: Optional[str]) -> List[InlineKeyboardButton]:
+    row = []
+    if prev_data:
+        row.append(InlineKeyboardButton(text='◀️', callback_data=prev_data))
+    if next_data:
+        row.append(InlineKeyboardButton(text='▶️', callback_data=next_data))
+    return row
+
+def chat_cursor(chat: Dict) -> str:
+    return f"{chat['created_at']}|{chat['id']}"
+
+@dp.callback_query(F.data.startswith('chats_'))
+async def chat_page_handler(callback: types.CallbackQuery):
+    # chats_n_<cursor> - следующая (более старая) страница, chats_p_<cursor> - предыдущая
+    direction, cursor = callback.data[len('chats_'):].split('_', 1)
+    created_at, chat_id = cursor.rsplit('|', 1)
+    await chat_list_handler(callback, cursor=(created_at, int(chat_id)), backward=direction == 'p')
+
 @dp.callback_query(F.data == 'chat_list')
-async def chat_list_handler(callback: types.CallbackQuery):
-    chats = db.get_user_chats(callback.from_user.id)
+async def chat_list_handler(callback: types.CallbackQuery, cursor: Optional[Tuple[str, int]] = None,
+                            backward: bool = False):
+    # Одна лишняя строка показывает, есть ли ещё страница в этом направлении
+    chats = await adb.get_user_chats(callback.from_user.id, CHATS_PAGE_SIZE + 1, cursor, backward)
+    more = len(chats) > CHATS_PAGE_SIZE
+    chats = chats[1:] if backward and more else chats[:CHATS_PAGE_SIZE]
+    if cursor and not chats:
+        chats = await adb.get_user_chats(callback.from_user.id, CHATS_PAGE_SIZE + 1)
+        more, cursor, backward = len(chats) > CHATS_PAGE_SIZE, None, False
+        chats = chats[:CHATS_PAGE_SIZE]
+    has_newer = more if backward else cursor is not None
+    has_older = True if backward else more
     
     if not chats:
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -1290,6 +2623,10 @@ async def chat_list_handler(callback: types.CallbackQuery):
         keyboard = []
         for chat in chats:
             keyboard.append([InlineKeyboardButton(text=chat['chat_name'], callback_data=f"open_chat_{chat['id']}")])
+        nav = page_nav_row(f"chats_p_{chat_cursor(chats[0])}" if has_newer else None,
+                           f"chats_n_{chat_cursor(chats[-1])}" if has_older else None)
+        if nav:
+            keyboard.append(nav)
         keyboard.append([InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data='back_main')])
         
         await callback.message.edit_text(t(callback.from_user.id, 'your_chats'), 
@@ -1299,7 +2636,7 @@ async def chat_list_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith('open_chat_'))
 async def open_chat_handler(callback: types.CallbackQuery):
     chat_id = int(callback.data.replace('open_chat_', ''))
-    chat = db.get_chat(chat_id)
+    chat = await adb.get_chat(chat_id)
     
     text = f"{t(callback.from_user.id, 'chat')}: {chat['chat_name']}\n{t(callback.from_user.id, 'model_in_chat')}: {chat['model']}"
     
@@ -1316,10 +2653,10 @@ async def open_chat_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith('delete_chat_'))
 async def delete_chat_handler(callback: types.CallbackQuery):
     chat_id = int(callback.data.replace('delete_chat_', ''))
-    db.delete_chat(chat_id)
+    await adb.delete_chat(chat_id)
     
-    if callback.from_user.id in user_states and user_states[callback.from_user.id].get('current_chat') == chat_id:
-        user_states[callback.from_user.id]['current_chat'] = None
+    if (await get_user_state(callback.from_user.id)).get('current_chat') == chat_id:
+        await update_user_state(callback.from_user.id, current_chat=None)
     
     await callback.answer(t(callback.from_user.id, 'chat_deleted'))
     await chat_list_handler(callback)
@@ -1342,16 +2679,16 @@ async def chat_rename_input_handler(message: types.Message, state: FSMContext):
     chat_id = data.get('rename_chat_id')
     new_name = message.text.strip()
     
-    db.update_chat_name(chat_id, new_name)
+    await adb.update_chat_name(chat_id, new_name)
     await state.clear()
     await message.answer(t(message.from_user.id, 'chat_renamed'))
 
 @dp.callback_query(F.data.startswith('continue_chat_'))
 async def continue_chat_handler(callback: types.CallbackQuery):
     chat_id = int(callback.data.replace('continue_chat_', ''))
-    user_states[callback.from_user.id] = {'current_chat': chat_id}
+    await set_user_state(callback.from_user.id, {'current_chat': chat_id})
     
-    chat = db.get_chat(chat_id)
+    chat = await adb.get_chat(chat_id)
     await callback.message.answer(
         f"{t(callback.from_user.id, 'continuing_chat')} {chat['chat_name']}",
         reply_markup=get_main_keyboard(callback.from_user.id)
@@ -1360,17 +2697,21 @@ async def continue_chat_handler(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data == 'settings')
 async def settings_handler(callback: types.CallbackQuery):
-    user = db.get_user(callback.from_user.id)
-    models = await get_ollama_models(user['host'])
+    user = await adb.get_user(callback.from_user.id)
+    models = await get_running_models(user['host'])
+    hosts = await adb.get_user_hosts(callback.from_user.id)
+    
+    active_host = next((h for h in hosts if h['is_active']), None)
+    host_name = active_host['host_name'] if active_host else user['host']
     
     text = f"""{t(callback.from_user.id, 'settings')}
-{t(callback.from_user.id, 'selected_host')}: {user['host']}
+{t(callback.from_user.id, 'selected_host')}: {host_name}
 {t(callback.from_user.id, 'translator_model')}: {user['translator_model'] or t(callback.from_user.id, 'none')}
 {t(callback.from_user.id, 'loaded_models')}: {', '.join(models) if models else t(callback.from_user.id, 'none')}
 {t(callback.from_user.id, 'selected_model')}: {user['selected_model'] or t(callback.from_user.id, 'none')}"""
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_change_host'), callback_data='change_host')],
+        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_manage_hosts'), callback_data='manage_hosts')],
         [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_select_translator'), callback_data='select_translator')],
         [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_manage_models'), callback_data='manage_models')],
         [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_localization'), callback_data='localization')],
@@ -1380,6 +2721,53 @@ async def settings_handler(callback: types.CallbackQuery):
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
+@dp.callback_query(F.data == 'manage_hosts')
+async def manage_hosts_handler(callback: types.CallbackQuery):
+    hosts = await adb.get_user_hosts(callback.from_user.id)
+    
+    if not hosts:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_add_host'), callback_data='add_host')],
+            [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data='settings')]
+        ])
+        await callback.message.edit_text("У вас нет сохраненных хостов", reply_markup=keyboard)
+    else:
+        text = "📡 Ваши хосты:\n\n"
+        keyboard = []
+        for host in hosts:
+            status = "✓ " if host['is_active'] else ""
+            text += f"{status}{host['host_name']}: {host['host_url']}\n"
+            keyboard.append([
+                InlineKeyboardButton(text=f"{status}{host['host_name']}", callback_data=f"selhost_{host['id']}"),
+                InlineKeyboardButton(text="🗑", callback_data=f"delhost_{host['id']}")
+            ])
+        
+        keyboard.append([InlineKeyboardButton(text=t(callback.from_user.id, 'btn_add_host'), callback_data='add_host')])
+        keyboard.append([InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data='settings')])
+        
+        await callback.message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
+    await callback.answer()
+
+@dp.callback_query(F.data == 'add_host')
+async def add_host_handler(callback: types.CallbackQuery, state: FSMContext):
+    await callback.message.answer(t(callback.from_user.id, 'enter_new_host'))
+    await state.set_state(States.waiting_host)
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith('selhost_'))
+async def select_host_handler(callback: types.CallbackQuery):
+    host_id = int(callback.data.replace('selhost_', ''))
+    await adb.set_active_host(callback.from_user.id, host_id)
+    await callback.answer("✅ Хост активирован!")
+    await manage_hosts_handler(callback)
+
+@dp.callback_query(F.data.startswith('delhost_'))
+async def delete_host_handler(callback: types.CallbackQuery):
+    host_id = int(callback.data.replace('delhost_', ''))
+    await adb.delete_host(host_id)
+    await callback.answer("🗑 Хост удален")
+    await manage_hosts_handler(callback)
+
 @dp.callback_query(F.data == 'change_host')
 async def change_host_handler(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.answer(t(callback.from_user.id, 'enter_new_host'))
@@ -1388,7 +2776,7 @@ async def change_host_handler(callback: types.CallbackQuery, state: FSMContext):
 
 @dp.callback_query(F.data == 'select_translator')
 async def select_translator_handler(callback: types.CallbackQuery):
-    user = db.get_user(callback.from_user.id)
+    user = await adb.get_user(callback.from_user.id)
     models = await get_ollama_models(user['host'])
     
     keyboard = []
@@ -1411,56 +2799,34 @@ async def translator_select_handler(callback: types.CallbackQuery):
     if model == 'none':
         model = None
     
-    db.update_user(callback.from_user.id, translator_model=model)
+    await adb.update_user(callback.from_user.id, translator_model=model)
     await callback.answer(t(callback.from_user.id, 'translator_set'))
     await settings_handler(callback)
 
 @dp.callback_query(F.data == 'manage_models')
 async def manage_models_handler(callback: types.CallbackQuery):
-    user = db.get_user(callback.from_user.id)
-    models = await get_ollama_models(user['host'])
-    
-    keyboard = []
-    for model in models:
-        keyboard.append([
-            InlineKeyboardButton(text=f"📥 {model}", callback_data=f"load_{model}"),
-            InlineKeyboardButton(text="📤", callback_data=f"unload_{model}")
-        ])
-    
-    keyboard.append([InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data='settings')])
+    user = await adb.get_user(callback.from_user.id)
+    host = user['host'].rstrip('/')
+    models = await get_ollama_models(host)
+    running = set(await get_running_models(host))
+    await residency.load()
+    
+    # Загрузкой управляет ResidencyManager: здесь только состояние - загруженные и самые востребованные
+    ranked = sorted(models, key=lambda m: (m not in running, -residency.rank(host, m), m))
+    lines = []
+    for model in ranked[:MODELS_PAGE_SIZE]:
+        uses = residency.demand.get(host, {}).get(model, {}).get('uses', 0)
+        lines.append(f"{'🟢' if model in running else '⚪'} {model} · {uses}")
     
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data='settings')]
+    ])
     await callback.message.edit_text(
-        t(callback.from_user.id, 'manage_models_text'),
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
+        t(callback.from_user.id, 'manage_models_text') + ('\n\n' + '\n'.join(lines) if lines else ''),
+        reply_markup=keyboard
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith('load_'))
-async def load_model_handler(callback: types.CallbackQuery):
-    model = callback.data.replace('load_', '')
-    user = db.get_user(callback.from_user.id)
-    
-    await callback.answer(t(callback.from_user.id, 'loading_model'))
-    success = await load_model(user['host'], model)
-    
-    if success:
-        await callback.message.answer(t(callback.from_user.id, 'model_loaded'))
-    else:
-        await callback.message.answer(t(callback.from_user.id, 'model_load_error'))
-
-@dp.callback_query(F.data.startswith('unload_'))
-async def unload_model_handler(callback: types.CallbackQuery):
-    model = callback.data.replace('unload_', '')
-    user = db.get_user(callback.from_user.id)
-    
-    await callback.answer(t(callback.from_user.id, 'unloading_model'))
-    success = await unload_model(user['host'], model)
-    
-    if success:
-        await callback.message.answer(t(callback.from_user.id, 'model_unloaded'))
-    else:
-        await callback.message.answer(t(callback.from_user.id, 'model_unload_error'))
-
 @dp.callback_query(F.data == 'localization')
 async def localization_handler(callback: types.CallbackQuery):
     keyboard = []
@@ -1481,7 +2847,7 @@ async def localization_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith('lang_'))
 async def language_select_handler(callback: types.CallbackQuery):
     lang_code = callback.data.replace('lang_', '')
-    db.update_user(callback.from_user.id, locale=lang_code)
+    await adb.update_user(callback.from_user.id, locale=lang_code)
     await callback.answer(t(callback.from_user.id, 'language_changed'))
     await settings_handler(callback)
 
@@ -1502,85 +2868,109 @@ async def send_typing_action(chat_id: int):
 @dp.callback_query(F.data.startswith('regen_'))
 async def regenerate_handler(callback: types.CallbackQuery):
     chat_id = int(callback.data.replace('regen_', ''))
-    user = db.get_user(callback.from_user.id)
-    chat = db.get_chat(chat_id)
-    
-    messages = db.get_chat_messages(chat_id)[:-1]
-    
-    typing_task = asyncio.create_task(send_typing_action(callback.message.chat.id))
-    response = await chat_with_ollama(user['host'], chat['model'], messages, TOOLS)
-    typing_task.cancel()
-    
-    if response:
-        content = response['message']['content']
-        if user['translator_model']:
-            content = await translate_text(user['host'], user['translator_model'], content, user['locale'])
+    await callback.answer()
+    async with chat_lanes.turn(chat_id) as ticket:
+        user = await adb.get_user(callback.from_user.id)
+        chat = await adb.get_chat(chat_id)
         
-        db.update_last_message(chat_id, response['message']['content'])
+        hosts = await get_user_host_urls(user)
+        # Перегенерируется последний ответ модели; если его нет (ход был вытеснен после сохранения
+        # вопроса), отвечаем на последний вопрос заново
+        last = await adb.get_last_message(chat_id)
+        answer_id = last['id'] if last and last['role'] == 'assistant' else None
+        messages = await build_context(chat, hosts, callback.from_user.id, before_id=answer_id)
         
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text=t(callback.from_user.id, 'btn_regenerate'), callback_data=f'regen_{chat_id}'),
-                InlineKeyboardButton(text=t(callback.from_user.id, 'btn_modify'), callback_data=f'modify_{chat_id}')
-            ]
-        ])
+        stream, pipeline = open_reply_stream(callback.message, user, hosts, sent=callback.message)
+        on_delta = pipeline.feed if pipeline else stream.feed if stream else None
         
-        await callback.message.edit_text(content, reply_markup=keyboard)
-    await callback.answer()
+        typing_task = asyncio.create_task(send_typing_action(callback.message.chat.id))
+        notice = QueueNotice(callback.message, callback.from_user.id)
+        try:
+            response = await chat_lanes.run(chat_id, ticket, generate_reply(
+                chat, hosts, messages, TOOLS, on_delta=on_delta,
+                user_id=callback.from_user.id, on_queue=notice.update))
+        except GenerationSuperseded:
+            await finish_superseded(stream, pipeline, callback.from_user.id)
+            return
+        finally:
+            typing_task.cancel()
+        
+        keyboard = get_response_keyboard(callback.from_user.id, chat_id)
+        if response:
+            content = await translate_reply(pipeline, hosts, user, response['message']['content'])
+            await save_reply(chat_id, answer_id, response['message']['content'])
+        else:
+            # Поток мог оборваться после части текста: убираем курсор и возвращаем кнопки
+            if pipeline is not None:
+                pipeline.cancel()
+            content = t(callback.from_user.id, 'error_generating')
+        
+        if stream:
+            await stream.finish(content, reply_markup=keyboard)
+        else:
+            await callback.message.edit_text(content, reply_markup=keyboard)
+
+async def save_reply(chat_id: int, answer_id: Optional[int], content: str):
+    """Заменяет ответ модели по id или, если заменять нечего, добавляет новый"""
+    if answer_id is not None:
+        await adb.update_message(chat_id, answer_id, content)
+    else:
+        await adb.add_message(chat_id, 'assistant', content)
 
 @dp.callback_query(F.data.startswith('modify_'))
 async def modify_handler(callback: types.CallbackQuery):
     chat_id = int(callback.data.replace('modify_', ''))
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text=t(callback.from_user.id, 'btn_shorter'), callback_data=f'mod_shorter_{chat_id}'),
-            InlineKeyboardButton(text=t(callback.from_user.id, 'btn_longer'), callback_data=f'mod_longer_{chat_id}')
-        ],
-        [
-            InlineKeyboardButton(text=t(callback.from_user.id, 'btn_simpler'), callback_data=f'mod_simpler_{chat_id}'),
-            InlineKeyboardButton(text=t(callback.from_user.id, 'btn_complex'), callback_data=f'mod_complex_{chat_id}')
-        ],
-        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_edit_response'), callback_data=f'edit_resp_{chat_id}')],
-        [InlineKeyboardButton(text=t(callback.from_user.id, 'btn_back'), callback_data=f'cancel_modify_{chat_id}')]
-    ])
-    
-    await callback.message.edit_reply_markup(reply_markup=keyboard)
+    await callback.message.edit_reply_markup(reply_markup=get_modify_keyboard(callback.from_user.id, chat_id))
     await callback.answer()
 
 async def modify_response(callback: types.CallbackQuery, chat_id: int, modification: str):
-    user = db.get_user(callback.from_user.id)
-    chat = db.get_chat(chat_id)
-    messages = db.get_chat_messages(chat_id)
-    
-    mod_prompt = {
-        'shorter': 'Make your previous response shorter and more concise.',
-        'longer': 'Expand your previous response with more details.',
-        'simpler': 'Simplify your previous response for easier understanding.',
-        'complex': 'Make your previous response more detailed and sophisticated.'
-    }
-    
-    messages.append({'role': 'user', 'content': mod_prompt[modification]})
-    
-    typing_task = asyncio.create_task(send_typing_action(callback.message.chat.id))
-    response = await chat_with_ollama(user['host'], chat['model'], messages, TOOLS)
-    typing_task.cancel()
-    
-    if response:
-        content = response['message']['content']
-        if user['translator_model']:
-            content = await translate_text(user['host'], user['translator_model'], content, user['locale'])
+    async with chat_lanes.turn(chat_id) as ticket:
+        user = await adb.get_user(callback.from_user.id)
+        chat = await adb.get_chat(chat_id)
+        hosts = await get_user_host_urls(user)
+        last = await adb.get_last_message(chat_id)
+        answer_id = last['id'] if last and last['role'] == 'assistant' else None
+        messages = await build_context(chat, hosts, callback.from_user.id)
         
-        db.update_last_message(chat_id, response['message']['content'])
+        mod_prompt = {
+            'shorter': 'Make your previous response shorter and more concise.',
+            'longer': 'Expand your previous response with more details.',
+            'simpler': 'Simplify your previous response for easier understanding.',
+            'complex': 'Make your previous response more detailed and sophisticated.'
+        }
         
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text=t(callback.from_user.id, 'btn_regenerate'), callback_data=f'regen_{chat_id}'),
-                InlineKeyboardButton(text=t(callback.from_user.id, 'btn_modify'), callback_data=f'modify_{chat_id}')
-            ]
-        ])
+        messages.append({'role': 'user', 'content': mod_prompt[modification]})
+        
+        stream, pipeline = open_reply_stream(callback.message, user, hosts, sent=callback.message)
+        on_delta = pipeline.feed if pipeline else stream.feed if stream else None
+        
+        typing_task = asyncio.create_task(send_typing_action(callback.message.chat.id))
+        notice = QueueNotice(callback.message, callback.from_user.id)
+        try:
+            response = await chat_lanes.run(chat_id, ticket, generate_reply(
+                chat, hosts, messages, TOOLS, on_delta=on_delta,
+                user_id=callback.from_user.id, on_queue=notice.update))
+        except GenerationSuperseded:
+            await finish_superseded(stream, pipeline, callback.from_user.id)
+            return
+        finally:
+            typing_task.cancel()
         
-        await callback.message.edit_text(content, reply_markup=keyboard)
+        keyboard = get_response_keyboard(callback.from_user.id, chat_id)
+        if response:
+            content = await translate_reply(pipeline, hosts, user, response['message']['content'])
+            await save_reply(chat_id, answer_id, response['message']['content'])
+        else:
+            # Поток мог оборваться после части текста: убираем курсор и возвращаем кнопки
+            if pipeline is not None:
+                pipeline.cancel()
+            content = t(callback.from_user.id, 'error_generating')
+        
+        if stream:
+            await stream.finish(content, reply_markup=keyboard)
+        else:
+            await callback.message.edit_text(content, reply_markup=keyboard)
 
 @dp.callback_query(F.data.startswith('mod_shorter_'))
 async def mod_shorter_handler(callback: types.CallbackQuery):
@@ -1620,7 +3010,7 @@ async def response_edit_input_handler(message: types.Message, state: FSMContext)
     data = await state.get_data()
     chat_id = data.get('edit_chat_id')
     
-    db.update_last_message(chat_id, message.text)
+    await adb.update_last_message(chat_id, message.text)
     await state.clear()
     await message.answer(t(message.from_user.id, 'response_updated'))
 
@@ -1628,19 +3018,14 @@ async def response_edit_input_handler(message: types.Message, state: FSMContext)
 async def cancel_modify_handler(callback: types.CallbackQuery):
     chat_id = int(callback.data.replace('cancel_modify_', ''))
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text=t(callback.from_user.id, 'btn_regenerate'), callback_data=f'regen_{chat_id}'),
-            InlineKeyboardButton(text=t(callback.from_user.id, 'btn_modify'), callback_data=f'modify_{chat_id}')
-        ]
-    ])
+    keyboard = get_response_keyboard(callback.from_user.id, chat_id)
     
     await callback.message.edit_reply_markup(reply_markup=keyboard)
     await callback.answer()
 
 @dp.inline_query()
 async def inline_query_handler(inline_query: types.InlineQuery):
-    user = db.get_user(inline_query.from_user.id)
+    user = await adb.get_user(inline_query.from_user.id)
     
     if not user or not user['selected_model']:
         results = [
@@ -1686,15 +3071,16 @@ async def inline_query_handler(inline_query: types.InlineQuery):
 @dp.callback_query(F.data.startswith('inline_answer_'))
 async def inline_answer_handler(callback: types.CallbackQuery):
     query = callback.data.replace('inline_answer_', '')
-    user = db.get_user(callback.from_user.id)
+    user = await adb.get_user(callback.from_user.id)
     
     messages = [{'role': 'user', 'content': query}]
-    response = await chat_with_ollama(user['host'], user['selected_model'], messages)
+    hosts = await get_user_host_urls(user)
+    response = await host_pool.chat(hosts, user['selected_model'], messages, user_id=callback.from_user.id)
     
     if response:
         content = response['message']['content']
         if user['translator_model']:
-            content = await translate_text(user['host'], user['translator_model'], content, user['locale'])
+            content = await translate_text(hosts, user['translator_model'], content, user['locale'], user['user_id'])
         await callback.message.edit_text(content)
     else:
         await callback.message.edit_text(t(callback.from_user.id, 'error_generating'))
@@ -1704,25 +3090,17 @@ async def inline_answer_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith('inline_translate_'))
 async def inline_translate_handler(callback: types.CallbackQuery):
     query = callback.data.replace('inline_translate_', '')
-    user = db.get_user(callback.from_user.id)
+    user = await adb.get_user(callback.from_user.id)
     
     if not user['translator_model']:
         await callback.message.edit_text(t(callback.from_user.id, 'no_translator'))
         await callback.answer()
         return
     
-    system_prompt = '''You are a professional translator. Input is a JSON object where the key is the target language code and the value is the source text. Translate the text accurately, preserving meaning and nuances, following the target language's grammar and cultural norms. Output ONLY the translated text, with no explanations, comments, or formatting.'''
-    
-    json_input = json.dumps({user['locale']: query})
-    messages = [
-        {'role': 'system', 'content': system_prompt},
-        {'role': 'user', 'content': json_input}
-    ]
-    
-    response = await chat_with_ollama(user['host'], user['translator_model'], messages)
+    hosts = await get_user_host_urls(user)
+    content = await request_translation(hosts, user['translator_model'], query, user['locale'], callback.from_user.id)
     
-    if response:
-        content = response['message']['content'].strip()
+    if content is not None:
         await callback.message.edit_text(content)
     else:
         await callback.message.edit_text(t(callback.from_user.id, 'error_translating'))
@@ -1735,106 +3113,287 @@ async def text_message_handler(message: types.Message):
     user_id = message.from_user.id
     
     # Check if it's a keyboard button
-    if text == t(user_id, 'btn_model_select'):
-        fake_callback = types.CallbackQuery(
-            id='fake', from_user=message.from_user, message=message,
-            chat_instance='', data='select_model'
-        )
-        await select_model_handler(fake_callback)
-        return
-    
-    if text == t(user_id, 'btn_chats'):
-        fake_callback = types.CallbackQuery(
-            id='fake', from_user=message.from_user, message=message,
-            chat_instance='', data='chat_list'
-        )
-        await chat_list_handler(fake_callback)
-        return
-    
-    if text == t(user_id, 'btn_settings'):
+    action = MENU_BUTTONS[get_locale(user_id)].get(text)
+    if action:
+        chat_lanes.depart(user_id, message.message_id)
         fake_callback = types.CallbackQuery(
             id='fake', from_user=message.from_user, message=message,
-            chat_instance='', data='settings'
+            chat_instance='', data=action
         )
-        await settings_handler(fake_callback)
+        handler = {'select_model': select_model_handler,
+                   'chat_list': chat_list_handler,
+                   'settings': settings_handler}[action]
+        await handler(fake_callback)
         return
     
     # Process as regular user message
-    user = db.get_user(message.from_user.id)
+    # Более ранние сообщения сначала занимают ход: иначе быстрые сообщения подряд могли бы попасть
+    # в очередь чата в обратном порядке или создать два новых чата
+    await chat_lanes.wait_arrival(user_id, message.message_id)
+    user = await adb.get_user(message.from_user.id)
     
     if not user or not user['selected_model']:
         await message.answer(t(message.from_user.id, 'please_select_model'))
         return
     
-    if message.from_user.id not in user_states or not user_states[message.from_user.id].get('current_chat'):
-        chat_id = db.create_chat(message.from_user.id, t(message.from_user.id, 'new_chat_name'), user['selected_model'])
-        user_states[message.from_user.id] = {'current_chat': chat_id}
-    
-    chat_id = user_states[message.from_user.id]['current_chat']
-    chat = db.get_chat(chat_id)
+    chat_id = (await get_user_state(message.from_user.id)).get('current_chat')
+    if not chat_id:
+        chat_id = await adb.create_chat(message.from_user.id, t(message.from_user.id, 'new_chat_name'), user['selected_model'])
+        await set_user_state(message.from_user.id, {'current_chat': chat_id})
     
-    user_text = message.text
-    if user['translator_model']:
-        user_text = await translate_text(user['host'], user['translator_model'], message.text, 'en')
-    
-    db.add_message(chat_id, 'user', user_text)
-    
-    typing_task = asyncio.create_task(send_typing_action(message.chat.id))
-    
-    messages = db.get_chat_messages(chat_id)
-    response = await chat_with_ollama(user['host'], chat['model'], messages, TOOLS)
-    
-    typing_task.cancel()
-    
-    if not response:
-        await message.answer(t(message.from_user.id, 'error_generating'))
+    # Ходы одного чата выполняются по очереди, чтобы ответы и записи в БД не перемешивались
+    async with chat_lanes.turn(chat_id, arrival=(user_id, message.message_id)) as ticket:
+        chat = await adb.get_chat(chat_id)
+        
+        hosts = await get_user_host_urls(user)
+        user_text = message.text
+        if user['translator_model']:
+            user_text = await translate_text(hosts, user['translator_model'], message.text, 'en', user['user_id'])
+        
+        await adb.add_message(chat_id, 'user', user_text)
+        
+        # Ответ показывается по мере генерации (с переводчиком - по мере перевода предложений)
+        stream, pipeline = open_reply_stream(message, user, hosts)
+        on_delta = pipeline.feed if pipeline else stream.feed if stream else None
+        
+        typing_task = asyncio.create_task(send_typing_action(message.chat.id))
+        
+        messages = await build_context(chat, hosts, user_id)
+        notice = QueueNotice(message, user_id)
+        try:
+            response = await chat_lanes.run(chat_id, ticket, generate_reply(
+                chat, hosts, messages, TOOLS, on_delta=on_delta, user_id=user_id, on_queue=notice.update))
+        except GenerationSuperseded:
+            await finish_superseded(stream, pipeline, user_id)
+            return
+        finally:
+            typing_task.cancel()
+        
+        if not response:
+            if stream and stream.sent:
+                await stream.finish(t(message.from_user.id, 'error_generating'))
+            else:
+                await message.answer(t(message.from_user.id, 'error_generating'))
+            return
+        
+        tool_context = {'chat': chat, 'chat_id': chat_id, 'user_id': user_id, 'notes': []}
+        
+        async def generate(step_tools: Optional[List[Dict]]) -> Optional[Dict]:
+            return await chat_lanes.run(chat_id, ticket, generate_reply(
+                chat, hosts, messages, step_tools, on_delta=on_delta, user_id=user_id, on_queue=notice.update))
+        
+        try:
+            # Вызовы одного шага выполняются параллельно, их результаты уходят модели одним запросом
+            assistant_message = await run_agent(response['message'], messages, tool_context, generate)
+        except GenerationSuperseded:
+            await finish_superseded(stream, pipeline, user_id)
+            return
+        tool_notes = tool_context['notes']
+        
+        if assistant_message['content']:
+            content = await translate_reply(pipeline, hosts, user, assistant_message['content'])
+            await adb.add_message(chat_id, 'assistant', assistant_message['content'])
+        else:
+            # Цепочка инструментов оборвана по лимиту шагов или времени, не дав ответа
+            if pipeline is not None:
+                pipeline.cancel()
+            content = t(message.from_user.id, 'error_generating')
+        
+        full_text = content
+        if tool_notes:
+            full_text += '\n\n' + '\n'.join(tool_notes)
+        
+        keyboard = get_response_keyboard(message.from_user.id, chat_id)
+        
+        if stream:
+            await stream.finish(full_text, reply_markup=keyboard)
+        else:
+            await message.answer(full_text, reply_markup=keyboard)
+
+def stats_report(prompt_stats: Optional[Dict] = None) -> str:
+    """Сводка счётчиков процесса; prompt_stats - статистика prompt eval одного чата"""
+    replies = stream_stats['replies']
+    lines = [
+        f"📈 Статистика процесса {multiprocessing.current_process().name}",
+        f"Потоковые ответы: {replies}, среднее время до первого фрагмента "
+        f"{stream_stats['ttft_total'] / replies if replies else 0:.2f} с",
+        f"Соединения с Ollama: повторно использовано {ollama.reuse_rate():.0%}",
+        f"Кэш переводов: попаданий {translation_cache.hit_ratio:.0%} {translation_cache.stats}",
+        f"Агент: {agent_stats}",
+        f"Очереди чатов: {chat_lanes.stats}",
+        f"Каталог моделей: {model_catalog.stats}",
+        f"Резидентность моделей: {residency.stats}",
+        f"Отложенная запись: {adb.stats}",
+    ]
+    if prompt_stats:
+        lines.append(
+            f"Текущий чат: запросов {prompt_stats['requests']}, Ollama вычислила {prompt_stats['prompt_eval_count']} "
+            f"токенов промпта за {prompt_stats['prompt_eval_duration'] / 1e9:.1f} с, "
+            f"из кэша префикса ~{prompt_stats['estimated_reuse_ratio']:.0%} (оценка: ~4 символа на токен)")
+    return '\n'.join(lines)
+
+async def log_stats():
+    while True:
+        await asyncio.sleep(STATS_LOG_INTERVAL)
+        print(stats_report())
+
+async def close_resources():
+    if calculator_pool is not None:
+        calculator_pool.close()
+    await residency.stop()
+    await host_pool.stop()
+    await ollama.close()
+    await storage.close()
+    await adb.close()
+
+async def run_webhook():
+    """Принимает обновления через aiohttp-сервер; обработчики те же, что и при polling"""
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                          allowed_updates=dp.resolve_used_update_types())
+    print(f"🌐 Webhook установлен: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+# Несколько webhook-процессов тоже получают обновления через шардирующий приём:
+# у каждого процесса свои кэши, очереди чатов и отложенные записи, и пользователь не должен попадать в два процесса
+SHARD_PROCESSES = max(SHARD_WORKERS, WEBHOOK_WORKERS if WEBHOOK_URL else 1)
+
+shard_stats = {'routed': [0] * SHARD_PROCESSES}
+
+def update_owner(update: Dict) -> int:
+    """Id владельца обновления: пользователь, иначе чат, иначе само обновление"""
+    event = next((value for key, value in update.items() if key != 'update_id' and isinstance(value, dict)), {})
+    owner = event.get('from') or event.get('user') or event.get('chat') or (event.get('message') or {}).get('chat') or {}
+    return owner.get('id', update.get('update_id', 0))
+
+def shard_of(update: Dict) -> int:
+    """Номер процесса-обработчика для обновления: по id пользователя, иначе по чату"""
+    return update_owner(update) % SHARD_PROCESSES
+
+async def route_update(queues: List, update: Dict):
+    shard = shard_of(update)
+    shard_stats['routed'][shard] += 1
+    # Переполненная очередь задерживает приём обновлений — естественное ограничение нагрузки;
+    # ожидание идёт в потоке, чтобы не останавливать цикл событий приёма
+    await asyncio.get_running_loop().run_in_executor(None, queues[shard].put, json.dumps(update))
+
+async def run_ingress(queues: List):
+    """Принимает обновления (webhook или polling) и раздаёт их процессам-обработчикам"""
+    if WEBHOOK_URL:
+        async def handle(request: web.Request) -> web.Response:
+            if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+                return web.Response(status=401)
+            await route_update(queues, await request.json())
+            return web.Response()
+        
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                              allowed_updates=dp.resolve_used_update_types())
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
         return
     
-    assistant_message = response['message']
-    tool_notes = []
-    
-    if 'tool_calls' in assistant_message:
-        for tool_call in assistant_message['tool_calls']:
-            func_name = tool_call['function']['name']
-            func_args = tool_call['function']['arguments']
-            
-            if func_name == 'rename_chat':
-                old_name = chat['chat_name']
-                new_name = func_args['new_name']
-                db.update_chat_name(chat_id, new_name)
-                tool_notes.append(f"(ИИ изменил имя чата: \"{old_name}\" → \"{new_name}\")")
-            elif func_name == 'calculator':
-                result = execute_tool(func_name, func_args)
-                messages.append({'role': 'assistant', 'content': '', 'tool_calls': assistant_message['tool_calls']})
-                messages.append({'role': 'tool', 'content': result})
-                response = await chat_with_ollama(user['host'], chat['model'], messages)
-                if response:
-                    assistant_message = response['message']
-    
-    content = assistant_message['content']
-    
-    if user['translator_model'] and content:
-        content = await translate_text(user['host'], user['translator_model'], content, user['locale'])
-    
-    db.add_message(chat_id, 'assistant', assistant_message['content'])
-    
-    full_text = content
-    if tool_notes:
-        full_text += '\n\n' + '\n'.join(tool_notes)
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text=t(message.from_user.id, 'btn_regenerate'), callback_data=f'regen_{chat_id}'),
-            InlineKeyboardButton(text=t(message.from_user.id, 'btn_modify'), callback_data=f'modify_{chat_id}')
-        ]
-    ])
-    
-    await message.answer(full_text, reply_markup=keyboard)
+    await bot.delete_webhook()
+    offset = None
+    allowed_updates = dp.resolve_used_update_types()
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:
+            print(f"Ошибка получения обновлений: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            await route_update(queues, update.model_dump(mode='json', exclude_unset=True, by_alias=True))
+            offset = update.update_id + 1
+
+async def run_shard(updates: multiprocessing.Queue, shard: int):
+    """Процесс-обработчик: выполняет обновления своей доли пользователей"""
+    loop = asyncio.get_running_loop()
+    reader = ThreadPoolExecutor(max_workers=1)
+    tasks = set()
+    host_pool.start()
+    if shard == 0:
+        # Загрузкой моделей управляет один процесс; остальные только записывают спрос в общую таблицу
+        residency.start()
+    stats_task = asyncio.create_task(log_stats()) if STATS_LOG_INTERVAL else None
+    try:
+        while True:
+            raw = await loop.run_in_executor(reader, updates.get)
+            if raw is None:
+                break
+            update = types.Update.model_validate_json(raw, context={'bot': bot})
+            # Обновления передаются диспетчеру в порядке поступления, но не ждут друг друга: иначе нажатия
+            # и новые сообщения стояли бы за идущей генерацией. Порядок ходов одного чата держит ChatLanes
+            task = asyncio.create_task(dp.feed_update(bot, update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        if stats_task:
+            stats_task.cancel()
+        reader.shutdown(wait=False)
+        await bot.session.close()
+        await close_resources()
+
+def run_shard_worker(updates: multiprocessing.Queue, shard: int):
+    try:
+        asyncio.run(run_shard(updates, shard))
+    except KeyboardInterrupt:
+        pass
+
+def run_sharded():
+    # spawn: каждый процесс заново создаёт соединения с БД, Ollama и Telegram
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue(SHARD_QUEUE_SIZE) for _ in range(SHARD_PROCESSES)]
+    workers = [context.Process(target=run_shard_worker, args=(q, i)) for i, q in enumerate(queues)]
+    for process in workers:
+        process.start()
+    print(f"🔀 Обновления распределяются между {SHARD_PROCESSES} процессами")
+    try:
+        asyncio.run(run_ingress(queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for q in queues:
+            q.put(None)
+        for process in workers:
+            process.join()
 
 async def main():
     print("🤖 Ollama Telegram Bot запущен!")
     print("📊 Ожидание сообщений...")
-    await dp.start_polling(bot)
+    host_pool.start()
+    residency.start()
+    stats_task = asyncio.create_task(log_stats()) if STATS_LOG_INTERVAL else None
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        if stats_task:
+            stats_task.cancel()
+        await close_resources()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    if SHARD_PROCESSES > 1:
+        run_sharded()
+    else:
+        asyncio.run(main())